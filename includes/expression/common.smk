@@ -78,8 +78,7 @@ def get_strand(wildcards):
 def check_housekeeping():
     """Check if we can find each housekeeping gene in the GTF file"""
     # Read the mapping from ENSG to gene name
-    with open(config["gtf"]) as fin:
-        ensg_to_name = gtf.gene_id_name(fin)
+    ensg_to_name = gtf.GTFIndex.open(config["gtf"]).gene_id_name()
 
     # Create mapping from name to ENSG
     name_to_ensg = {v: k for k, v in ensg_to_name.items()}
@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 
 import argparse
-from typing import Any
+import sys
+from array import array
+from typing import Any, TextIO, Union
 import pysam
 from statistics import median
 
 from collections import defaultdict
 from dataclasses import dataclass
 
-from typing import Iterator, Optional
-from gtf import gene_id_name
+from typing import Iterable, Iterator, Optional
+from gtf import GTFIndex
+
+try:
+    import numpy as np
+
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+# Mask to store the hash of a read name as an unsigned 64-bit integer
+HASH_MASK = 2**64 - 1
 
 
 @dataclass
@@ -33,6 +45,59 @@ class Coverage:
     reverse: Optional[float]
 
 
+class CompactNames:
+    """Set of read names, stored as 64-bit hashes in a typed array
+
+    Read names are added to the array as-is, and deduplicated by sorting
+    whenever the array has doubled in size. This uses a fraction of the memory
+    of a set of strings, while the number of names is exact as long as there
+    are no hash collisions, which is extremely unlikely for 64-bit hashes.
+    """
+
+    def __init__(self) -> None:
+        self.hashes = array("Q")
+        self.unique = 0
+
+    def add(self, name: str) -> None:
+        self.hashes.append(hash(name) & HASH_MASK)
+        if len(self.hashes) >= 2 * max(self.unique, 1024):
+            self.compact()
+
+    def compact(self) -> None:
+        """Sort the hashes and remove duplicates"""
+        if HAS_NUMPY:
+            unique = np.unique(np.frombuffer(self.hashes, dtype=np.uint64))
+            self.hashes = array("Q", unique.tobytes())
+        else:
+            hashes = array("Q")
+            previous = None
+            for value in sorted(self.hashes):
+                if value != previous:
+                    hashes.append(value)
+                    previous = value
+            self.hashes = hashes
+        self.unique = len(self.hashes)
+
+    def __len__(self) -> int:
+        if len(self.hashes) != self.unique:
+            self.compact()
+        return self.unique
+
+    def nbytes(self) -> int:
+        """Return the number of bytes used to store the hashes"""
+        return sys.getsizeof(self.hashes)
+
+
+ReadNames = Union[set[str], CompactNames]
+
+
+def names_nbytes(names: ReadNames) -> int:
+    """Return the number of bytes used to store the read names"""
+    if isinstance(names, CompactNames):
+        return names.nbytes()
+    return sys.getsizeof(names) + sum(sys.getsizeof(name) for name in names)
+
+
 def parse_bed(fname: str) -> Iterator[Bed]:
     """Parse BED file and yield records"""
     with open(fname) as fin:
@@ -48,64 +113,128 @@ def parse_bed(fname: str) -> Iterator[Bed]:
             yield B
 
 
-def get_reads(record: Bed, bamfile: str) -> Iterator[pysam.AlignedSegment]:
-    """Get reads that overlap Bed record
+def include_read(read: pysam.AlignedSegment) -> bool:
+    """Determine if a read should be counted
 
     To mimic the results from the STAR counts table, ignore reads that are
      - supplementary
      - secondary
      - not in proper pairs
     """
-    with pysam.AlignmentFile(bamfile, "rb") as samfile:
-        for read in samfile.fetch(
-            contig=record.chrom, start=record.chromStart, end=record.chromEnd
-        ):
-            if read.is_supplementary or read.is_secondary or not read.is_proper_pair:
-                continue
-            yield read
-
-
-def read_names(Bed: Bed, bamfile: str) -> dict[str, set[str]]:
-    """Extract the read names in Bed region, per strandedness"""
-
-    # Store the read name to ensure we don't count forward/reverse double
-    by_strand: dict[str, set[str]] = {
-        "unstranded": set(),
-        "forward": set(),
-        "reverse": set(),
-    }
-
-    for read in get_reads(Bed, bamfile):
-        orientation = orientation_first(read)
-        read_name = read.query_name
-        assert read_name is not None
-        if orientation == Bed.strand:
-            by_strand["forward"].add(read_name)
-        else:
-            by_strand["reverse"].add(read_name)
+    return not (read.is_supplementary or read.is_secondary or not read.is_proper_pair)
+
 
-        # For unstranded, we count both orientations
-        by_strand["unstranded"].add(read_name)
+def group_regions(records: Iterable[Bed]) -> dict[str, list[list[Bed]]]:
+    """Group the BED records per contig into clusters of overlapping records
 
-    return by_strand
+    The records in every cluster are sorted by start position
+    """
+    per_contig: dict[str, list[Bed]] = defaultdict(list)
+    for record in records:
+        per_contig[record.chrom].append(record)
+
+    clusters: dict[str, list[list[Bed]]] = dict()
+    for contig, contig_records in per_contig.items():
+        contig_records.sort(key=lambda record: (record.chromStart, record.chromEnd))
+        contig_clusters: list[list[Bed]] = list()
+        cluster_end = 0
+        for record in contig_records:
+            if contig_clusters and record.chromStart <= cluster_end:
+                contig_clusters[-1].append(record)
+                cluster_end = max(cluster_end, record.chromEnd)
+            else:
+                contig_clusters.append([record])
+                cluster_end = record.chromEnd
+        clusters[contig] = contig_clusters
+
+    return clusters
+
+
+def read_names_by_name(
+    records: Iterable[Bed], bamfile: str, compact: bool = False
+) -> dict[str, dict[str, ReadNames]]:
+    """Extract the read names per strandedness for all BED records at once
+
+    The BAM file is only opened once, and overlapping records are merged so
+    every read is only fetched once.
+
+    If compact is set, the read names are stored as CompactNames instead of
+    sets of strings.
+    """
+    new_names = CompactNames if compact else set
+    records = list(records)
+    by_name: dict[str, dict[str, ReadNames]] = dict()
+    # Keep the names in the order of the BED file
+    for record in records:
+        if record.name not in by_name:
+            by_name[record.name] = {
+                "unstranded": new_names(),
+                "forward": new_names(),
+                "reverse": new_names(),
+            }
 
+    with pysam.AlignmentFile(bamfile, "rb") as samfile:
+        for contig, clusters in group_regions(records).items():
+            for cluster in clusters:
+                start = cluster[0].chromStart
+                end = max(record.chromEnd for record in cluster)
+                for read in samfile.fetch(contig=contig, start=start, end=end):
+                    if not include_read(read):
+                        continue
+                    assign_read(read, cluster, by_name)
+
+    return by_name
+
+
+def assign_read(
+    read: pysam.AlignedSegment,
+    cluster: list[Bed],
+    by_name: dict[str, dict[str, ReadNames]],
+) -> None:
+    """Add the read name to every record in the cluster that the read overlaps
 
-def get_bed_coverage(bedfile: str, bamfile: str) -> dict[str, Coverage]:
+    A read overlaps a record in the same way as pysam fetch determines it
+    """
+    read_name = read.query_name
+    assert read_name is not None
+    read_start = read.reference_start
+    read_end = read.reference_end
+    if read_end is None:
+        read_end = read_start + 1
+
+    orientation = None
+    for record in cluster:
+        if record.chromStart >= read_end:
+            break
+        if record.chromEnd <= read_start:
+            continue
+        if orientation is None:
+            orientation = orientation_first(read)
+        names = by_name[record.name]
+        if orientation == record.strand:
+            names["forward"].add(read_name)
+        else:
+            names["reverse"].add(read_name)
+        names["unstranded"].add(read_name)
+
+
+def get_bed_coverage(
+    bedfile: str, bamfile: str, compact: bool = False
+) -> dict[str, Coverage]:
     """Get coverage for the regions specified in the bedfile"""
     # If there are multiple regions in the BED file with the same name, we add
     # the read names together so we don't count double
-    by_name: dict[str, dict[str, set[str]]] = defaultdict(
-        lambda: {"unstranded": set(), "forward": set(), "reverse": set()}
+    by_name = read_names_by_name(parse_bed(bedfile), bamfile, compact)
+
+    nbytes = sum(
+        names_nbytes(names) for reads in by_name.values() for names in reads.values()
     )
+    storage = "compact read names" if compact else "read names"
+    print(f"{storage} use {nbytes / 2**20:.2f} MiB", file=sys.stderr)
 
     # Final coverage counts
     coverage = dict()
 
-    for record in parse_bed(bedfile):
-        names = read_names(record, bamfile)
-        for strand in ["unstranded", "forward", "reverse"]:
-            by_name[record.name][strand].update(names[strand])
-
     for name, reads in by_name.items():
         u = reads["unstranded"]
         f = reads["forward"]
@@ -148,9 +277,8 @@ def read_STAR_counts(fname: str) -> Iterator[tuple[str, Coverage]]:
 def counts_by_name(countsfile: str, gtffile: str) -> dict[str, Coverage]:
     """Read the STAR counts by gene name"""
     counts = dict()
-    # Read the gft files to get the ENSG to name mapping
-    with open(gtffile) as fin:
-        ensg_to_name = gene_id_name(fin)
+    # Read the ENSG to name mapping from the (cached) GTF index
+    ensg_to_name = GTFIndex.open(gtffile).gene_id_name()
 
     # Read the STAR counts file
     for ensg, coverage in read_STAR_counts(countsfile):
@@ -174,6 +302,36 @@ def get_normalizer_values(
     return Coverage(median(unstranded), median(forward), median(reverse))  # type: ignore
 
 
+def normalize(
+    coverage: dict[str, Coverage], normalizer: Coverage
+) -> dict[str, Coverage]:
+    """Normalize the coverage by the normalizer values"""
+    normalized = dict()
+    for gene, cov in coverage.items():
+        norm = Coverage(cov.unstranded, cov.forward, cov.reverse)
+        # If all housekeeping genes have 0 expression, we set the value to None
+        try:
+            norm.unstranded /= normalizer.unstranded  # type: ignore
+        except ZeroDivisionError:
+            norm.unstranded = None
+        try:
+            norm.forward /= normalizer.forward  # type: ignore
+        except ZeroDivisionError:
+            norm.forward = None
+        try:
+            norm.reverse /= normalizer.reverse  # type: ignore
+        except ZeroDivisionError:
+            norm.reverse = None
+        normalized[gene] = norm
+    return normalized
+
+
+def write_coverage(coverage: dict[str, Coverage], fout: TextIO) -> None:
+    """Write the coverage as a table"""
+    for gene, cov in coverage.items():
+        print(gene, cov.unstranded, cov.forward, cov.reverse, sep="\t", file=fout)
+
+
 def main(
     bamfile: str,
     countsfile: str,
@@ -182,8 +340,26 @@ def main(
     bedfile: Optional[str],
     genes: list[str],
     raw: bool,
+    raw_output: Optional[str] = None,
+    normalized_output: Optional[str] = None,
+    compact: bool = False,
 ) -> None:
+    """Write the raw and/or normalized coverage
+
+    If no output files are specified, the raw (if raw is set) or normalized
+    coverage is written to stdout. Otherwise, both tables can be written from
+    the same pass over the input files.
+    """
+    outputs: list[tuple[str, bool]] = list()
+    if raw_output:
+        outputs.append((raw_output, True))
+    if normalized_output:
+        outputs.append((normalized_output, False))
+
     if not bedfile and not genes:
+        # Create the (empty) output files
+        for fname, _ in outputs:
+            open(fname, "w").close()
         exit(0)
 
     coverage: dict[str, Coverage] = dict()
@@ -194,31 +370,25 @@ def main(
     normalizer = get_normalizer_values(STAR_counts, housekeeping)
 
     if bedfile:
-        coverage = get_bed_coverage(bedfile, bamfile)
+        coverage = get_bed_coverage(bedfile, bamfile, compact)
 
     # Get the genes of interest from the STAR_counts
     for gene in genes:
         coverage[gene] = STAR_counts[gene]
 
-    # Normalize the coverage
-    if not raw:
-        for gene in coverage:
-            # If all housekeeping genes have 0 expression, we set the value to None
-            try:
-                coverage[gene].unstranded /= normalizer.unstranded  # type: ignore
-            except ZeroDivisionError:
-                coverage[gene].unstranded = None
-            try:
-                coverage[gene].forward /= normalizer.forward  # type: ignore
-            except ZeroDivisionError:
-                coverage[gene].forward = None
-            try:
-                coverage[gene].reverse /= normalizer.reverse  # type: ignore
-            except ZeroDivisionError:
-                coverage[gene].reverse = None
+    if not outputs:
+        if raw:
+            write_coverage(coverage, sys.stdout)
+        else:
+            write_coverage(normalize(coverage, normalizer), sys.stdout)
+        return
 
-    for gene, cov in coverage.items():
-        print(gene, cov.unstranded, cov.forward, cov.reverse, sep="\t")
+    for fname, is_raw in outputs:
+        with open(fname, "w") as fout:
+            if is_raw:
+                write_coverage(coverage, fout)
+            else:
+                write_coverage(normalize(coverage, normalizer), fout)
 
 
 if __name__ == "__main__":
@@ -254,6 +424,19 @@ if __name__ == "__main__":
         default=False,
         help="Do not normalize the expression counts",
     )
+    parser.add_argument(
+        "--raw-output", help="Write the raw expression counts to this file"
+    )
+    parser.add_argument(
+        "--normalized-output",
+        help="Write the normalized expression counts to this file",
+    )
+    parser.add_argument(
+        "--compact-read-names",
+        action="store_true",
+        default=False,
+        help="Store the read names as 64-bit hashes to reduce memory usage",
+    )
 
     args = parser.parse_args()
 
@@ -265,4 +448,7 @@ if __name__ == "__main__":
         args.bed,
         args.genes,
         args.raw,
+        args.raw_output,
+        args.normalized_output,
+        args.compact_read_names,
     )
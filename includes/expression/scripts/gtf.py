@@ -1,38 +1,286 @@
 #!/usr/bin/env python3
 
-from io import TextIOWrapper
+import functools
+import hashlib
+import mmap
+import os
+import struct
 import sys
 import json
-from typing import Iterator
+import re
+import tempfile
+from array import array
+from dataclasses import dataclass
+from typing import Container, Iterable, Iterator, Optional, Union
 
+# Features from the GTF file that are stored in the index
+INDEX_FEATURES = ("gene", "transcript")
+# Attributes from the GTF file that are stored in the index
+INDEX_ATTRIBUTES = ("gene_id", "gene_name", "transcript_id")
 
-def read_attributes(fin: TextIOWrapper) -> Iterator[dict[str, str]]:
+# Magic bytes and version of the index format
+INDEX_MAGIC = b"GTFIDX01"
+# Magic, number of strings, number of records, size of the string blob
+INDEX_HEADER = struct.Struct("<8sQQQ")
+# Feature, chrom, start, end, strand, gene_id, gene_name, transcript_id
+RECORD_FIELDS = 8
+
+
+@dataclass
+class GTFLine:
+    """A line from a GTF file, with the requested attributes"""
+
+    chrom: str
+    feature: str
+    start: int
+    end: int
+    strand: str
+    attributes: dict[str, str]
+
+
+def iter_gtf(
+    fin: Iterable[str],
+    features: Optional[Container[str]] = None,
+    keys: Optional[Iterable[str]] = None,
+) -> Iterator[GTFLine]:
+    """Iterate over the lines in a GTF file
+
+    Only lines of the specified feature types are parsed, and only the
+    specified attribute keys are extracted. Both default to everything. If a
+    specified key occurs multiple times in a line, the first value is used.
+    """
+    patterns = None if keys is None else attribute_patterns(keys)
     for line in fin:
         if line.startswith("#"):
             continue
-        spline = line.strip().split(maxsplit=8)
-        kvals = spline[-1]
+        spline = line.rstrip("\n").split("\t", maxsplit=8)
+        if features is not None and spline[2] not in features:
+            continue
+
+        kvals = spline[8].strip()
+        if patterns is None:
+            attributes = parse_attributes(kvals)
+        else:
+            attributes = dict()
+            for key, pattern in patterns:
+                if match := pattern.search(kvals):
+                    attributes[key] = match.group(1).strip(" ").replace('"', "")
+
+        yield GTFLine(
+            spline[0], spline[2], int(spline[3]), int(spline[4]), spline[6], attributes
+        )
+
+
+@functools.lru_cache
+def attribute_pattern(key: str) -> re.Pattern[str]:
+    return re.compile(f"(?:^|;) *{re.escape(key)} ([^;]*)")
+
 
-        d = dict()
-        for pair in kvals.split(";"):
-            if not pair:
-                continue
-            pair = pair.strip(" ")
-            k, v = pair.split(" ", maxsplit=1)
-            d[k] = v.replace('"', "")
-        yield d
+def attribute_patterns(keys: Iterable[str]) -> list[tuple[str, re.Pattern[str]]]:
+    """Return the regular expressions to extract the attribute keys"""
+    return [(key, attribute_pattern(key)) for key in keys]
 
 
-def gene_id_name(fin: TextIOWrapper) -> dict[str, str]:
-    """Return a two-way mapping between gene names and ID's"""
+def read_attributes(fin: Iterable[str]) -> Iterator[dict[str, str]]:
+    for line in iter_gtf(fin):
+        yield line.attributes
+
+
+def parse_attributes(kvals: str) -> dict[str, str]:
+    """Parse the attribute column of a GTF line"""
+    d = dict()
+    for pair in kvals.split(";"):
+        if not pair:
+            continue
+        pair = pair.strip(" ")
+        k, v = pair.split(" ", maxsplit=1)
+        d[k] = v.replace('"', "")
+    return d
+
+
+def gene_id_name(fin: Iterable[str]) -> dict[str, str]:
+    """Return a two-way mapping between gene names and ID's
+
+    Only the "gene" lines of the GTF file are used, so every gene must have a
+    gene line (as in the Ensembl and GENCODE GTF files).
+    """
     mapping = dict()
-    for record in read_attributes(fin):
+    for line in iter_gtf(fin, features={"gene"}, keys=("gene_id", "gene_name")):
+        record = line.attributes
         if "gene_id" in record and "gene_name" in record:
             # From geneID (ENSG) to gene name
             mapping[record["gene_id"]] = record["gene_name"]
     return mapping
 
 
+@dataclass
+class GTFRecord:
+    """Gene or transcript record from the GTF index"""
+
+    feature: str
+    chrom: str
+    start: int
+    end: int
+    strand: str
+    gene_id: str
+    gene_name: Optional[str]
+    transcript_id: Optional[str]
+
+
+class GTFIndex:
+    """Compact index of the gene and transcript records in a GTF file
+
+    Only the "gene" and "transcript" lines of the GTF file are indexed, so
+    genes or transcripts which only occur on other lines (such as exon lines)
+    are not included.
+
+    The index is a binary table, which can be used directly from a memory
+    mapped file. Strings are stored once, and only decoded when a record is
+    accessed.
+    """
+
+    def __init__(self, buffer: Union[bytes, mmap.mmap]) -> None:
+        self.buffer = buffer
+        magic, n_strings, n_records, blob_size = INDEX_HEADER.unpack_from(buffer)
+        if magic != INDEX_MAGIC:
+            raise ValueError("Invalid GTF index")
+
+        view = memoryview(buffer)
+        start = INDEX_HEADER.size
+        end = start + 8 * (n_strings + 1)
+        self.offsets = view[start:end].cast("Q")
+        start, end = end, end + 8 * RECORD_FIELDS * n_records
+        self.records = view[start:end].cast("q")
+        self.blob = view[end : end + blob_size]
+        self.n_records: int = n_records
+
+    def __len__(self) -> int:
+        return self.n_records
+
+    def __iter__(self) -> Iterator[GTFRecord]:
+        for idx in range(self.n_records):
+            yield self[idx]
+
+    def __getitem__(self, idx: int) -> GTFRecord:
+        if not 0 <= idx < self.n_records:
+            raise IndexError(idx)
+        fields = self.records[idx * RECORD_FIELDS : (idx + 1) * RECORD_FIELDS]
+        feature, chrom, start, end, strand, gene_id, gene_name, transcript_id = fields
+        return GTFRecord(
+            self.string(feature),
+            self.string(chrom),
+            start,
+            end,
+            self.string(strand),
+            self.string(gene_id),
+            self.string(gene_name) if gene_name >= 0 else None,
+            self.string(transcript_id) if transcript_id >= 0 else None,
+        )
+
+    def string(self, idx: int) -> str:
+        return str(self.blob[self.offsets[idx] : self.offsets[idx + 1]], "utf-8")
+
+    def features(self, feature: str) -> Iterator[GTFRecord]:
+        """Iterate over the records of the specified feature type"""
+        for record in self:
+            if record.feature == feature:
+                yield record
+
+    def gene_id_name(self) -> dict[str, str]:
+        """Return the mapping from gene ID to gene name"""
+        return {
+            record.gene_id: record.gene_name
+            for record in self.features("gene")
+            if record.gene_name is not None
+        }
+
+    @classmethod
+    def build(cls, fin: Iterable[str]) -> bytes:
+        """Build the index for the GTF file"""
+        strings: dict[str, int] = dict()
+
+        def intern(value: Optional[str]) -> int:
+            if value is None:
+                return -1
+            if value not in strings:
+                strings[value] = len(strings)
+            return strings[value]
+
+        records = array("q")
+        for line in iter_gtf(fin, INDEX_FEATURES, INDEX_ATTRIBUTES):
+            attributes = line.attributes
+            records.extend(
+                (
+                    intern(line.feature),
+                    intern(line.chrom),
+                    line.start,
+                    line.end,
+                    intern(line.strand),
+                    intern(attributes["gene_id"]),
+                    intern(attributes.get("gene_name")),
+                    intern(attributes.get("transcript_id")),
+                )
+            )
+
+        encoded = [string.encode() for string in strings]
+        offsets = array("Q", [0])
+        for value in encoded:
+            offsets.append(offsets[-1] + len(value))
+        blob = b"".join(encoded)
+
+        header = INDEX_HEADER.pack(
+            INDEX_MAGIC, len(strings), len(records) // RECORD_FIELDS, len(blob)
+        )
+        return header + offsets.tobytes() + records.tobytes() + blob
+
+    @classmethod
+    def open(cls, gtf_file: str, cache_dir: Optional[str] = None) -> "GTFIndex":
+        """Open the index for the GTF file, and build it on first use
+
+        The index is cached in cache_dir, keyed by the path, size and
+        modification time of the GTF file. If the index can not be written to
+        the cache, it is only kept in memory.
+        """
+        path = index_path(gtf_file, cache_dir)
+        if not os.path.exists(path):
+            with open(gtf_file) as fin:
+                data = cls.build(fin)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+                with os.fdopen(fd, "wb") as fout:
+                    fout.write(data)
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f"Unable to cache the GTF index: {e}", file=sys.stderr)
+                return cls(data)
+
+        with open(path, "rb") as fin:
+            return cls(mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def index_path(gtf_file: str, cache_dir: Optional[str] = None) -> str:
+    """Return the path of the cached index for the GTF file"""
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    stat = os.stat(gtf_file)
+    key = f"{os.path.abspath(gtf_file)}\t{stat.st_size}\t{stat.st_mtime_ns}"
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    fname = f"{os.path.basename(gtf_file)}.{digest}.idx"
+    return os.path.join(cache_dir, fname)
+
+
+def default_cache_dir() -> str:
+    """Return the directory to cache the GTF indices
+
+    This is the gtf folder in the HAMLET_CACHE environment variable. By
+    default, the indices are cached in .cache/hamlet in the working directory,
+    since the index is also opened while the workflow is parsed.
+    """
+    cache = os.environ.get("HAMLET_CACHE") or os.path.join(".cache", "hamlet")
+    return os.path.join(cache, "gtf")
+
+
 if __name__ == "__main__":
     with open(sys.argv[1]) as fin:
         mapping = gene_id_name(fin)
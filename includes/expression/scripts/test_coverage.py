@@ -4,7 +4,21 @@ import dataclasses
 
 from typing import Any, Sequence, cast
 
-from coverage import orientation_first
+from coverage import (
+    HAS_NUMPY,
+    Bed,
+    CompactNames,
+    Coverage,
+    group_regions,
+    get_bed_coverage,
+    normalize,
+    orientation_first,
+    assign_read,
+    parse_bed,
+    read_names_by_name,
+)
+
+BAM = "test/data/expression/SRR8615409.bam"
 
 
 @dataclasses.dataclass
@@ -64,3 +78,118 @@ def test_true(reads: Sequence[pysam.AlignedSegment]) -> None:
     print()
     for read in reads:
         print(read)
+
+
+def test_group_regions() -> None:
+    records = [
+        Bed("chr1", 50, 60, "C", 0, "+"),
+        Bed("chr1", 0, 10, "A", 0, "+"),
+        Bed("chr2", 0, 10, "D", 0, "+"),
+        Bed("chr1", 5, 20, "B", 0, "-"),
+    ]
+    clusters = group_regions(records)
+    assert [[r.name for r in cluster] for cluster in clusters["chr1"]] == [
+        ["A", "B"],
+        ["C"],
+    ]
+    assert [[r.name for r in cluster] for cluster in clusters["chr2"]] == [["D"]]
+
+
+def test_read_names_by_name() -> None:
+    """
+    GIVEN overlapping BED records, some of which have the same name
+    WHEN we extract the read names for all records at once
+    THEN the result should be the same as extracting them per record
+    """
+    records = list(parse_bed("test/data/reference/transcripts_chrM.bed"))
+    # Overlapping records, on both strands, with the same name
+    records += [
+        Bed("chrM", 10000, 12000, "MT-ND3", 0, "-"),
+        Bed("chrM", 11000, 11500, "overlap", 0, "+"),
+        Bed("chrM", 11200, 13000, "overlap", 0, "-"),
+    ]
+
+    expected: dict[str, dict[str, set[str]]] = dict()
+    for record in records:
+        names = expected.setdefault(
+            record.name, {"unstranded": set(), "forward": set(), "reverse": set()}
+        )
+        for strand, reads in read_names_by_name([record], BAM)[record.name].items():
+            names[strand].update(cast(set[str], reads))
+
+    by_name = read_names_by_name(records, BAM)
+    assert list(by_name) == list(expected)
+    assert by_name == expected
+    assert by_name["overlap"]["unstranded"]
+
+
+def test_assign_read(reads: Sequence[pysam.AlignedSegment]) -> None:
+    """
+    GIVEN a cluster of BED records, and reads which cover chr1:9-13
+    WHEN we assign the reads to the records in the cluster
+    THEN the read names should only be added to the overlapping records
+    """
+    cluster = [
+        Bed("chr1", 0, 9, "before", 0, "+"),
+        Bed("chr1", 5, 10, "start", 0, "+"),
+        Bed("chr1", 12, 20, "end", 0, "-"),
+        Bed("chr1", 13, 20, "after", 0, "+"),
+    ]
+    by_name: dict[str, dict[str, Any]] = {
+        record.name: {"unstranded": set(), "forward": set(), "reverse": set()}
+        for record in cluster
+    }
+    for read in reads:
+        assign_read(read, cluster, by_name)
+
+    assert (
+        by_name["before"]
+        == by_name["after"]
+        == {
+            "unstranded": set(),
+            "forward": set(),
+            "reverse": set(),
+        }
+    )
+    # The orientation of the first read of the pair determines the strand
+    assert by_name["start"] == {
+        "unstranded": {"read1", "read2", "read3", "read4"},
+        "forward": {"read1", "read4"},
+        "reverse": {"read2", "read3"},
+    }
+    assert by_name["end"] == {
+        "unstranded": {"read1", "read2", "read3", "read4"},
+        "forward": {"read2", "read3"},
+        "reverse": {"read1", "read4"},
+    }
+
+
+def test_normalize() -> None:
+    """
+    GIVEN raw coverage
+    WHEN we normalize it
+    THEN the raw coverage should not be changed
+    """
+    coverage = {"A": Coverage(10, 4, 0), "B": Coverage(0, 0, 0)}
+    normalized = normalize(coverage, Coverage(5, 2, 0))
+    assert normalized["A"] == Coverage(2, 2, None)
+    assert normalized["B"] == Coverage(0, 0, None)
+    assert coverage["A"] == Coverage(10, 4, 0)
+
+
+@pytest.mark.parametrize("has_numpy", [False, HAS_NUMPY])
+def test_compact_names(monkeypatch: pytest.MonkeyPatch, has_numpy: bool) -> None:
+    monkeypatch.setattr("coverage.HAS_NUMPY", has_numpy)
+    names = CompactNames()
+    for i in range(5000):
+        names.add(f"read{i % 3000}")
+    assert len(names) == 3000
+    # The array is compacted when it has doubled in size
+    assert len(names.hashes) == 3000
+    names.add("read0")
+    assert len(names) == 3000
+
+
+def test_get_bed_coverage_compact() -> None:
+    bed = "test/data/reference/transcripts_chrM.bed"
+    assert get_bed_coverage(bed, BAM, compact=True) == get_bed_coverage(bed, BAM)
@@ -0,0 +1,99 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from gtf import (
+    GTFIndex,
+    default_cache_dir,
+    gene_id_name,
+    index_path,
+    iter_gtf,
+    read_attributes,
+)
+
+GTF = "test/data/reference/hamlet-ref.gtf"
+
+
+def test_gtf_index(tmp_path: Path) -> None:
+    index = GTFIndex.open(GTF, str(tmp_path))
+    assert os.path.exists(index_path(GTF, str(tmp_path)))
+
+    record = index[1]
+    assert record.feature == "transcript"
+    assert record.chrom == "chr1"
+    assert (record.start, record.end, record.strand) == (114704469, 114716771, "-")
+    assert record.gene_name == "NRAS"
+    assert record.transcript_id == "ENST00000369535"
+
+    with open(GTF) as fin:
+        assert index.gene_id_name() == gene_id_name(fin)
+
+
+def test_gtf_index_cached(tmp_path: Path) -> None:
+    """
+    GIVEN a GTF file which has been indexed
+    WHEN the GTF file is modified
+    THEN a new index should be used
+    """
+    gtf = tmp_path / "test.gtf"
+    lines = Path(GTF).read_text().splitlines(keepends=True)
+    gtf.write_text("".join(lines[:2]))
+    cache = str(tmp_path / "cache")
+
+    assert len(GTFIndex.open(str(gtf), cache)) == 2
+    old_path = index_path(str(gtf), cache)
+
+    gtf.write_text("".join(lines[:1]))
+    os.utime(gtf, ns=(0, 0))
+    assert index_path(str(gtf), cache) != old_path
+    assert len(GTFIndex.open(str(gtf), cache)) == 1
+
+
+def test_gtf_index_unwritable_cache(tmp_path: Path) -> None:
+    # The cache directory can not be created, since it is a file
+    cache = tmp_path / "cache"
+    cache.touch()
+    index = GTFIndex.open(GTF, str(cache / "gtf"))
+    assert index[0].gene_name == "NRAS"
+
+
+def test_gtf_index_invalid() -> None:
+    with pytest.raises(ValueError, match="Invalid GTF index"):
+        GTFIndex(b"\0" * 32)
+
+
+def test_iter_gtf_features() -> None:
+    with open(GTF) as fin:
+        lines = list(iter_gtf(fin, features={"gene"}))
+    assert len(lines) == 79
+    assert lines[0].feature == "gene"
+    assert (lines[0].chrom, lines[0].start, lines[0].strand) == ("chr1", 114704469, "-")
+    assert lines[0].attributes["gene_biotype"] == "protein_coding"
+
+
+def test_iter_gtf_keys() -> None:
+    """
+    GIVEN a GTF file
+    WHEN we only extract some of the attribute keys
+    THEN the values should be the same as when parsing all attributes
+    """
+    keys = ("gene_id", "transcript_id", "exon_number", "ccds_id")
+    with open(GTF) as fin:
+        lines = list(iter_gtf(fin, keys=keys))
+    with open(GTF) as fin:
+        expected = [
+            {key: attributes[key] for key in keys if key in attributes}
+            for attributes in read_attributes(fin)
+        ]
+    assert [line.attributes for line in lines] == expected
+
+
+def test_default_cache_dir(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("HAMLET_CACHE", "/cache")
+    assert default_cache_dir() == os.path.join("/cache", "gtf")
+
+    # Never write to the home folder of the user by default
+    monkeypatch.delenv("HAMLET_CACHE")
+    assert default_cache_dir() == os.path.join(".cache", "hamlet", "gtf")
+
@@ -14,6 +14,7 @@ containers = {
     "crimson": "docker://quay.io/biocontainers/crimson:1.1.0--pyh5e36f6f_0",
     "multiqc": "docker://quay.io/biocontainers/multiqc:1.31--pyhdfd78af_0",
     "mutalyzer": "docker://quay.io/biocontainers/mutalyzer_hgvs_parser:0.3.8--pyh7e72e81_0",
+    "pysam": "docker://quay.io/biocontainers/pysam:0.22.1--py39h61809e1_2",
 }
 
 # If we run with the full hamlet configuration, subset the configuration
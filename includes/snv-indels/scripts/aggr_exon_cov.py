@@ -1,11 +1,44 @@
 #!/usr/bin/env python
 
 import argparse
+import bisect
+import itertools
 import json
+import math
 import sys
 import statistics as stats
-from collections import namedtuple
-from typing import Any, Dict, Iterable, Optional, Sequence, TextIO, Tuple
+from array import array
+from collections import OrderedDict, namedtuple
+from fractions import Fraction
+from multiprocessing import Pool
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+)
+
+try:
+    import numpy as np
+
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+try:
+    import pysam
+
+    HAS_PYSAM = True
+except ImportError:
+    HAS_PYSAM = False
+
+BACKENDS = ["python", "numpy"] if HAS_NUMPY else ["python"]
 
 
 class Row(
@@ -36,7 +69,9 @@ class Row(
         return (self.chrom, self.start + self.exon_pos)
 
 
-def aggr_covs_entry(entry: Dict[str, Any], cov_limits: Iterable[int]) -> Dict[str, Any]:
+def aggr_covs_entry(
+    entry: Dict[str, Any], cov_limits: Iterable[int], backend: str = "python"
+) -> Dict[str, Any]:
     covs = entry.pop("covs")
     metrics: Dict[str, Any] = {
         k: None for k in ("min", "max", "avg", "median", "stdev")
@@ -45,35 +80,201 @@ def aggr_covs_entry(entry: Dict[str, Any], cov_limits: Iterable[int]) -> Dict[st
     metrics["frac_cov_at_least"] = {f"{k}x": 0 for k in cov_limits}
     metrics["len"] = entry["end"] - entry["start"]
 
-    if covs:
-        covs.sort()
-        count = len(covs)
-        avg = stats.mean(covs)
-        median = stats.median(covs)
-        try:
-            stdev = stats.stdev(covs, xbar=avg)
-        except stats.StatisticsError:
-            stdev = None
-
-        limit_counts = {k: 0 for k in cov_limits}
-        for cov in covs:
-            for limit in cov_limits:
-                if cov >= limit:
-                    limit_counts[limit] += 1
-
-        metrics = {
+    if len(covs):
+        if isinstance(covs, DepthHistogram):
+            metrics = covs.metrics(cov_limits)
+        elif backend == "numpy":
+            metrics = covs_metrics_numpy(covs, cov_limits)
+        else:
+            metrics = covs_metrics(list(covs), cov_limits)
+
+    entry["metrics"] = metrics
+    return entry
+
+
+def covs_metrics(covs: Any, cov_limits: Iterable[int]) -> Dict[str, Any]:
+    """Calculate the coverage metrics from a list of depths"""
+    covs.sort()
+    count = len(covs)
+    avg = stats.mean(covs)
+    median = stats.median(covs)
+    try:
+        stdev = stats.stdev(covs, xbar=avg)
+    except stats.StatisticsError:
+        stdev = None
+
+    limit_counts = {k: 0 for k in cov_limits}
+    for cov in covs:
+        for limit in cov_limits:
+            if cov >= limit:
+                limit_counts[limit] += 1
+
+    return {
+        "count": count,
+        "min": covs[0],
+        "max": covs[-1],
+        "avg": avg,
+        "median": median,
+        "stdev": stdev,
+        "frac_cov_at_least": {f"{k}x": v / count for k, v in limit_counts.items()},
+    }
+
+
+def covs_metrics_numpy(covs: Any, cov_limits: Iterable[int]) -> Dict[str, Any]:
+    """Calculate the coverage metrics from an array of depths using numpy
+
+    The results are identical to covs_metrics, since the mean, median and
+    standard deviation are calculated with exact integer arithmetic in the
+    same way as the statistics module does.
+    """
+    covs = np.sort(np.asarray(covs, dtype=np.int64))
+    count = len(covs)
+
+    total = int(covs.sum())
+    avg = total // count if total % count == 0 else total / count
+
+    mid = count // 2
+    median: float
+    if count % 2:
+        median = int(covs[mid])
+    else:
+        median = (int(covs[mid - 1]) + int(covs[mid])) / 2
+
+    stdev = _stdev_numpy(covs, avg)
+
+    # The covs are sorted, so every value from the insertion point is >= limit
+    limit_counts = {k: count - int(np.searchsorted(covs, k)) for k in cov_limits}
+
+    return {
+        "count": count,
+        "min": int(covs[0]),
+        "max": int(covs[-1]),
+        "avg": avg,
+        "median": median,
+        "stdev": stdev,
+        "frac_cov_at_least": {f"{k}x": v / count for k, v in limit_counts.items()},
+    }
+
+
+def _stdev_numpy(covs: Any, xbar: Any) -> Optional[float]:
+    """Calculate the sample standard deviation like statistics.stdev(covs, xbar)"""
+    values, counts = np.unique(covs, return_counts=True)
+    return stdev_from_counts(
+        ((int(v), int(n)) for v, n in zip(values, counts)), xbar, len(covs)
+    )
+
+
+def stdev_from_counts(
+    counts: Iterable[Tuple[int, int]], xbar: Any, count: int
+) -> Optional[float]:
+    """Calculate the sample standard deviation from (depth, count) pairs
+
+    The squared deviations are calculated with the same (integer or float)
+    arithmetic as the statistics module (as of Python 3.11), and then summed
+    exactly. Floats are summed as integer ratios, grouped per denominator.
+    """
+    if count < 2:
+        return None
+
+    if isinstance(xbar, int):
+        ss = Fraction(sum(n * (v - xbar) ** 2 for v, n in counts))
+    else:
+        partials: Dict[int, int] = {}
+        for v, n in counts:
+            deviation = float(v) - xbar
+            num, den = (deviation * deviation).as_integer_ratio()
+            partials[den] = partials.get(den, 0) + num * n
+        ss = sum((Fraction(num, den) for den, num in partials.items()), Fraction(0))
+    mss = ss / (count - 1)
+
+    # Use the same (correctly rounded) square root as the statistics module
+    sqrt_of_frac = getattr(stats, "_float_sqrt_of_frac", None)
+    if sqrt_of_frac is not None:
+        return float(sqrt_of_frac(mss.numerator, mss.denominator))
+    return math.sqrt(mss)
+
+
+class DepthHistogram(object):
+    """Histogram of the depths of coverage of a single exon
+
+    Depths below max_depth are counted in a fixed size histogram, the (rare)
+    depths above that are kept in an overflow bucket as-is. This way, the
+    memory use per exon is bounded, while all metrics are still exact.
+    """
+
+    def __init__(self, max_depth: int = 1000) -> None:
+        self.max_depth = max_depth
+        self.bins = array("q", [0]) * max_depth
+        self.overflow = array("q")
+        self.count = 0
+        self.total = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, cov: int) -> None:
+        if 0 <= cov < self.max_depth:
+            self.bins[cov] += 1
+        else:
+            self.overflow.append(cov)
+        self.count += 1
+        self.total += cov
+
+    def counts(self) -> Iterable[Tuple[int, int]]:
+        """Yield (depth, count) pairs in ascending order of depth"""
+        overflow = sorted(self.overflow)
+        below = [cov for cov in overflow if cov < 0]
+        above = overflow[len(below) :]
+        in_bins: Iterable[Tuple[int, int]]
+        if HAS_NUMPY:
+            bins = np.frombuffer(self.bins, dtype=np.int64)
+            nonzero = np.flatnonzero(bins)
+            in_bins = zip(nonzero.tolist(), bins[nonzero].tolist())
+        else:
+            in_bins = ((cov, n) for cov, n in enumerate(self.bins) if n)
+        for cov in below:
+            yield cov, 1
+        yield from in_bins
+        for cov in above:
+            yield cov, 1
+
+    def metrics(self, cov_limits: Iterable[int]) -> Dict[str, Any]:
+        """Calculate the same coverage metrics as covs_metrics"""
+        count = self.count
+        avg = self.total // count if self.total % count == 0 else self.total / count
+
+        # A single cumulative sum over the histogram gives us every order
+        # statistic, and the number of depths below each limit
+        counts = list(self.counts())
+        depths = [cov for cov, _ in counts]
+        cumulative = list(itertools.accumulate(n for _, n in counts))
+
+        def nth(index: int) -> int:
+            return depths[bisect.bisect_right(cumulative, index)]
+
+        def at_least(limit: int) -> int:
+            below = bisect.bisect_left(depths, limit)
+            return count - cumulative[below - 1] if below else count
+
+        mid = count // 2
+        median: float
+        if count % 2:
+            median = nth(mid)
+        else:
+            median = (nth(mid - 1) + nth(mid)) / 2
+
+        limit_counts = {k: at_least(k) for k in cov_limits}
+
+        return {
             "count": count,
-            "min": covs[0],
-            "max": covs[-1],
+            "min": depths[0],
+            "max": depths[-1],
             "avg": avg,
             "median": median,
-            "stdev": stdev,
+            "stdev": stdev_from_counts(counts, avg, count),
             "frac_cov_at_least": {f"{k}x": v / count for k, v in limit_counts.items()},
         }
 
-    entry["metrics"] = metrics
-    return entry
-
 
 def parse_idm(idm_fh: TextIO) -> Dict[str, str]:
     idms = {}
@@ -95,6 +296,7 @@ def group_per_exon(
     input_fh: TextIO,
     idm_fh: Optional[TextIO] = None,
     cov_limits: Iterable[int] = (8, 10, 20, 30, 40, 50),
+    backend: str = "python",
 ) -> Dict[Key, Dict[str, Any]]:
     idms = {} if idm_fh is None else parse_idm(idm_fh)
     grouped: Dict[Key, Dict[str, Any]] = {}
@@ -116,22 +318,239 @@ def group_per_exon(
                     "gx": idms[row.feature],
                     "trx": row.feature,
                     "exon_num": row.exon_num,
-                    "covs": [],
+                    # Store the depths in a typed array to save memory
+                    "covs": array("q"),
                 }
             grouped[row.key]["covs"].append(row.cov)
 
-        if idx % 1_000_000 == 0 or idx == 1:
-            show = f"{idx // 1000000}M lines" if idx != 1 else f"{idx} line"
-            print(f"processed {show} ...", file=sys.stderr)
+        log_progress(idx)
 
     print(f"processed {idx:,} lines in total", file=sys.stderr)
     print("aggregating coverage values ...", file=sys.stderr)
 
-    return {k: aggr_covs_entry(v, cov_limits) for k, v in grouped.items()}
+    return {k: aggr_covs_entry(v, cov_limits, backend) for k, v in grouped.items()}
+
+
+def log_progress(idx: int) -> None:
+    if idx % 1_000_000 == 0 or idx == 1:
+        show = f"{idx // 1000000}M lines" if idx != 1 else f"{idx} line"
+        print(f"processed {show} ...", file=sys.stderr)
+
+
+def stream_per_exon(
+    input_fh: TextIO,
+    idm_fh: Optional[TextIO] = None,
+    cov_limits: Iterable[int] = (8, 10, 20, 30, 40, 50),
+    max_depth: int = 1000,
+) -> Iterator[Tuple[Key, Dict[str, Any]]]:
+    """Aggregate the exons from position-sorted input in constant memory
+
+    An exon is aggregated as soon as the input has moved past its end, so only
+    the exons that overlap the current position are kept in memory, with their
+    depths in a DepthHistogram. The exons are yielded in the same order, and
+    with the same metrics, as group_per_exon returns them.
+    """
+    idms = {} if idm_fh is None else parse_idm(idm_fh)
+    # The exons that have not been yielded yet, in order of appearance
+    pending: "OrderedDict[Key, Dict[str, Any]]" = OrderedDict()
+    # The exons that have been aggregated, to detect unsorted input
+    finished: Set[Key] = set()
+    region: Optional[Tuple[str, int]] = None
+
+    def aggregate_passed(chrom: Optional[str], start: int) -> None:
+        for key, entry in pending.items():
+            if "covs" in entry and (entry["chrom"] != chrom or entry["end"] <= start):
+                aggr_covs_entry(entry, cov_limits)
+                finished.add(key)
+
+    def ready() -> Iterator[Tuple[Key, Dict[str, Any]]]:
+        while pending:
+            key, entry = next(iter(pending.items()))
+            if "metrics" not in entry:
+                break
+            yield pending.popitem(last=False)
+
+    idx = 0
+    for idx, line in enumerate(input_fh, start=1):
+        row = Row.from_raw_line(line)
+
+        if (row.chrom, row.start) != region:
+            if region is not None and row.chrom == region[0] and row.start < region[1]:
+                msg = f"Input is not sorted at line {idx}: {line.strip()}"
+                raise ValueError(msg)
+            region = (row.chrom, row.start)
+            aggregate_passed(row.chrom, row.start)
+            yield from ready()
+
+        if not idms or row.feature in idms:
+            if row.key in finished:
+                msg = f"Exon {row.key} is not contiguous in the input at line {idx}"
+                raise ValueError(msg)
+            if row.key not in pending:
+                pending[row.key] = {
+                    "chrom": row.chrom,
+                    "start": row.start,
+                    "end": row.end,
+                    "gx": idms[row.feature],
+                    "trx": row.feature,
+                    "exon_num": row.exon_num,
+                    "covs": DepthHistogram(max_depth),
+                }
+            pending[row.key]["covs"].append(row.cov)
+
+        log_progress(idx)
+
+    print(f"processed {idx:,} lines in total", file=sys.stderr)
+
+    aggregate_passed(None, 0)
+    yield from ready()
+
+
+class Exon(namedtuple("Exon", ["chrom", "start", "end", "feature", "exon_num"])):
+
+    @classmethod
+    def from_bed_line(cls, line: str) -> "Exon":
+        cols = line.strip().split("\t")
+        return cls(cols[0], int(cols[1]), int(cols[2]), cols[3], int(cols[4]))
+
+    @property
+    def key(self) -> Tuple[str, int]:
+        return (self.feature, self.exon_num)
+
+
+def merge_regions(regions: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Merge overlapping and adjacent (start, end) regions"""
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(regions):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def region_depths(
+    bam_path: str, chrom: str, regions: Sequence[Tuple[int, int]]
+) -> List[Any]:
+    """Calculate the depth of coverage at every position of the regions
+
+    The depth is calculated like bedtools coverage -d does for a BAM file:
+    every mapped read covers its reference span, from the start of the first
+    to the end of the last aligned block. The regions are merged, so every
+    read is only fetched once for overlapping regions.
+    """
+    merged = merge_regions(regions)
+    merged_depths = list()
+
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        known = chrom in bam.references
+        for start, end in merged:
+            # Count where reads start and end, the depth is the cumulative sum
+            diff = [0] * (end - start + 1)
+            reads: Iterable[Any] = bam.fetch(chrom, start, end) if known else []
+            for read in reads:
+                if read.is_unmapped or read.reference_end is None:
+                    continue
+                read_start = max(read.reference_start, start)
+                read_end = min(read.reference_end, end)
+                if read_start < read_end:
+                    diff[read_start - start] += 1
+                    diff[read_end - start] -= 1
+            merged_depths.append(array("q", itertools.accumulate(diff[:-1])))
+
+    merged_starts = [start for start, _ in merged]
+    result = list()
+    for start, end in regions:
+        idx = bisect.bisect_right(merged_starts, start) - 1
+        offset = merged_starts[idx]
+        result.append(merged_depths[idx][start - offset : end - offset])
+    return result
+
+
+def group_bam_per_exon(
+    bam_path: str,
+    bed_fh: TextIO,
+    idm_fh: Optional[TextIO] = None,
+    cov_limits: Iterable[int] = (8, 10, 20, 30, 40, 50),
+    backend: str = "python",
+    workers: int = 1,
+) -> Dict[Key, Dict[str, Any]]:
+    """Calculate the exon coverage metrics directly from a BAM file
+
+    Only the exons in the BED file of the transcripts in the id mapping are
+    read from the BAM file, and the chromosomes are processed in parallel by
+    the specified number of workers. The result is identical to
+    group_per_exon on the output of bedtools coverage -d.
+    """
+    idms = {} if idm_fh is None else parse_idm(idm_fh)
+    exons = [Exon.from_bed_line(line) for line in bed_fh if line.strip()]
+    if idms:
+        exons = [exon for exon in exons if exon.feature in idms]
+
+    # The indices of the exons on every chromosome
+    per_chrom: Dict[str, List[int]] = OrderedDict()
+    for idx, exon in enumerate(exons):
+        per_chrom.setdefault(exon.chrom, []).append(idx)
+
+    tasks = [
+        (bam_path, chrom, [(exons[idx].start, exons[idx].end) for idx in indices])
+        for chrom, indices in per_chrom.items()
+    ]
+    if workers > 1 and len(tasks) > 1:
+        with Pool(min(workers, len(tasks))) as pool:
+            results = pool.starmap(region_depths, tasks)
+    else:
+        results = [region_depths(*task) for task in tasks]
+
+    exon_depths: List[Any] = [None] * len(exons)
+    for indices, chrom_depths in zip(per_chrom.values(), results):
+        for idx, depths in zip(indices, chrom_depths):
+            exon_depths[idx] = depths
+
+    print(f"processed {len(exons):,} exons in total", file=sys.stderr)
+    print("aggregating coverage values ...", file=sys.stderr)
+
+    grouped: Dict[Key, Dict[str, Any]] = {}
+    for exon, depths in zip(exons, exon_depths):
+        if exon.key not in grouped:
+            grouped[exon.key] = {
+                "chrom": exon.chrom,
+                "start": exon.start,
+                "end": exon.end,
+                "gx": idms[exon.feature],
+                "trx": exon.feature,
+                "exon_num": exon.exon_num,
+                "covs": array("q"),
+            }
+        grouped[exon.key]["covs"].extend(depths)
+
+    return {k: aggr_covs_entry(v, cov_limits, backend) for k, v in grouped.items()}
+
+
+def write_json_stream(items: Iterable[Tuple[str, Any]], fout: TextIO) -> None:
+    """Write the items as a JSON object, one item at a time
+
+    The output is identical to json.dump(dict(items), fout, indent=2)
+    """
+    empty = True
+    for key, value in items:
+        fout.write("{\n  " if empty else ",\n  ")
+        fout.write(json.dumps(key) + ": ")
+        fout.write(json.dumps(value, indent=2).replace("\n", "\n  "))
+        empty = False
+    fout.write("{}" if empty else "\n}")
 
 
 def main(
-    input_tsv: TextIO, output: str, id_mapping: str, cov_limit: Sequence[int]
+    input_tsv: TextIO,
+    output: str,
+    id_mapping: str,
+    cov_limit: Sequence[int],
+    backend: str = "python",
+    streaming: bool = False,
+    max_depth: int = 1000,
+    bam: Optional[str] = None,
+    workers: int = 1,
 ) -> None:
     """Calculates exon-level coverage metrics.
 
@@ -153,13 +572,38 @@ def main(
     is grouped by chromosome and then sorted by start and stop coordinates,
     in ascending order.
 
+    With the numpy backend, the metrics are calculated with vectorized numpy
+    operations, which produces identical output.
+
+    In streaming mode, every exon is written as soon as the input has moved
+    past it, and the depths are counted in a histogram of max_depth bins (with
+    an overflow bucket for higher depths). This uses constant memory and also
+    produces identical output, but requires the input to be sorted.
+
+    If a BAM file is specified, the input is a BED file of the exons instead,
+    with the transcript name and exon number in the fourth and fifth column.
+    The depth of coverage is then read directly from the (indexed) BAM file,
+    which avoids writing and parsing one line per base. The chromosomes are
+    processed in parallel by the specified number of workers.
     """
-    with open(id_mapping) as mapping:
-        grouped = group_per_exon(input_tsv, mapping, cov_limit)
 
     def serialize_key(row_key: Key) -> str:
         return f"{row_key[0]}|{row_key[1]}"
 
+    if streaming:
+        with open(id_mapping) as mapping, open(output, "wt") as fout:
+            exons = stream_per_exon(input_tsv, mapping, cov_limit, max_depth)
+            write_json_stream(((serialize_key(k), v) for k, v in exons), fout)
+        return
+
+    with open(id_mapping) as mapping:
+        if bam is not None:
+            grouped = group_bam_per_exon(
+                bam, input_tsv, mapping, cov_limit, backend, workers
+            )
+        else:
+            grouped = group_per_exon(input_tsv, mapping, cov_limit, backend)
+
     with open(output, "wt") as fout:
         json.dump({serialize_key(k): v for k, v in grouped.items()}, fout, indent=2)
 
@@ -177,6 +621,48 @@ if __name__ == "__main__":
         default=[8, 10, 20, 30, 40, 50],
         help="Values at which fraction coverage will be calculated.",
     )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="python",
+        help="Library to use for calculating the metrics.",
+    )
+
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Write every exon as soon as the sorted input has moved past it.",
+    )
+    parser.add_argument(
+        "--max-depth",
+        type=int,
+        default=1000,
+        help="Number of histogram bins per exon in streaming mode.",
+    )
+    parser.add_argument(
+        "--bam",
+        help="Read the depth from this BAM file, the input is a BED file of exons.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of chromosomes to process in parallel with --bam.",
+    )
 
     args = parser.parse_args()
-    main(args.input_tsv, args.output, args.id_mapping, args.cov_limit)
+    if args.bam and not HAS_PYSAM:
+        parser.error("--bam requires pysam to be installed")
+    if args.bam and args.streaming:
+        parser.error("--streaming can not be used with --bam")
+    main(
+        args.input_tsv,
+        args.output,
+        args.id_mapping,
+        args.cov_limit,
+        args.backend,
+        args.streaming,
+        args.max_depth,
+        args.bam,
+        args.workers,
+    )
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for the python hot paths of the snv-indels module
+
+All input data is generated synthetically and deterministically, so the
+results of different runs (and different versions of HAMLET) can be compared.
+Every benchmark runs in a separate process, to measure its peak memory usage.
+
+Example:
+    python3 benchmark.py --scale 1 --save results.json
+    python3 benchmark.py --scale 1 --compare results.json
+"""
+
+import argparse
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from dataclasses import asdict, dataclass
+from typing import Callable, Iterator
+
+import aggr_exon_cov
+import filter_annotate_vep
+from utils import Variant, get_position, parse_hgvs, read_criteria_file
+
+NUCLEOTIDES = "ACGT"
+
+CONSEQUENCES = [
+    "missense_variant",
+    "synonymous_variant",
+    "frameshift_variant",
+    "stop_gained",
+    "inframe_deletion",
+    "splice_region_variant",
+    "intron_variant",
+]
+
+
+@dataclass
+class Result:
+    name: str
+    records: int
+    seconds: float
+    peak_rss_mb: float
+
+    @property
+    def records_per_second(self) -> float:
+        return self.records / self.seconds if self.seconds else float("inf")
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name:<20}{self.records:>12,}{self.seconds:>10.2f}"
+            f"{self.records_per_second:>14,.0f}{self.peak_rss_mb:>12.1f}"
+        )
+
+
+def transcript_ids(count: int) -> list[str]:
+    """Generate versioned transcript identifiers"""
+    return [f"ENST{i:011d}.{i % 5 + 1}" for i in range(count)]
+
+
+def random_hgvsc(rng: random.Random, transcript: str) -> str:
+    """Generate a random cDNA HGVS description"""
+    position = rng.randint(1, 3000)
+    kind = rng.random()
+    if kind < 0.6:
+        ref, alt = rng.sample(NUCLEOTIDES, 2)
+        return f"{transcript}:c.{position}{ref}>{alt}"
+    elif kind < 0.75:
+        offset = rng.choice([-5, -2, 2, 5])
+        ref, alt = rng.sample(NUCLEOTIDES, 2)
+        return f"{transcript}:c.{position}{offset:+d}{ref}>{alt}"
+    elif kind < 0.9:
+        return f"{transcript}:c.{position}_{position + rng.randint(1, 30)}del"
+    else:
+        inserted = "".join(rng.choices(NUCLEOTIDES, k=rng.randint(1, 30)))
+        return f"{transcript}:c.{position}_{position + 1}ins{inserted}"
+
+
+def synthetic_vep_lines(
+    count: int, transcripts: list[str], seed: int = 42
+) -> Iterator[str]:
+    """Generate VEP 'json' output lines
+
+    Every record overlaps one to three transcripts. Half of the records use
+    transcripts which are not of interest.
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        position = 1000 + i * 10
+        ref, alt = rng.sample(NUCLEOTIDES, 2)
+        consequences = list()
+        for _ in range(rng.randint(1, 3)):
+            if rng.random() < 0.5:
+                transcript = rng.choice(transcripts)
+            else:
+                transcript = f"ENST9{rng.randint(0, 10**10):010d}.1"
+            consequences.append(
+                {
+                    "transcript_id": transcript.split(".")[0],
+                    "gene_id": f"ENSG{rng.randint(0, 10**11):011d}",
+                    "hgvsc": random_hgvsc(rng, transcript),
+                    "consequence_terms": rng.sample(CONSEQUENCES, rng.randint(1, 2)),
+                    "impact": "MODERATE",
+                    "biotype": "protein_coding",
+                }
+            )
+        record = {
+            "input": f"chr1\t{position}\t.\t{ref}\t{alt}\t.\tPASS\t.",
+            "most_severe_consequence": consequences[0]["consequence_terms"][0],
+            "transcript_consequences": consequences,
+            "colocated_variants": [
+                {"frequencies": {alt: {"gnomade": round(rng.random() * 0.02, 5)}}}
+            ],
+        }
+        yield json.dumps(record)
+
+
+def synthetic_criteria(count: int, transcripts: list[str], seed: int = 42) -> str:
+    """Generate the contents of a criteria file"""
+    rng = random.Random(seed)
+    lines = ["transcript_id\tconsequence\tstart\tend\tframe\tannotation"]
+    for i in range(count):
+        transcript = transcripts[i % len(transcripts)]
+        consequence = rng.choice(["", *CONSEQUENCES])
+        if rng.random() < 0.8:
+            position = rng.randint(1, 3000)
+            start, end = str(position), str(position + rng.randint(0, 200))
+        else:
+            start, end = "", ""
+        lines.append(f"{transcript}\t{consequence}\t{start}\t{end}\t\tcriterion{i}")
+    return "\n".join(lines) + "\n"
+
+
+def synthetic_exons(count: int, seed: int = 42) -> list[tuple[str, int, int, str, int]]:
+    """Generate sorted exons as (chrom, start, end, transcript, exon_num)"""
+    rng = random.Random(seed)
+    exons = list()
+    transcripts = transcript_ids(max(1, count // 10))
+    position = 1000
+    for i in range(count):
+        transcript = transcripts[i // 10].split(".")[0]
+        start = position + rng.randint(100, 1000)
+        end = start + rng.randint(50, 300)
+        exons.append(("chr1", start, end, transcript, i % 10 + 1))
+        position = end
+    return exons
+
+
+def synthetic_coverage_lines(
+    exons: list[tuple[str, int, int, str, int]], seed: int = 42
+) -> Iterator[str]:
+    """Generate the per base output of bedtools coverage -d for exons"""
+    rng = random.Random(seed)
+    for chrom, start, end, transcript, exon_num in exons:
+        depth = rng.randint(0, 200)
+        for pos in range(1, end - start + 1):
+            depth = max(0, depth + rng.randint(-3, 3))
+            yield f"{chrom}\t{start}\t{end}\t{transcript}\t{exon_num}\t{pos}\t{depth}\n"
+
+
+def synthetic_id_mapping(exons: list[tuple[str, int, int, str, int]]) -> str:
+    """Generate an id mapping file for the transcripts in exons"""
+    transcripts = sorted({exon[3] for exon in exons})
+    lines = ["gene_id\tgene_name\ttranscript_ids"]
+    for i, transcript in enumerate(transcripts):
+        lines.append(f"ENSG{i:011d}\tGENE{i}\t{transcript}")
+    return "\n".join(lines) + "\n"
+
+
+def bench_filter_annotate_vep(scale: float, tmpdir: str) -> int:
+    count = int(20_000 * scale)
+    transcripts = transcript_ids(200)
+
+    vep_file = os.path.join(tmpdir, "vep.txt.gz")
+    with gzip.open(vep_file, "wt") as fout:
+        for line in synthetic_vep_lines(count, transcripts):
+            fout.write(line + "\n")
+
+    criteria_file = os.path.join(tmpdir, "criteria.tsv")
+    with open(criteria_file, "wt") as fout:
+        fout.write(synthetic_criteria(int(200 * scale) or 1, transcripts))
+
+    # Discard the output, the benchmark is about processing the records
+    out = io.TextIOWrapper(io.BytesIO())
+    with redirect_stdout(out):
+        filter_annotate_vep.main(
+            vep_file, criteria_file, criteria_file, "", "gnomade", 0.01
+        )
+    return count
+
+
+def bench_criterion_match(scale: float, tmpdir: str) -> int:
+    transcripts = transcript_ids(50)
+    criteria_file = os.path.join(tmpdir, "criteria.tsv")
+    with open(criteria_file, "wt") as fout:
+        fout.write(synthetic_criteria(200, transcripts))
+    criteria = list(read_criteria_file(criteria_file))
+
+    rng = random.Random(42)
+    variants = [
+        Variant(random_hgvsc(rng, rng.choice(transcripts)), CONSEQUENCES[:2])
+        for _ in range(int(1000 * scale) or 1)
+    ]
+    for variant in variants:
+        for criterion in criteria:
+            criterion.match(variant)
+    return len(variants) * len(criteria)
+
+
+def bench_get_position(scale: float, tmpdir: str) -> int:
+    rng = random.Random(42)
+    transcripts = transcript_ids(50)
+    descriptions = [
+        random_hgvsc(rng, rng.choice(transcripts))
+        for _ in range(int(2000 * scale) or 1)
+    ]
+    # Make sure we measure the parsing, not the cache
+    parse_hgvs.cache_clear()
+    for hgvs in descriptions:
+        get_position(hgvs)
+    return len(descriptions)
+
+
+def bench_group_per_exon(scale: float, tmpdir: str, backend: str = "python") -> int:
+    exons = synthetic_exons(int(5000 * scale) or 1)
+    coverage_file = os.path.join(tmpdir, "coverage.tsv")
+    with open(coverage_file, "wt") as fout:
+        fout.writelines(synthetic_coverage_lines(exons))
+    id_mapping = io.StringIO(synthetic_id_mapping(exons))
+
+    with open(coverage_file) as fin:
+        count = sum(1 for _ in fin)
+        fin.seek(0)
+        aggr_exon_cov.group_per_exon(fin, id_mapping, backend=backend)
+    return count
+
+
+def bench_group_per_exon_numpy(scale: float, tmpdir: str) -> int:
+    return bench_group_per_exon(scale, tmpdir, backend="numpy")
+
+
+def bench_stream_per_exon(scale: float, tmpdir: str) -> int:
+    exons = synthetic_exons(int(5000 * scale) or 1)
+    coverage_file = os.path.join(tmpdir, "coverage.tsv")
+    with open(coverage_file, "wt") as fout:
+        fout.writelines(synthetic_coverage_lines(exons))
+    id_mapping = io.StringIO(synthetic_id_mapping(exons))
+
+    with open(coverage_file) as fin:
+        count = sum(1 for _ in fin)
+        fin.seek(0)
+        for _ in aggr_exon_cov.stream_per_exon(fin, id_mapping):
+            pass
+    return count
+
+
+BENCHMARKS: dict[str, Callable[[float, str], int]] = {
+    "filter_annotate_vep": bench_filter_annotate_vep,
+    "criterion_match": bench_criterion_match,
+    "get_position": bench_get_position,
+    "group_per_exon": bench_group_per_exon,
+    "stream_per_exon": bench_stream_per_exon,
+}
+if aggr_exon_cov.HAS_NUMPY:
+    BENCHMARKS["group_per_exon_numpy"] = bench_group_per_exon_numpy
+
+
+def _run(name: str, scale: float, queue: "multiprocessing.Queue[Result]") -> None:
+    """Run a single benchmark, and put the result on the queue"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Silence the progress messages from the scripts under test
+        with open(os.devnull, "w") as devnull:
+            stderr, sys.stderr = sys.stderr, devnull
+            try:
+                start = time.perf_counter()
+                records = BENCHMARKS[name](scale, tmpdir)
+                seconds = time.perf_counter() - start
+            finally:
+                sys.stderr = stderr
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put(Result(name, records, seconds, peak))
+
+
+def run_benchmark(name: str, scale: float) -> Result:
+    """Run a benchmark in a separate process, to measure its peak memory"""
+    queue: "multiprocessing.Queue[Result]" = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(name, scale, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def compare(results: list[Result], baseline_file: str, tolerance: float) -> bool:
+    """Compare the results to a baseline, returns False on a regression"""
+    with open(baseline_file) as fin:
+        baseline = {b["name"]: Result(**b) for b in json.load(fin)}
+
+    ok = True
+    for result in results:
+        if result.name not in baseline:
+            continue
+        base = baseline[result.name]
+        change = result.records_per_second / base.records_per_second - 1
+        status = "OK"
+        if change < -tolerance:
+            status = "REGRESSION"
+            ok = False
+        print(f"{result.name:<20}{change:>+10.1%} {status}")
+    return ok
+
+
+def main(
+    names: list[str],
+    scale: float,
+    save: str | None,
+    baseline: str | None,
+    tolerance: float,
+) -> int:
+    header = f"{'benchmark':<20}{'records':>12}{'seconds':>10}{'records/s':>14}{'peak MB':>12}"
+    print(header)
+
+    results = list()
+    for name in names:
+        result = run_benchmark(name, scale)
+        print(result)
+        results.append(result)
+
+    if save:
+        with open(save, "wt") as fout:
+            json.dump([asdict(r) for r in results], fout, indent=2)
+
+    if baseline and not compare(results, baseline, tolerance):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help=f"Benchmarks to run, choose from {', '.join(BENCHMARKS)} (default: all)",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Scale the size of the synthetic data sets",
+    )
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare to the results in this JSON file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction of throughput that may be lost before it is a regression",
+    )
+
+    args = parser.parse_args()
+
+    names = args.benchmarks or list(BENCHMARKS)
+    if unknown := [name for name in names if name not in BENCHMARKS]:
+        parser.error(f"Unknown benchmark(s): {', '.join(unknown)}")
+
+    sys.exit(main(names, args.scale, args.save, args.compare, args.tolerance))
@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
 from dataclasses import dataclass
-from io import TextIOWrapper
 import sys
-from typing import Iterator
+
+from gtf import GTFIndex
 
 
 @dataclass
@@ -16,44 +16,25 @@ class Mapping:
         return f"{self.gene_id}\t{self.gene_name}\t{','.join(self.transcript_ids)}"
 
 
-Attributes = dict[str, str]
-
-
-def read_attributes(fin: TextIOWrapper) -> Iterator[Attributes]:
-    for line in fin:
-        if line.startswith("#"):
-            continue
-        spline = line.strip().split(maxsplit=8)
-        kvals = spline[-1]
-
-        d = dict()
-        for pair in kvals.split(";"):
-            if not pair:
-                continue
-            pair = pair.strip(" ")
-            k, v = pair.split(" ", maxsplit=1)
-            d[k] = v.replace('"', "")
-        yield d
-
-
 def create_mapping(gtf_file: str, transcripts: set[str]) -> dict[str, Mapping]:
-    """Create the mapping for each transcript in transcripts"""
-    results: dict[str, Mapping] = dict()
-    with open(gtf_file) as fin:
-        for record in read_attributes(fin):
-            if (transcript_id := record.get("transcript_id")) is None:
-                continue
-
-            # Transscript can have a version number, or not
-            if transcript_id not in transcripts:
-                continue
-            gene_id = record["gene_id"]
-            gene_name = record["gene_name"]
+    """Create the mapping for each transcript in transcripts
 
-            if gene_id in results:
-                results[gene_id].transcript_ids.add(transcript_id)
-            else:
-                results[gene_id] = Mapping(gene_id, gene_name, {transcript_id})
+    The transcripts are read from the "transcript" lines of the GTF file
+    """
+    results: dict[str, Mapping] = dict()
+    for record in GTFIndex.open(gtf_file).features("transcript"):
+        transcript_id = record.transcript_id
+        # Transscript can have a version number, or not
+        if transcript_id is None or transcript_id not in transcripts:
+            continue
+        gene_id = record.gene_id
+        gene_name = record.gene_name
+        assert gene_name is not None
+
+        if gene_id in results:
+            results[gene_id].transcript_ids.add(transcript_id)
+        else:
+            results[gene_id] = Mapping(gene_id, gene_name, {transcript_id})
     return results
 
 
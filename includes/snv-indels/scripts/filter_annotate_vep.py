@@ -5,21 +5,148 @@
 import argparse
 import json
 import gzip
+import os
 import re
+import sys
 
-from collections.abc import Iterator
+from collections.abc import Callable, Iterable, Iterator
+from itertools import islice
+from multiprocessing import Pool
 from typing import Any
 
+from json_codec import Codec, LazyVEP, available_codecs, get_codec, get_encoder
 
-from utils import VEP, read_criteria_file, read_known_variants
+from utils import (
+    VEP,
+    CriteriaIndex,
+    hgvs_cache_stats,
+    parse_hgvs,
+    read_criteria_file,
+    read_known_variants,
+)
 
+# The number of VEP lines to send to a worker process at once
+BATCH_SIZE = 200
 
-def parse_vep_json(vep_file: str, prog: Any) -> Iterator[VEP]:
-    """Parse the VEP 'json' output file, each line contains a JSON entry"""
-    with gzip.open(vep_file, "rt") as fin:
+
+class TranscriptScanner:
+    """Recognize VEP lines which contain a transcript of interest
+
+    This works on the raw bytes of each line, without decoding or parsing the
+    JSON. Only the "transcript_id" fields are considered, and the transcript
+    must match exactly after the version number (if any) has been removed.
+    """
+
+    pattern = re.compile(rb'"transcript_id":\s*"([^"]*)"')
+
+    def __init__(self, transcripts: Iterable[str]) -> None:
+        self.transcripts = {t.encode() for t in transcripts}
+        self.parsed = 0
+        self.skipped = 0
+
+    def match(self, line: bytes) -> bool:
+        """Determine if line contains a transcript of interest"""
+        for transcript in self.pattern.finditer(line):
+            if transcript.group(1).split(b".")[0] in self.transcripts:
+                self.parsed += 1
+                return True
+        self.skipped += 1
+        return False
+
+    def stats(self) -> str:
+        total = self.parsed + self.skipped
+        return (
+            f"Parsed {self.parsed} of {total} VEP records, "
+            f"skipped {self.skipped} without a transcript of interest"
+        )
+
+
+def parse_vep_json(
+    vep_file: str, scanner: TranscriptScanner, codec: Codec | None = None
+) -> Iterator[VEP]:
+    """Parse the VEP 'json' output file, each line contains a JSON entry
+
+    If a codec is specified, only the fields needed for filtering are decoded
+    """
+    for line in read_vep_lines(vep_file, scanner):
+        if codec is None:
+            yield VEP(json.loads(line))
+        else:
+            yield LazyVEP(line, codec)
+
+
+def read_vep_lines(vep_file: str, scanner: TranscriptScanner) -> Iterator[bytes]:
+    """Yield the lines from the VEP 'json' output file which match scanner"""
+    with gzip.open(vep_file, "rb") as fin:
         for line in fin:
-            if prog.search(line):
-                yield VEP(json.loads(line))
+            if scanner.match(line):
+                yield line
+
+
+def batched(lines: Iterator[bytes], size: int) -> Iterator[list[bytes]]:
+    """Split lines into lists of at most size lines"""
+    while batch := list(islice(lines, size)):
+        yield batch
+
+
+def filter_annotate(
+    vep: VEP,
+    encode: Callable[[VEP], bytes],
+    inclusion_index: CriteriaIndex,
+    known_variants: dict[str, str],
+    annotation_index: CriteriaIndex,
+    population: str,
+    frequency: float,
+) -> bytes | None:
+    """Filter and annotate a single VEP record
+
+    Returns the encoded VEP record, or None if the record is filtered out
+    """
+    # Skip variants that are above the specified population frequency
+    if vep.above_population_threshold(population, frequency):
+        return None
+
+    # Filter and annotate transcripts based on known variants and the annotations
+    # The known variants have the higher priority
+    vep.filter_annotate_transcripts(inclusion_index, known_variants, annotation_index)
+
+    # If there is no consequence of interest left
+    if not vep["transcript_consequences"]:
+        return None
+
+    if isinstance(vep, LazyVEP):
+        vep = vep.materialize()
+
+    return encode(vep)
+
+
+# The codec and the arguments for filter_annotate in the worker processes
+_worker_codec = Codec()
+_worker_args: tuple[Any, ...] = tuple()
+
+
+def _init_worker(codec_name: str, sort_keys: bool, *args: Any) -> None:
+    global _worker_codec, _worker_args
+    _worker_codec = get_codec(codec_name)
+    _worker_args = (get_encoder(_worker_codec, sort_keys), *args)
+    # Forked workers inherit the cache (and counters) of the main process
+    parse_hgvs.cache_clear()
+
+
+def _filter_annotate_batch(
+    lines: list[bytes],
+) -> tuple[int, list[bytes], tuple[int, ...]]:
+    """Filter and annotate a batch of VEP lines in a worker process
+
+    Returns the process id, the output lines and the HGVS cache info
+    """
+    out = list()
+    for line in lines:
+        result = filter_annotate(LazyVEP(line, _worker_codec), *_worker_args)
+        if result is not None:
+            out.append(result)
+    info = parse_hgvs.cache_info()
+    return os.getpid(), out, (info.hits, info.misses, info.maxsize or 0, info.currsize)
 
 
 def main(
@@ -29,6 +156,9 @@ def main(
     known_variants_file: str,
     population: str,
     frequency: float,
+    workers: int = 1,
+    codec_name: str = "auto",
+    sort_keys: bool = True,
 ) -> None:
     # Get genes and transcripts of interest
     annotations = read_criteria_file(annotation_file)
@@ -48,25 +178,49 @@ def main(
         id = v.split(":c")[0].split(".")[0]
         ids.add(id)
 
-    # Make a regex to recognize lines which contain variatns of interest,
-    # without parsing the json which is slow
-    regex = r"|".join(ids)
-    prog = re.compile(regex)
+    # Recognize lines which contain variants of interest, without parsing
+    # the json which is slow
+    scanner = TranscriptScanner(ids)
 
-    for vep in parse_vep_json(vep_file, prog):
-        # Skip variants that are above the specified population frequency
-        if vep.above_population_threshold(population, frequency):
-            continue
+    # Index the criteria once, so we only test the relevant criteria for
+    # every transcript
+    inclusion_index = CriteriaIndex(inclusion_criteria)
+    annotation_index = CriteriaIndex(annotations)
 
-        # Filter and annotate transcripts based on known variants and the annotations
-        # The known variants have the higher priority
-        vep.filter_annotate_transcripts(inclusion_criteria, known_variants, annotations)
+    codec = get_codec(codec_name)
+    encode = get_encoder(codec, sort_keys)
+    out = sys.stdout.buffer
 
-        # If there is no consequence of interest left
-        if not vep["transcript_consequences"]:
-            continue
+    args = (
+        inclusion_index,
+        known_variants,
+        annotation_index,
+        population,
+        frequency,
+    )
+
+    if workers > 1:
+        # The HGVS cache info from every worker process
+        cache_info = dict()
+        initargs = (codec.name, sort_keys, *args)
+        with Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+            batches = batched(read_vep_lines(vep_file, scanner), BATCH_SIZE)
+            # imap returns the results in the order of the input
+            for pid, lines, info in pool.imap(_filter_annotate_batch, batches):
+                out.writelines(lines)
+                cache_info[pid] = info
+        infos = [parse_hgvs.cache_info(), *cache_info.values()]
+        print(scanner.stats(), file=sys.stderr)
+        print(hgvs_cache_stats(infos), file=sys.stderr)
+        return
+
+    for vep in parse_vep_json(vep_file, scanner, codec):
+        result = filter_annotate(vep, encode, *args)
+        if result is not None:
+            out.write(result)
 
-        print(json.dumps(vep, sort_keys=True))
+    print(scanner.stats(), file=sys.stderr)
+    print(hgvs_cache_stats(), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -87,6 +241,24 @@ if __name__ == "__main__":
         default=0.05,
         type=float,
     )
+    parser.add_argument(
+        "--workers",
+        help="Number of processes to use for filtering and annotation",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--json-codec",
+        help="JSON library to use for reading and writing VEP records",
+        default="auto",
+        choices=["auto", *available_codecs()],
+    )
+    parser.add_argument(
+        "--no-sort-keys",
+        help="Write the VEP records without sorting the keys, which is faster",
+        action="store_false",
+        dest="sort_keys",
+    )
 
     args = parser.parse_args()
 
@@ -97,4 +269,7 @@ if __name__ == "__main__":
         args.known_variants,
         args.population,
         args.frequency,
+        args.workers,
+        args.json_codec,
+        args.sort_keys,
     )
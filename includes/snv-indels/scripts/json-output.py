@@ -2,12 +2,26 @@
 
 import argparse
 import gzip
+import io
 from io import TextIOWrapper
 import json
 import csv
+import sys
+import tempfile
+import uuid
+from array import array
 from pathlib import Path
 from collections import defaultdict
-from typing import Any, DefaultDict, Sequence, cast
+from typing import (
+    Any,
+    Container,
+    DefaultDict,
+    Iterator,
+    Optional,
+    Sequence,
+    TextIO,
+    cast,
+)
 
 from crimson import picard, vep
 
@@ -190,14 +204,6 @@ def idf_to_gene_symbol(id_mapping: Sequence[IDM]) -> dict[str, str]:
 VEP = dict[str, Any]
 
 
-def update_variant_overview(
-    mapping: dict[str, str], vep: VEP, overview: DefaultDict[str, list[VEP]]
-) -> None:
-    """Add the vep entry to overview"""
-    symbol = get_gene_symbol(vep, mapping)
-    overview[symbol].append(vep)
-
-
 def get_gene_symbol(vep: VEP, mapping: dict[str, str]) -> str:
     """Determine the gene symbol from a VEP object"""
     consequences = vep.get("transcript_consequences")
@@ -211,34 +217,130 @@ def get_gene_id(consequence: dict[str, str]) -> str:
     return consequence["gene_id"]
 
 
-def group_variants(
-    id_mapping: Sequence[IDM], vep_txt: str
-) -> DefaultDict[str, list[VEP]]:
-    """Group variants by gene symbol"""
-    mapping = idf_to_gene_symbol(id_mapping)
-    overview: DefaultDict[str, list[VEP]] = defaultdict(list)
+def read_variants(
+    vep_txt: str,
+    info_keys: Optional[Container[str]] = None,
+    format_keys: Optional[Container[str]] = None,
+) -> Iterator[VEP]:
+    """Read the VEP records, with the parsed FORMAT and INFO fields"""
     with gzip.open(vep_txt, "rt") as fin:
         for line in fin:
             js = json.loads(line)
-            js["FORMAT"] = get_format(js["input"])
-            js["INFO"] = get_info(js["input"])
-            update_variant_overview(mapping, js, overview)
+            js["INFO"], js["FORMAT"] = parse_vcf_line(
+                js["input"], info_keys, format_keys
+            )
+            yield js
+
+
+class VariantSpool:
+    """Store the variants per gene symbol in a temporary file
+
+    Every variant is encoded as soon as it is added, so only the position
+    of the encoded variants is kept in memory. The variants are encoded
+    exactly as json.dumps(..., sort_keys=True, indent=2) would write them
+    at the specified nesting depth.
+    """
+
+    def __init__(self, depth: int) -> None:
+        self.depth = depth
+        self.file = tempfile.TemporaryFile()
+        # The offset and size of the variants of each gene
+        self.index: DefaultDict[str, array[int]] = defaultdict(lambda: array("Q"))
+
+    def __enter__(self) -> "VariantSpool":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.file.close()
+
+    def add(self, symbol: str, vep: VEP) -> None:
+        encoded = json.dumps(vep, sort_keys=True, indent=2)
+        data = encoded.replace("\n", "\n" + " " * 2 * self.depth).encode()
+        self.index[symbol].extend((self.file.tell(), len(data)))
+        self.file.write(data)
+
+    def variants(self, symbol: str) -> Iterator[str]:
+        """Yield the encoded variants of the gene, in the order they were added"""
+        index = self.index[symbol]
+        for offset, size in zip(index[::2], index[1::2]):
+            self.file.seek(offset)
+            yield self.file.read(size).decode()
+        self.file.seek(0, io.SEEK_END)
+
+    def write(self, fout: TextIO) -> None:
+        """Write the variants per gene as a JSON object, like json.dumps does"""
+        if not self.index:
+            fout.write("{}")
+            return
+
+        gene_indent = " " * 2 * (self.depth - 1)
+        close_indent = " " * 2 * (self.depth - 2)
+        variant_indent = " " * 2 * self.depth
+
+        fout.write("{")
+        for i, symbol in enumerate(sorted(self.index)):
+            fout.write("," if i else "")
+            fout.write(f"\n{gene_indent}{json.dumps(symbol)}: [")
+            for j, variant in enumerate(self.variants(symbol)):
+                fout.write("," if j else "")
+                fout.write(f"\n{variant_indent}{variant}")
+            fout.write(f"\n{gene_indent}]")
+        fout.write(f"\n{close_indent}}}")
+
+
+def spool_variants(
+    id_mapping: Sequence[IDM],
+    vep_txt: str,
+    spool: VariantSpool,
+    info_keys: Optional[Container[str]] = None,
+    format_keys: Optional[Container[str]] = None,
+) -> None:
+    """Group variants by gene symbol in the spool"""
+    mapping = idf_to_gene_symbol(id_mapping)
+    for js in read_variants(vep_txt, info_keys, format_keys):
+        spool.add(get_gene_symbol(js, mapping), js)
 
-    return overview
 
+Info = dict[str, str | bool]
 
-def get_info(vcf: str) -> dict[str, str]:
-    """Create an INFO dict from a vcf line"""
+
+def parse_vcf_line(
+    vcf: str,
+    info_keys: Optional[Container[str]] = None,
+    format_keys: Optional[Container[str]] = None,
+) -> tuple[Info, dict[str, str]]:
+    """Create the INFO and FORMAT dicts from a vcf line
+
+    The line is only split once. INFO flags are set to True, and missing
+    fields result in an empty dict. If info_keys or format_keys are
+    specified, only those keys are kept.
+    """
     split = vcf.strip().split("\t")
-    return dict((pair.split("=") for pair in split[7].split(";")))
+
+    info: Info = dict()
+    if len(split) > 7 and split[7] != ".":
+        for field in split[7].split(";"):
+            key, sep, value = field.partition("=")
+            if info_keys is None or key in info_keys:
+                info[key] = value if sep else True
+
+    vcf_format = dict()
+    if len(split) > 9:
+        for key, value in zip(split[8].split(":"), split[9].split(":")):
+            if format_keys is None or key in format_keys:
+                vcf_format[key] = value
+
+    return info, vcf_format
+
+
+def get_info(vcf: str) -> Info:
+    """Create an INFO dict from a vcf line"""
+    return parse_vcf_line(vcf)[0]
 
 
 def get_format(vcf: str) -> dict[str, str]:
     """Create a FORMAT dict from a vcf line"""
-    split = vcf.strip().split("\t")
-    format_fields = split[8].split(":")
-    format_values = split[9].split(":")
-    return {k: v for k, v in zip(format_fields, format_values)}
+    return parse_vcf_line(vcf)[1]
 
 
 def main(
@@ -250,6 +352,8 @@ def main(
     exon_cov_stats_path: str,
     vep_stats_path: str,
     sample_name: str,
+    info_keys: Optional[Sequence[str]] = None,
+    format_keys: Optional[Sequence[str]] = None,
 ) -> None:
     """Helper script for combining multiple stats files into one JSON."""
     with open(id_mappings_path) as fin:
@@ -276,13 +380,37 @@ def main(
         },
     }
 
-    combined["snv_indels"]["genes"] = (
-        group_variants(idm, vep_txt) if vep_txt else dict()
-    )
-
     if aln_stats_path:
         combined["snv_indels"]["stats"] = post_process(combined["snv_indels"]["stats"])
-    print(json.dumps(combined, sort_keys=True, indent=2))
+
+    # Genes are nested in snv_indels, variants are in a list per gene
+    with VariantSpool(depth=4) as spool:
+        if vep_txt:
+            spool_variants(
+                idm,
+                vep_txt,
+                spool,
+                None if info_keys is None else set(info_keys),
+                None if format_keys is None else set(format_keys),
+            )
+        write_output(combined, spool, sys.stdout)
+
+
+def write_output(combined: dict[str, Any], spool: VariantSpool, fout: TextIO) -> None:
+    """Write the combined output, with the genes from the spool
+
+    The output is identical to json.dumps(combined, sort_keys=True, indent=2),
+    but the variants are written directly from the spool, so they never have
+    to be in memory all at once.
+    """
+    placeholder = f"<genes-{uuid.uuid4()}>"
+    combined["snv_indels"]["genes"] = placeholder
+    head, tail = json.dumps(combined, sort_keys=True, indent=2).split(
+        json.dumps(placeholder)
+    )
+    fout.write(head)
+    spool.write(fout)
+    fout.write(tail + "\n")
 
 
 if __name__ == "__main__":
@@ -295,6 +423,12 @@ if __name__ == "__main__":
     parser.add_argument("--exon_cov_stats_path")
     parser.add_argument("--vep_stats_path")
     parser.add_argument("--sample")
+    parser.add_argument(
+        "--info-keys", nargs="*", help="Only include these keys from the VCF INFO"
+    )
+    parser.add_argument(
+        "--format-keys", nargs="*", help="Only include these keys from the VCF FORMAT"
+    )
 
     args = parser.parse_args()
     main(
@@ -306,4 +440,6 @@ if __name__ == "__main__":
         args.exon_cov_stats_path,
         args.vep_stats_path,
         args.sample,
+        args.info_keys,
+        args.format_keys,
     )
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""JSON codecs for reading and writing VEP records
+
+The json module from the standard library is always available. If orjson or
+msgspec are installed, they are used to speed up decoding and encoding.
+msgspec can also decode only the fields of a VEP record that are needed for
+filtering and annotation, the rest of the record is only decoded when the
+record is written.
+"""
+
+import functools
+import json
+from typing import Any, Callable
+
+try:
+    import orjson
+
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+try:
+    import msgspec
+
+    HAS_MSGSPEC = True
+except ImportError:
+    HAS_MSGSPEC = False
+
+from utils import VEP
+
+# The top level fields of a VEP record that are used for filtering and
+# annotation
+VEP_FIELDS = (
+    "input",
+    "colocated_variants",
+    "transcript_consequences",
+    "most_severe_consequence",
+)
+
+
+class Codec:
+    """Codec using the json module from the standard library"""
+
+    name = "json"
+
+    def loads(self, data: str | bytes) -> Any:
+        return json.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        """Encode obj, without sorting the keys"""
+        return json.dumps(obj).encode()
+
+    def loads_fields(self, data: str | bytes) -> tuple[dict[str, Any], bool]:
+        """Decode the VEP_FIELDS from a VEP record
+
+        Returns the decoded fields, and whether the whole record was decoded
+        """
+        return self.loads(data), True
+
+
+class OrjsonCodec(Codec):
+    """Codec using orjson"""
+
+    name = "orjson"
+
+    def loads(self, data: str | bytes) -> Any:
+        return orjson.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        data: bytes = orjson.dumps(obj)
+        return data
+
+
+class MsgspecCodec(Codec):
+    """Codec using msgspec, which can skip the fields that are not needed"""
+
+    name = "msgspec"
+
+    def loads(self, data: str | bytes) -> Any:
+        return msgspec.json.decode(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        data: bytes = msgspec.json.encode(obj)
+        return data
+
+    def loads_fields(self, data: str | bytes) -> tuple[dict[str, Any], bool]:
+        fields = _fields_decoder().decode(data)
+        decoded = {
+            field: getattr(fields, field)
+            for field in VEP_FIELDS
+            if getattr(fields, field) is not msgspec.UNSET
+        }
+        return decoded, False
+
+
+@functools.cache
+def _fields_decoder() -> Any:
+    """Create a msgspec decoder for the VEP_FIELDS"""
+
+    class VEPFields(msgspec.Struct):
+        input: str | msgspec.UnsetType = msgspec.UNSET
+        colocated_variants: list[dict[str, Any]] | msgspec.UnsetType = msgspec.UNSET
+        transcript_consequences: list[dict[str, Any]] | msgspec.UnsetType = (
+            msgspec.UNSET
+        )
+        most_severe_consequence: str | msgspec.UnsetType = msgspec.UNSET
+
+    return msgspec.json.Decoder(VEPFields)
+
+
+CODECS: dict[str, type[Codec]] = {
+    "json": Codec,
+    "orjson": OrjsonCodec,
+    "msgspec": MsgspecCodec,
+}
+
+
+def available_codecs() -> list[str]:
+    """Return the names of the codecs that can be used"""
+    available = ["json"]
+    if HAS_ORJSON:
+        available.append("orjson")
+    if HAS_MSGSPEC:
+        available.append("msgspec")
+    return available
+
+
+def get_codec(name: str = "auto") -> Codec:
+    """Return the codec called name
+
+    If name is 'auto', the fastest available codec is returned
+    """
+    available = available_codecs()
+    if name == "auto":
+        name = available[-1]
+    if name not in available:
+        msg = f"JSON codec '{name}' is not available, choose from {available}"
+        raise ValueError(msg)
+    return CODECS[name]()
+
+
+class LazyVEP(VEP):
+    """VEP record which only contains the fields needed for filtering
+
+    Use materialize to get the full VEP record, including any changes made to
+    the filtering fields.
+    """
+
+    def __init__(self, data: str | bytes, codec: Codec):
+        fields, complete = codec.loads_fields(data)
+        super().__init__(fields)
+        self.codec = codec
+        # The raw record, if the fields are incomplete
+        self.raw = None if complete else data
+
+    def materialize(self) -> VEP:
+        """Return the full VEP record"""
+        if self.raw is None:
+            return VEP(self)
+
+        full = VEP(self.codec.loads(self.raw))
+        full.update(self)
+        return full
+
+
+def get_encoder(codec: Codec, sort_keys: bool = True) -> Callable[[VEP], bytes]:
+    """Return a function to encode a VEP record as a line of JSON
+
+    Sorted output is always written with the standard library, so the output
+    does not depend on the codec that is installed
+    """
+    if sort_keys:
+        return lambda vep: json.dumps(vep, sort_keys=True).encode() + b"\n"
+    else:
+        return lambda vep: codec.dumps(vep) + b"\n"
@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 
+import gzip
 import importlib
+import io
+import json
+from pathlib import Path
 from typing import Any, Dict, List, Sequence, Union
 import pytest
-from collections import defaultdict
 
 json_output = importlib.import_module("json-output")
-update_variant_overview = json_output.update_variant_overview
 get_gene_id = json_output.get_gene_id
 get_gene_symbol = json_output.get_gene_symbol
 idf_to_gene_symbol = json_output.idf_to_gene_symbol
 get_format = json_output.get_format
 get_info = json_output.get_info
+parse_vcf_line = json_output.parse_vcf_line
+VariantSpool = json_output.VariantSpool
+spool_variants = json_output.spool_variants
+write_output = json_output.write_output
 
 Mapping = Dict[str, Union[str, List[str]]]
 VEP = Dict[str, Any]
@@ -66,12 +72,6 @@ def test_get_gene_symbol(vep_single: VEP, mapping: Mapping) -> None:
     assert get_gene_symbol(vep_single, mapping) == "GENE1"
 
 
-def test_update_variant_overview(vep_single: VEP, mapping: Mapping) -> None:
-    overview: defaultdict[str, list[VEP]] = defaultdict(list)
-    update_variant_overview(mapping, vep_single, overview)
-    assert "GENE1" in overview
-
-
 def test_get_format(vcf_line: str) -> None:
     FORMAT = get_format(vcf_line)
     assert FORMAT["GT"] == "1/1"
@@ -82,3 +82,89 @@ def test_get_info(vcf_line: str) -> None:
     INFO = get_info(vcf_line)
     assert INFO["ADP"] == "17"
     assert INFO["HOM"] == "1"
+
+
+@pytest.mark.parametrize(
+    "genes",
+    [
+        {},
+        {
+            "GENE2": [{"b": [1, 2], "a": {"c": "x\ny"}}],
+            "GENE1": [{"a": 1}, {"a": 2, "z": None}],
+        },
+    ],
+)
+def test_variant_spool(genes: dict[str, list[VEP]]) -> None:
+    """
+    GIVEN variants per gene
+    WHEN we write them via the VariantSpool
+    THEN the output should be identical to json.dumps
+    """
+    with VariantSpool(depth=4) as spool:
+        for symbol, variants in genes.items():
+            for vep in variants:
+                spool.add(symbol, vep)
+        combined: dict[str, Any] = {"snv_indels": {"stats": {"aln": {}}}}
+        fout = io.StringIO()
+        write_output(combined, spool, fout)
+
+    combined["snv_indels"]["genes"] = genes
+    expected = json.dumps(combined, sort_keys=True, indent=2) + "\n"
+    assert fout.getvalue() == expected
+
+
+def test_parse_vcf_line(vcf_line: str) -> None:
+    info, vcf_format = parse_vcf_line(vcf_line)
+    assert info == get_info(vcf_line)
+    assert vcf_format == get_format(vcf_line)
+
+
+def test_parse_vcf_line_flags() -> None:
+    vcf = "chr1\t100\t.\tC\tT\t.\tPASS\tDP=10;SOMATIC;AF=0.5\tGT:AF\t0/1:0.5"
+    info, _ = parse_vcf_line(vcf)
+    assert info == {"DP": "10", "SOMATIC": True, "AF": "0.5"}
+
+
+def test_parse_vcf_line_missing() -> None:
+    info, vcf_format = parse_vcf_line("chr1\t100\t.\tC\tT\t.\tPASS\t.")
+    assert info == {}
+    assert vcf_format == {}
+
+
+def test_parse_vcf_line_keys(vcf_line: str) -> None:
+    info, vcf_format = parse_vcf_line(
+        vcf_line, info_keys={"ADP"}, format_keys={"AD", "DP", "FREQ"}
+    )
+    assert info == {"ADP": "17"}
+    assert vcf_format == {"AD": "15", "DP": "17", "FREQ": "100%"}
+
+
+def test_spool_variants(
+    tmp_path: Path, id_mapping: Sequence[Mapping], vcf_line: str
+) -> None:
+    """
+    GIVEN VEP records for different genes
+    WHEN we spool the variants
+    THEN the variants should be grouped by gene symbol, in the input order
+    """
+    records = [
+        {"input": vcf_line, "transcript_consequences": [{"gene_id": gene}]}
+        for gene in ("gene2", "gene1", "gene2")
+    ]
+    vep_txt = tmp_path / "vep.txt.gz"
+    with gzip.open(vep_txt, "wt") as fout:
+        for record in records:
+            print(json.dumps(record), file=fout)
+
+    with VariantSpool(depth=1) as spool:
+        spool_variants(id_mapping, str(vep_txt), spool, info_keys={"ADP"})
+        genes = {
+            symbol: [json.loads(variant) for variant in spool.variants(symbol)]
+            for symbol in sorted(spool.index)
+        }
+
+    assert list(genes) == ["GENE1", "GENE2"]
+    assert len(genes["GENE1"]) == 1
+    assert len(genes["GENE2"]) == 2
+    assert genes["GENE1"][0]["INFO"] == {"ADP": "17"}
+    assert genes["GENE2"][0]["FORMAT"]["GT"] == "1/1"
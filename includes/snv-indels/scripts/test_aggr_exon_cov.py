@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import random
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from aggr_exon_cov import (
+    HAS_NUMPY,
+    DepthHistogram,
+    Row,
+    aggr_covs_entry,
+    covs_metrics,
+    covs_metrics_numpy,
+    group_bam_per_exon,
+    group_per_exon,
+    merge_regions,
+    stream_per_exon,
+    write_json_stream,
+)
+
+ID_MAPPING = "gene_id\tgene_name\ttranscript_ids\nENSG1\tGENE1\tENST1,ENST2\n"
+
+
+def coverage_lines(depths: dict[tuple[str, int], list[int]]) -> str:
+    """Create bedtools coverage output for the specified exons"""
+    lines = list()
+    start = 100
+    for (transcript, exon_num), covs in depths.items():
+        end = start + len(covs)
+        for pos, cov in enumerate(covs, start=1):
+            lines.append(
+                f"chr1\t{start}\t{end}\t{transcript}\t{exon_num}\t{pos}\t{cov}"
+            )
+        start = end + 100
+    return "\n".join(lines) + "\n"
+
+
+def test_row_from_raw_line() -> None:
+    row = Row.from_raw_line("chr1\t100\t110\tENST1\t2\t3\t42\n")
+    assert row.key == ("ENST1", 2)
+    assert row.genome_pos == ("chr1", 102)
+    assert row.cov == 42
+
+
+def test_covs_metrics() -> None:
+    metrics = covs_metrics([10, 0, 20, 30], cov_limits=[10, 30])
+    assert metrics == {
+        "count": 4,
+        "min": 0,
+        "max": 30,
+        "avg": 15,
+        "median": 15.0,
+        "stdev": pytest.approx(12.9099444),
+        "frac_cov_at_least": {"10x": 0.75, "30x": 0.25},
+    }
+
+
+def test_aggr_covs_entry_empty() -> None:
+    entry = {"start": 100, "end": 110, "covs": []}
+    metrics = aggr_covs_entry(entry, cov_limits=[10])["metrics"]
+    assert metrics["count"] == 0
+    assert metrics["len"] == 10
+    assert metrics["frac_cov_at_least"] == {"10x": 0}
+
+
+def test_group_per_exon() -> None:
+    depths = {("ENST1", 1): [1, 2, 3], ("ENST1", 2): [5], ("ENST3", 1): [1]}
+    grouped = group_per_exon(
+        io.StringIO(coverage_lines(depths)), io.StringIO(ID_MAPPING), [2]
+    )
+    # ENST3 is not in the id mapping
+    assert list(grouped) == [("ENST1", 1), ("ENST1", 2)]
+    assert grouped[("ENST1", 1)]["gx"] == "GENE1"
+    assert grouped[("ENST1", 1)]["metrics"]["median"] == 2
+    assert grouped[("ENST1", 2)]["metrics"]["stdev"] is None
+
+
+@pytest.mark.skipif(not HAS_NUMPY, reason="numpy is not installed")
+def test_covs_metrics_numpy_identical() -> None:
+    """
+    GIVEN random coverage depths
+    WHEN we calculate the metrics with numpy
+    THEN the JSON output should be identical to the python backend
+    """
+    rng = random.Random(42)
+    for _ in range(2000):
+        max_depth = rng.choice([1, 10, 1000])
+        covs = [rng.randint(0, max_depth) for _ in range(rng.randint(1, 20))]
+        expected = covs_metrics(list(covs), [0, 8, 10, 50])
+        assert json.dumps(covs_metrics_numpy(covs, [0, 8, 10, 50])) == json.dumps(
+            expected
+        )
+
+
+@pytest.mark.skipif(not HAS_NUMPY, reason="numpy is not installed")
+def test_group_per_exon_numpy_identical() -> None:
+    rng = random.Random(42)
+    depths = {
+        ("ENST1", i): [rng.randint(0, 100) for _ in range(rng.randint(1, 300))]
+        for i in range(1, 20)
+    }
+
+    def grouped(backend: str) -> Any:
+        result = group_per_exon(
+            io.StringIO(coverage_lines(depths)),
+            io.StringIO(ID_MAPPING),
+            backend=backend,
+        )
+        return json.dumps(list(result.items()))
+
+    assert grouped("numpy") == grouped("python")
+
+
+def test_depth_histogram_metrics_identical() -> None:
+    """
+    GIVEN random coverage depths, some of which are above max_depth
+    WHEN we calculate the metrics from a DepthHistogram
+    THEN the JSON output should be identical to the python backend
+    """
+    rng = random.Random(42)
+    for _ in range(2000):
+        max_depth = rng.choice([1, 10, 1000])
+        covs = [rng.randint(0, max_depth) for _ in range(rng.randint(1, 20))]
+        histogram = DepthHistogram(max_depth=10)
+        for cov in covs:
+            histogram.append(cov)
+        expected = covs_metrics(list(covs), [0, 8, 10, 50])
+        assert json.dumps(histogram.metrics([0, 8, 10, 50])) == json.dumps(expected)
+
+
+def test_stream_per_exon_identical() -> None:
+    """
+    GIVEN sorted coverage lines of overlapping exons
+    WHEN we aggregate the exons in streaming mode
+    THEN the exons should be identical, and in the same order, as group_per_exon
+    """
+    rng = random.Random(42)
+    lines = list()
+    for offset, chrom in enumerate(("chr1", "chr2")):
+        starts = sorted(rng.sample(range(1000), 30))
+        for exon_num, start in enumerate(starts, start=offset * 100):
+            end = start + rng.randint(1, 200)
+            for pos in range(1, end - start + 1):
+                cov = rng.randint(0, 100)
+                lines.append(
+                    f"{chrom}\t{start}\t{end}\tENST1\t{exon_num}\t{pos}\t{cov}"
+                )
+    text = "\n".join(lines) + "\n"
+
+    expected = group_per_exon(io.StringIO(text), io.StringIO(ID_MAPPING))
+    streamed = stream_per_exon(io.StringIO(text), io.StringIO(ID_MAPPING), max_depth=50)
+    assert json.dumps(list(streamed)) == json.dumps(list(expected.items()))
+
+
+def test_stream_per_exon_unsorted() -> None:
+    depths = {("ENST1", 1): [1, 2, 3], ("ENST1", 2): [5]}
+    lines = coverage_lines(depths).splitlines(keepends=True)
+    with pytest.raises(ValueError, match="not sorted"):
+        list(
+            stream_per_exon(io.StringIO("".join(lines[::-1])), io.StringIO(ID_MAPPING))
+        )
+
+
+@pytest.mark.parametrize("items", [{}, {"ENST1|1": {"a": [1, 2]}, "ENST1|2": {}}])
+def test_write_json_stream(items: dict[str, Any]) -> None:
+    fout = io.StringIO()
+    write_json_stream(items.items(), fout)
+    assert fout.getvalue() == json.dumps(items, indent=2)
+
+
+def test_merge_regions() -> None:
+    regions = [(50, 60), (0, 10), (5, 20), (20, 30)]
+    assert merge_regions(regions) == [(0, 30), (50, 60)]
+
+
+@pytest.fixture
+def bam_file(tmp_path: Path) -> str:
+    """Create an indexed BAM file with reads on chr1"""
+    pysam = pytest.importorskip("pysam")
+    header = {"SQ": [{"SN": "chr1", "LN": 1000}, {"SN": "chr2", "LN": 1000}]}
+    # Position, cigar and flag of every read
+    reads = [
+        (95, "10M", 0),
+        (100, "5M", 1024),
+        (102, "3M2D3M", 16),
+        (104, "2M100N4M", 0),
+        (150, "10M", 256),
+        (103, "4M", 4),
+    ]
+    unsorted = str(tmp_path / "unsorted.bam")
+    with pysam.AlignmentFile(unsorted, "wb", header=header) as bam:
+        for idx, (pos, cigar, flag) in enumerate(reads):
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = f"read{idx}"
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = pos
+            read.cigarstring = cigar
+            read.query_sequence = "A" * read.infer_query_length()
+            bam.write(read)
+    path = str(tmp_path / "reads.bam")
+    pysam.sort("-o", path, unsorted)
+    pysam.index(path)
+    return path
+
+
+def test_group_bam_per_exon(bam_file: str) -> None:
+    """
+    GIVEN a BAM file and a BED file of overlapping exons
+    WHEN we calculate the metrics from the BAM file
+    THEN the result should be identical to the bedtools coverage -d output
+    """
+    bed = (
+        "chr1\t98\t108\tENST1\t1\t+\n"
+        "chr1\t100\t104\tENST2\t1\t+\n"
+        "chr1\t150\t160\tENST2\t2\t+\n"
+        "chr1\t200\t210\tENST3\t1\t+\n"
+        "chr2\t100\t110\tENST1\t2\t+\n"
+        "chr3\t100\t110\tENST1\t3\t+\n"
+    )
+    # The output of bedtools coverage -d for the reads in the BAM file
+    # The unmapped read is not counted, the spliced read covers its whole span
+    coverage = (
+        [
+            f"chr1\t98\t108\tENST1\t1\t{pos}\t{cov}"
+            for pos, cov in enumerate([1, 1, 2, 2, 3, 3, 4, 2, 2, 2], start=1)
+        ]
+        + [
+            f"chr1\t100\t104\tENST2\t1\t{pos}\t{cov}"
+            for pos, cov in enumerate([2, 2, 3, 3], start=1)
+        ]
+        + [f"chr1\t150\t160\tENST2\t2\t{pos}\t2" for pos in range(1, 11)]
+        + [f"chr2\t100\t110\tENST1\t2\t{pos}\t0" for pos in range(1, 11)]
+        # chr3 is not in the BAM header
+        + [f"chr3\t100\t110\tENST1\t3\t{pos}\t0" for pos in range(1, 11)]
+    )
+
+    expected = group_per_exon(
+        io.StringIO("\n".join(coverage) + "\n"), io.StringIO(ID_MAPPING)
+    )
+    for workers in (1, 2):
+        result = group_bam_per_exon(
+            bam_file, io.StringIO(bed), io.StringIO(ID_MAPPING), workers=workers
+        )
+        assert json.dumps(list(result.items())) == json.dumps(list(expected.items()))
@@ -4,9 +4,12 @@
 
 from typing import Sequence
 from typing import Any, Dict, List, Tuple
+from pathlib import Path
 import json
 import pytest
 
+import filter_annotate_vep
+
 from utils import (
     VEP,
     FrequenciesType,
@@ -777,3 +780,67 @@ def test_Variant_from_VEP(minimal_vep: VEP) -> None:
         ),
     ]
     assert list(Variant.from_VEP(minimal_vep)) == expected
+
+
+def test_filter_annotate_vep_workers(
+    tmp_path: Path, capsys: pytest.CaptureFixture[str], monkeypatch: Any
+) -> None:
+    """
+    GIVEN a VEP file and criteria
+    WHEN we filter and annotate the VEP file with multiple worker processes
+    THEN the output should be identical to using a single process
+    """
+    criteria = tmp_path / "criteria.tsv"
+    criteria.write_text(
+        "transcript_id\tconsequence\tstart\tend\tframe\tannotation\n"
+        "ENST00000361390.2\t\t200\t300\t\tND1\n"
+        "ENST00000361624.2\tsynonymous_variant\t\t\t\tCOX1\n"
+        "ENST00000361851.1\t\t\t\t\tATP8\n"
+    )
+    args = (
+        "test/data/output/v2/SRR8615409.vep.txt.gz",
+        str(criteria),
+        str(criteria),
+        "",
+        "gnomade",
+        0.01,
+    )
+    # Make sure the lines are spread over multiple batches
+    monkeypatch.setattr(filter_annotate_vep, "BATCH_SIZE", 2)
+
+    filter_annotate_vep.main(*args, workers=1)
+    serial = capsys.readouterr().out
+
+    filter_annotate_vep.main(*args, workers=3)
+    parallel = capsys.readouterr().out
+
+    assert serial
+    assert serial == parallel
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        (b'{"transcript_consequences":[{"transcript_id":"ENST1"}]}', True),
+        (b'{"transcript_consequences":[{"transcript_id": "ENST2"}]}', True),
+        (b'[{"transcript_id":"ENST3"},{"transcript_id":"ENST2"}]', True),
+        # RefSeq transcripts from VEP --merged include the version number
+        (b'[{"transcript_id":"NM_1.3"}]', True),
+        (b'[{"transcript_id":"NM_11.3"}]', False),
+        # Only exact matches on transcript_id are recognized
+        (b'[{"transcript_id":"ENST11"}]', False),
+        (b'[{"transcript_id":"ENST"}]', False),
+        (b'[{"hgvsc":"ENST1.1:c.10A>T"}]', False),
+        (b"{}", False),
+    ],
+)
+def test_transcript_scanner(line: bytes, expected: bool) -> None:
+    """
+    GIVEN a TranscriptScanner for transcripts of interest
+    WHEN we scan a raw VEP line
+    THEN we should only match lines with a transcript of interest
+    """
+    scanner = filter_annotate_vep.TranscriptScanner(["ENST1", "ENST2", "NM_1"])
+    assert scanner.match(line) is expected
+    assert scanner.parsed == int(expected)
+    assert scanner.skipped == int(not expected)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import pytest
+
+from json_codec import LazyVEP, available_codecs, get_codec, get_encoder
+
+
+@pytest.fixture
+def lines() -> list[bytes]:
+    with gzip.open("test/data/output/v2/SRR8615409.vep.txt.gz") as fin:
+        return fin.readlines()
+
+
+@pytest.mark.parametrize("name", available_codecs())
+def test_lazy_vep_materialize(name: str, lines: list[bytes]) -> None:
+    """
+    GIVEN a VEP record
+    WHEN we decode it lazily and materialize it
+    THEN we should get the same record as from the json module
+    """
+    codec = get_codec(name)
+    for line in lines:
+        assert LazyVEP(line, codec).materialize() == json.loads(line)
+
+
+@pytest.mark.parametrize("name", available_codecs())
+def test_lazy_vep_materialize_changes(name: str, lines: list[bytes]) -> None:
+    """
+    GIVEN a lazily decoded VEP record
+    WHEN we change the fields needed for filtering
+    THEN the changes should be part of the materialized record
+    """
+    vep = LazyVEP(lines[0], get_codec(name))
+    vep["transcript_consequences"] = list()
+    vep["most_severe_consequence"] = "intergenic_variant"
+
+    full = vep.materialize()
+    assert full["transcript_consequences"] == list()
+    assert full["most_severe_consequence"] == "intergenic_variant"
+    assert full["input"] == json.loads(lines[0])["input"]
+
+
+@pytest.mark.parametrize("name", available_codecs())
+@pytest.mark.parametrize("sort_keys", [True, False])
+def test_encoder(name: str, sort_keys: bool, lines: list[bytes]) -> None:
+    """
+    GIVEN a VEP record
+    WHEN we encode it
+    THEN we should get a single line of JSON, which is identical to the
+    output of the json module if the keys are sorted
+    """
+    encode = get_encoder(get_codec(name), sort_keys)
+    record = json.loads(lines[0])
+
+    encoded = encode(record)
+    assert encoded.endswith(b"\n")
+    assert encoded.count(b"\n") == 1
+    assert json.loads(encoded) == record
+    if sort_keys:
+        assert encoded.decode() == json.dumps(record, sort_keys=True) + "\n"
+
+
+def test_unknown_codec() -> None:
+    with pytest.raises(ValueError):
+        get_codec("no_such_codec")
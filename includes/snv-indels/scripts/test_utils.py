@@ -6,7 +6,9 @@ import pytest
 # Authors: Anne van der Grinten, Redmar van den Berg
 
 from utils import (
+    CriteriaIndex,
     Criterion,
+    IntervalTree,
     Variant,
     VEP,
     Location,
@@ -14,6 +16,7 @@ from utils import (
     region_contains,
     region_overlap,
     get_position,
+    parse_hgvs,
 )
 
 
@@ -596,3 +599,110 @@ class TestCriterion:
         THEN determine if region 2 falls within region1
         """
         assert region_contains(r1, r2) == expected
+
+
+class TestParseCache:
+    def test_variant_parsed_once(self) -> None:
+        """
+        GIVEN a Variant
+        WHEN we determine the size, frame and position
+        THEN the HGVS description should only be parsed once
+        """
+        parse_hgvs.cache_clear()
+        variant = Variant("ENST123.5:c.10_12del", consequences=[])
+
+        assert variant.size() == -3
+        assert variant.frame() == 0
+        assert variant.position == (Location(0, 10, 0), Location(0, 12, 0))
+        assert get_position(variant.hgvs) == variant.position
+
+        info = parse_hgvs.cache_info()
+        assert info.misses == 1
+        assert info.hits == 1
+
+
+class TestCriteriaIndex:
+    @pytest.fixture
+    def criteria(self) -> dict[Criterion, str]:
+        return {
+            Criterion("ENST1.1", start="10", end="20"): "first",
+            Criterion("ENST1.1", consequence="frameshift"): "second",
+            Criterion("ENST1.1", start="15", end="30"): "third",
+            Criterion("ENST1.1", start="100+5", end="*10"): "fourth",
+            Criterion("ENST2.1", start="10", end="20"): "fifth",
+        }
+
+    @pytest.mark.parametrize(
+        "intervals, region, expected",
+        [
+            ([], Region(1, 1), []),
+            ([(1, 5, 0)], Region(5, 6), [0]),
+            ([(1, 5, 0)], Region(6, 7), []),
+            ([(1, 5, 0), (3, 9, 1), (10, 12, 2)], Region(4, 4), [0, 1]),
+            ([(1, 5, 0), (3, 9, 1), (10, 12, 2)], Region(0, 20), [0, 1, 2]),
+            ([(1, 100, 0), (3, 4, 1), (5, 6, 2)], Region(50, 60), [0]),
+        ],
+    )
+    def test_interval_tree_overlap(
+        self, intervals: list[Any], region: Region, expected: list[int]
+    ) -> None:
+        """
+        GIVEN an IntervalTree
+        WHEN we query a region
+        THEN we should get every interval that overlaps the region
+        """
+        tree = IntervalTree(intervals)
+        assert sorted(tree.overlap(region)) == expected
+
+    @pytest.mark.parametrize(
+        "hgvs, consequences, expected",
+        [
+            # Only the first criterion overlaps
+            ("ENST1.1:c.12A>T", [], "first"),
+            # The first and third criteria overlap, the first one wins
+            ("ENST1.1:c.16A>T", [], "first"),
+            # Only the third criterion overlaps
+            ("ENST1.1:c.25A>T", [], "third"),
+            # The criterion without region matches before the third criterion
+            ("ENST1.1:c.25del", ["frameshift"], "second"),
+            # Intronic and UTR positions
+            ("ENST1.1:c.101-5A>T", [], "fourth"),
+            ("ENST1.1:c.100+4A>T", [], None),
+            # Different transcript
+            ("ENST2.1:c.15A>T", [], "fifth"),
+            ("ENST3.1:c.15A>T", [], None),
+            # Different coordinate system
+            ("ENST1.1:n.15A>T", [], None),
+        ],
+    )
+    def test_first_match(
+        self,
+        criteria: dict[Criterion, str],
+        hgvs: str,
+        consequences: list[str],
+        expected: str | None,
+    ) -> None:
+        """
+        GIVEN a CriteriaIndex
+        WHEN we look up the first Criterion matching a Variant
+        THEN we should get the same result as testing every Criterion in order
+        """
+        index = CriteriaIndex(criteria)
+        variant = Variant(hgvs, consequences)
+
+        linear = next((a for c, a in criteria.items() if c.match(variant)), None)
+        match = index.first_match(variant)
+
+        assert linear == expected
+        assert (match[1] if match else None) == expected
+
+    def test_version_mismatch(self, criteria: dict[Criterion, str]) -> None:
+        """
+        GIVEN a CriteriaIndex
+        WHEN we look up a Variant with a different transcript version
+        THEN we should get an error, even if the regions do not overlap
+        """
+        index = CriteriaIndex(criteria)
+        variant = Variant("ENST2.2:c.500A>T", [])
+        with pytest.raises(RuntimeError):
+            index.first_match(variant)
@@ -1,4 +1,4 @@
-from typing import Any, Iterator, Dict, Sequence, Tuple, Set
+from typing import Any, Iterator, Dict, Iterable, Mapping, Sequence, Tuple, Set
 import functools
 from collections import namedtuple
 from mutalyzer_hgvs_parser import to_model
@@ -14,6 +14,9 @@ Location = namedtuple("Location", ["downstream", "position", "offset"])
 # Tuple to store a region
 Region = namedtuple("Region", ["start", "end"])
 
+# The maximum number of parsed HGVS descriptions to keep in memory
+HGVS_CACHE_SIZE = 2**16
+
 
 class VEP(dict[str, Any]):
     """Class to work with VEP objects"""
@@ -64,11 +67,19 @@ class VEP(dict[str, Any]):
 
     def filter_annotate_transcripts(
         self,
-        inclusion: Sequence["Criterion"],
+        inclusion: "Sequence[Criterion] | CriteriaIndex",
         known_variants: dict[str, str],
-        annotation: dict["Criterion", str],
+        annotation: "Mapping[Criterion, str] | CriteriaIndex",
     ) -> None:
-        """Filter and annotate the transcripts"""
+        """Filter and annotate the transcripts
+
+        The criteria can be passed as a pre-built CriteriaIndex, which should
+        be done when filtering many VEP records with the same criteria
+        """
+        if not isinstance(inclusion, CriteriaIndex):
+            inclusion = CriteriaIndex(inclusion)
+        if not isinstance(annotation, CriteriaIndex):
+            annotation = CriteriaIndex(annotation)
 
         filtered = list()
         for transcript in self.get("transcript_consequences", list()):
@@ -82,25 +93,22 @@ class VEP(dict[str, Any]):
             variant = Variant(hgvsc, transcript["consequence_terms"])
 
             # If the variant does not match the inclusion criteria, we do nothing
-            for criteria in inclusion:
-                if criteria.match(variant):
-                    filtered.append(transcript)
-                    # Make sure the annotation key always exists
-                    transcript["annotation"] = ""
-                    break
-            else:
+            if inclusion.first_match(variant) is None:
                 continue
 
+            filtered.append(transcript)
+            # Make sure the annotation key always exists
+            transcript["annotation"] = ""
+
             # If hgvsc is a known variant, we update the annotation
             if hgvsc in known_variants:
                 transcript["annotation"] = known_variants[hgvsc]
                 continue
 
             # Otherwise, we check the criteria
-            for crit, annot in annotation.items():
-                if crit.match(variant):
-                    transcript["annotation"] = annot
-                    break
+            match = annotation.first_match(variant)
+            if match is not None:
+                transcript["annotation"] = match[1]
 
         self["transcript_consequences"] = filtered
         self.update_most_severe()
@@ -205,6 +213,24 @@ class Variant:
         self.hgvs = hgvs
         self.consequences = consequences
 
+        # The parsed HGVS description, only determined when needed
+        self._model: dict[str, Any] | None = None
+        self._position: Region | None = None
+
+    @property
+    def model(self) -> dict[str, Any]:
+        """The mutalyzer model of the HGVS description"""
+        if self._model is None:
+            self._model = parse_hgvs(self.hgvs)
+        return self._model
+
+    @property
+    def position(self) -> Region:
+        """The Region of the HGVS description"""
+        if self._position is None:
+            self._position = model_position(self.model)
+        return self._position
+
     @classmethod
     def from_VEP(cls, vep: VEP) -> Iterator["Variant"]:
         """Yield all Variants from a VEP record"""
@@ -258,7 +284,7 @@ class Variant:
 
     def size(self) -> int:
         """Return the size of the variant, inserted-deleted"""
-        model = to_model(self.hgvs)
+        model = self.model
         variants = model["variants"]
 
         # No variant
@@ -297,7 +323,7 @@ class Variant:
             raise NotImplementedError
 
     def frame(self) -> int | None:
-        model = to_model(self.hgvs)
+        model = self.model
         # Determine if the coordinate system supports detecting the frame
         coordinate = model["coordinate_system"]
         if coordinate != "c":
@@ -333,6 +359,9 @@ class Criterion:
         self.coordinate = coordinate
         self.consequence = consequence
 
+        # Split the version only once, since it is needed for every match
+        self.unversioned_id, self.version = self.split_version(identifier)
+
         # Define the type of start and end
         self.start: Location | None
         self.end: Location | None
@@ -439,7 +468,8 @@ class Criterion:
             and self.match_frame(variant)
         )
 
-    def split_version(self, identifier: str) -> Tuple[str, str]:
+    @staticmethod
+    def split_version(identifier: str) -> Tuple[str, str]:
         """Split the version from the identifier
 
         Set version to 0 if there is no version
@@ -462,10 +492,9 @@ class Criterion:
 
         # Get the variant id
         variant_id = variant.hgvs.split(":")[0]
-        criterion_id = self.identifier
 
         id1, v1 = self.split_version(variant_id)
-        id2, v2 = self.split_version(criterion_id)
+        id2, v2 = self.unversioned_id, self.version
 
         if id1 != id2:
             return False
@@ -488,7 +517,7 @@ class Criterion:
     def match_region(self, variant: Variant) -> bool:
         if self.start is None:
             return True
-        var_region = get_position(variant.hgvs)
+        var_region = variant.position
         crit_region = Region(self.start, self.end)
 
         return region_overlap(var_region, crit_region)
@@ -500,17 +529,41 @@ class Criterion:
             return variant.frame() == self.frame
 
 
-@functools.lru_cache(maxsize=1000)
+@functools.lru_cache(maxsize=HGVS_CACHE_SIZE)
+def parse_hgvs(hgvs: str) -> dict[str, Any]:
+    """Parse a HGVS description into a mutalyzer model
+
+    Parsing HGVS is slow, so all parsing should go through this function to
+    make sure every description is parsed only once. The model is shared
+    between callers, so it must not be modified.
+    """
+    model: dict[str, Any] = to_model(hgvs)
+    return model
+
+
+def hgvs_cache_stats(infos: Sequence[Any] | None = None) -> str:
+    """Return the hits and misses of the HGVS parse cache
+
+    To report on multiple processes, pass the cache_info() of every process
+    """
+    if infos is None:
+        infos = [parse_hgvs.cache_info()]
+
+    # Sum every field of the (hits, misses, maxsize, currsize) tuples
+    hits, misses, maxsize, currsize = (sum(field) for field in zip(*infos))
+    return (
+        f"HGVS parse cache: {hits} hits, {misses} misses, "
+        f"{currsize}/{maxsize} entries"
+    )
+
+
 def get_position(hgvs: str) -> Region:
-    # Get the variant part of the hgvs description
-    coordinate, var = hgvs.split(":")[1].split(".")
+    return model_position(parse_hgvs(hgvs))
 
-    if coordinate == "p":
-        model = to_model(var, "p_variant")
-    else:
-        model = to_model(var, "variant")
 
-    location = model["location"]
+def model_position(model: dict[str, Any]) -> Region:
+    """Determine the Region of a parsed HGVS description"""
+    location = model["variants"][0]["location"]
     if location["type"] == "point":
         start = point_to_tuple(location)
         end = start
@@ -581,6 +634,149 @@ def region_contains(region1: Region, region2: Region) -> bool:
     return bool(region1.start <= region2.start and region1.end >= region2.end)
 
 
+class IntervalTree:
+    """Static interval tree to find the (inclusive) intervals overlapping a
+    query region
+
+    The intervals are stored sorted by start position in an implicit balanced
+    binary tree, where every node also keeps the largest end position of its
+    subtree, so that subtrees which end before the query can be skipped.
+    """
+
+    def __init__(self, intervals: Iterable[Tuple[Location, Location, int]]):
+        # Each interval is (start, end, value)
+        self.intervals = sorted(intervals)
+        self.max_end: list[Location] = [i[1] for i in self.intervals]
+        if self.intervals:
+            self._build(0, len(self.intervals))
+
+    def _build(self, lo: int, hi: int) -> Location:
+        """Determine the max end position for the subtree in [lo, hi)"""
+        mid = (lo + hi) // 2
+        max_end = self.intervals[mid][1]
+        if lo < mid:
+            max_end = max(max_end, self._build(lo, mid))
+        if mid + 1 < hi:
+            max_end = max(max_end, self._build(mid + 1, hi))
+        self.max_end[mid] = max_end
+        return max_end
+
+    def __len__(self) -> int:
+        return len(self.intervals)
+
+    def overlap(self, region: Region) -> list[int]:
+        """Return the values of all intervals that overlap region"""
+        found: list[int] = list()
+        # Stack of [lo, hi) subtrees to visit
+        todo = [(0, len(self.intervals))]
+        while todo:
+            lo, hi = todo.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            # Nothing in this subtree ends after the start of region
+            if self.max_end[mid] < region.start:
+                continue
+            todo.append((lo, mid))
+            start, end, value = self.intervals[mid]
+            # Everything to the right starts after the end of region
+            if start > region.end:
+                continue
+            if end >= region.start:
+                found.append(value)
+            todo.append((mid + 1, hi))
+        return found
+
+
+class CriteriaIndex:
+    """Index of Criteria, to quickly find the Criteria matching a Variant
+
+    The Criteria are grouped by their unversioned identifier. Within every
+    group, the Criteria which specify a region are stored in an IntervalTree,
+    so that only the Criteria that can overlap the Variant are tested.
+
+    The order of the Criteria is preserved, so first_match returns the same
+    Criterion as testing every Criterion in order would.
+    """
+
+    def __init__(self, criteria: Mapping[Criterion, str] | Iterable[Criterion]):
+        if isinstance(criteria, Mapping):
+            self.criteria = list(criteria.items())
+        else:
+            self.criteria = [(c, "") for c in criteria]
+
+        # Per unversioned identifier, the indices of the criteria
+        self.by_id: dict[str, list[int]] = dict()
+        for index, (criterion, _) in enumerate(self.criteria):
+            self.by_id.setdefault(criterion.unversioned_id, list()).append(index)
+
+        # Per unversioned identifier, the regions of the criteria which have
+        # one. The other criteria can always overlap the variant
+        self.trees: dict[str, IntervalTree] = dict()
+        self.unbounded: dict[str, list[int]] = dict()
+        for id_, indices in self.by_id.items():
+            regions = list()
+            unbounded = list()
+            for index in indices:
+                c = self.criteria[index][0]
+                if c.start is not None and c.end is not None:
+                    regions.append((c.start, c.end, index))
+                else:
+                    unbounded.append(index)
+            self.trees[id_] = IntervalTree(regions)
+            self.unbounded[id_] = unbounded
+
+    def __len__(self) -> int:
+        return len(self.criteria)
+
+    def candidates(self, variant: Variant) -> list[int]:
+        """Return the indices of the criteria that could match variant, in order
+
+        Criteria that do not match the variant identifier, or whose region
+        does not overlap the variant, are left out. Criteria with a version
+        mismatch are always included, so matching them raises an error like
+        it would without the index.
+        """
+        variant_id = variant.hgvs.split(":")[0]
+        id_, version = Criterion.split_version(variant_id)
+
+        indices = self.by_id.get(id_)
+        if indices is None:
+            return list()
+
+        tree = self.trees[id_]
+        if not tree:
+            return indices
+
+        found = {i for i in indices if self.criteria[i][0].version != version}
+
+        coordinate = variant.hgvs.split(":")[1].split(".")[0]
+        if all(self.criteria[i][0].coordinate != coordinate for i in indices):
+            return sorted(found)
+
+        # If the position of the variant cannot be parsed, we leave it to
+        # Criterion.match to decide what to do with it
+        try:
+            region = variant.position
+        except Exception:
+            return indices
+
+        found.update(tree.overlap(region))
+        found.update(self.unbounded[id_])
+        return sorted(found)
+
+    def matches(self, variant: Variant) -> Iterator[Tuple[Criterion, str]]:
+        """Yield every (Criterion, annotation) that matches variant, in order"""
+        for index in self.candidates(variant):
+            criterion, annotation = self.criteria[index]
+            if criterion.match(variant):
+                yield criterion, annotation
+
+    def first_match(self, variant: Variant) -> Tuple[Criterion, str] | None:
+        """Return the first (Criterion, annotation) that matches variant"""
+        return next(self.matches(variant), None)
+
+
 def read_criteria_file(criteria_file: str) -> OrderedDict[Criterion, str]:
     """Read the criteria and annotations from the criteria file
 
@@ -1,13 +1,398 @@
 import argparse
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
 import json
 import base64
+import multiprocessing
 import os
+import re
+import sys
+import time
+from collections import defaultdict, deque
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from dataclasses import dataclass
 from datetime import datetime as dt
+from importlib.util import find_spec
 from pathlib import Path
 from tempfile import NamedTemporaryFile as NTF
-from typing import Any, Dict, List, Optional
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import (
+    BaseLoader,
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    Template,
+)
+
+try:
+    from PIL import Image
+
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+# Largest size of a figure in the report in inches, see 'figure img' in the
+# css file (96 pixels per inch)
+FIGURE_WIDTH = 640 / 96
+FIGURE_HEIGHT = 860 / 96
+
+MIME_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+}
+
+
+class Profiler(object):
+    """Keep track of the time spent per template and per filter"""
+
+    def __init__(self) -> None:
+        # Number of calls and total time, per (kind, name)
+        self.calls: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.times: Dict[Tuple[str, str], float] = defaultdict(float)
+
+    def add(self, kind: str, name: str, seconds: float) -> None:
+        self.calls[(kind, name)] += 1
+        self.times[(kind, name)] += seconds
+
+    def timed(self, kind: str, name: str, func: Callable[..., Any]) -> Any:
+        """Wrap func to record the time spent in every call"""
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(kind, name, time.perf_counter() - start)
+
+        return wrapper
+
+    def timed_render(
+        self, name: str, render_func: Callable[[Any], Iterator[str]]
+    ) -> Callable[[Any], Iterator[str]]:
+        """Wrap the render function of a template
+
+        The time spent on included templates is included in the time of the
+        template that includes them.
+        """
+
+        def render(context: Any) -> Iterator[str]:
+            chunks = render_func(context)
+            elapsed = 0.0
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield chunk
+            self.add("render", name, elapsed)
+
+        return render
+
+    def report(self, fout: IO[str] = sys.stderr) -> None:
+        """Print the time spent, from slowest to fastest"""
+        print(f"{'stage':<8} {'name':<32} {'calls':>7} {'seconds':>10}", file=fout)
+        for key, seconds in sorted(self.times.items(), key=lambda x: -x[1]):
+            kind, name = key
+            calls = self.calls[key]
+            print(f"{kind:<8} {name:<32} {calls:>7} {seconds:>10.4f}", file=fout)
+
+
+class ProfilingLoader(BaseLoader):
+    """Template loader which records the time spent per template"""
+
+    def __init__(self, loader: BaseLoader, profiler: Profiler) -> None:
+        self.loader = loader
+        self.profiler = profiler
+
+    def get_source(self, environment: Environment, template: str) -> Any:
+        return self.loader.get_source(environment, template)
+
+    def list_templates(self) -> List[str]:
+        return self.loader.list_templates()
+
+    def load(
+        self,
+        environment: Environment,
+        name: str,
+        globals: Optional[MutableMapping[str, Any]] = None,
+    ) -> Template:
+        """Load (and compile) a template, and time its rendering"""
+        start = time.perf_counter()
+        template = super().load(environment, name, globals)
+        self.profiler.add("load", name, time.perf_counter() - start)
+        template.root_render_func = self.profiler.timed_render(
+            name, template.root_render_func
+        )
+        return template
+
+
+def default_cache_dir() -> str:
+    """Return the directory to cache the compiled templates
+
+    This is the jinja folder in the HAMLET_CACHE environment variable, or in
+    .cache/hamlet in the working directory, the same as for the GTF index
+    """
+    cache = os.environ.get("HAMLET_CACHE") or os.path.join(".cache", "hamlet")
+    return os.path.join(cache, "jinja")
+
+
+def bytecode_cache(cache_dir: str) -> Optional[FileSystemBytecodeCache]:
+    """Return a cache for the compiled templates, if cache_dir is writable
+
+    Jinja checks the hash of the template source before using the cached
+    bytecode, so changes to the templates are always picked up.
+    """
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        pass
+    if not os.access(cache_dir, os.W_OK):
+        print(f"Unable to cache the compiled templates in {cache_dir}", file=sys.stderr)
+        return None
+    return FileSystemBytecodeCache(cache_dir)
+
+
+def show_int(value: Any) -> str:
+    if value is None or value == "":
+        return "?"
+    return "{:,d}".format(int(value))
+
+
+def show_pct(value1: Any, value2: Any) -> str:
+    if value2 == 0:
+        return "undefined"
+    elif any(v is None or v == "" for v in (value1, value2)):
+        return "?"
+    return "{:,.2f}%".format(value1 * 100.0 / value2)
+
+
+def show_float(value: Any, spec: str = ".3g") -> str:
+    if value is None or value == "":
+        return "?"
+    fmt = "{:," + spec + "}"
+    return fmt.format(float(value))
+
+
+def as_pct(value: Any) -> str:
+    if value is None or value == "":
+        return "?"
+    return "{:,.2f}%".format(float(value) * 100.0)
+
+
+def num_tids(idm: Any) -> int:
+    return sum([len(v["transcript_ids"]) for v in idm])
+
+
+def gene_rows(gene: Any) -> int:
+    """Determine how many rows a gene should span
+
+    The number of rows for a gene is determined by two factors:
+    1. The number of variants for that gene
+    2. How many transcripts of interest overlap that variant
+    """
+    rows = 0
+    for variant in gene:
+        rows += len(variant["transcript_consequences"])
+    return rows
+
+
+def database_url(identifier: str) -> str:
+    """Turn a database identifier into the apropriate url
+
+    If not known, return the identifier itself
+    """
+    if identifier.startswith("rs"):
+        return f"https://www.ncbi.nlm.nih.gov/snp/{identifier}"
+    elif identifier.startswith("COSV"):
+        return f"https://cancer.sanger.ac.uk/cosmic/search?q={identifier}"
+    else:
+        return identifier
+
+
+def make_href(identifier: str) -> str:
+    """Create a link for identifier"""
+    url = database_url(identifier)
+    # Don't know how to make an url
+    if url == identifier:
+        return identifier
+    else:
+        return f"<a href={url}>{identifier}</a>"
+
+
+def database_identifiers(item: Any) -> List[str]:
+    """Extract the id's from colocated variants"""
+    ids = list()
+    for known_var in item.get("colocated_variants", list()):
+        ids.append(make_href(known_var["id"]))
+    return ids
+
+
+def ref_AD(item: Any) -> int:
+    """Extract the reference depth from the vardict FORMAT AD field"""
+    ad = item["FORMAT"]["AD"]
+    return int(ad.split(",")[0])
+
+
+def alt_AD(item: Any) -> List[int]:
+    """Extract the alt depth(s) from the vardcit FORMAT AD field"""
+    ad = item["FORMAT"]["AD"]
+    ref, *alt = ad.split(",")
+    return [int(x) for x in alt]
+
+
+class AssetStore(object):
+    """Images encoded as base64 data URI's, memoized by path and mtime
+
+    Every image is only read and encoded once per document, and identical
+    images from different paths share one encoding. Images from a shared
+    folder, such as the logos, are kept for all documents. The other images
+    are dropped when a new document is started, so the memory use does not
+    grow with the number of documents. If dpi is set, PNG images which are
+    larger than a figure at that resolution are downscaled.
+    """
+
+    def __init__(self, dpi: Optional[int] = None) -> None:
+        self.dpi = dpi
+        # Content hash per (path, size, modification time)
+        self.digests: Dict[Tuple[str, int, int], str] = dict()
+        # Data URI per content hash
+        self.uris: Dict[str, str] = dict()
+        # How often every image is embedded in the current document
+        self.embedded: Dict[str, int] = defaultdict(int)
+
+    def data_uri(self, img_path: str) -> str:
+        path = Path(img_path)
+        if not path.exists():
+            raise ValueError(f"Unable to find file {img_path}")
+        stat = path.stat()
+        key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+        if key not in self.digests:
+            data = path.read_bytes()
+            digest = hashlib.sha256(data).hexdigest()
+            if digest not in self.uris:
+                self.uris[digest] = self.encode(data, img_path)
+            self.digests[key] = digest
+
+        digest = self.digests[key]
+        self.embedded[digest] += 1
+        return self.uris[digest]
+
+    def encode(self, data: bytes, img_path: str) -> str:
+        ext = os.path.splitext(img_path)[1].lower()
+        mime = MIME_TYPES.get(ext, "application/octet-stream")
+        if self.dpi is not None and mime == "image/png":
+            max_size = (round(FIGURE_WIDTH * self.dpi), round(FIGURE_HEIGHT * self.dpi))
+            data = downscale_png(data, max_size)
+        return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+
+    def new_document(self, shared_dir: Optional[str] = None) -> None:
+        """Start a new document, only keep the images from shared_dir"""
+        self.embedded.clear()
+        shared = None if shared_dir is None else Path(shared_dir).resolve()
+        self.digests = {
+            key: digest
+            for key, digest in self.digests.items()
+            if shared is not None and is_in_folder(Path(key[0]), shared)
+        }
+        kept = set(self.digests.values())
+        self.uris = {d: uri for d, uri in self.uris.items() if d in kept}
+
+    def embedded_bytes(self) -> int:
+        """The number of bytes the images add to the current document"""
+        return sum(len(self.uris[d]) * count for d, count in self.embedded.items())
+
+
+def is_in_folder(path: Path, folder: Path) -> bool:
+    """Determine if path is folder, or inside folder"""
+    return path == folder or folder in path.parents
+
+
+def downscale_png(data: bytes, max_size: Tuple[int, int]) -> bytes:
+    """Downscale a PNG image to fit in max_size, if that makes it smaller"""
+    with Image.open(io.BytesIO(data)) as img:
+        if img.width <= max_size[0] and img.height <= max_size[1]:
+            return data
+        # Image.Resampling was added in Pillow 9.1
+        resampling = getattr(Image, "Resampling", Image)
+        img.thumbnail(max_size, resampling.LANCZOS)
+        output = io.BytesIO()
+        img.save(output, format="PNG", optimize=True)
+    return min(data, output.getvalue(), key=len)
+
+
+# The images embedded in the reports of this process
+ASSETS = AssetStore()
+
+
+def convert_img_to_base64(img_path: str) -> str:
+    return ASSETS.data_uri(img_path)
+
+
+def create_environment(
+    tpl_dir: str, cache_dir: Optional[str] = None, profiler: Optional[Profiler] = None
+) -> Environment:
+    """Create the Jinja environment for the report templates
+
+    The environment can be shared between reports, so the templates are only
+    compiled once.
+    """
+    loader: BaseLoader = FileSystemLoader(tpl_dir)
+    if profiler is not None:
+        loader = ProfilingLoader(loader, profiler)
+    env = Environment(
+        loader=loader,
+        bytecode_cache=bytecode_cache(cache_dir) if cache_dir else None,
+    )
+    filters: Dict[str, Callable[..., Any]] = {
+        "show_int": show_int,
+        "show_pct": show_pct,
+        "show_float": show_float,
+        "as_pct": as_pct,
+        "num_tids": num_tids,
+    }
+    functions: Dict[str, Callable[..., Any]] = {
+        "gene_rows": gene_rows,
+        "database_identifiers": database_identifiers,
+        "ref_AD": ref_AD,
+        "alt_AD": alt_AD,
+        "convert_img_to_base64": convert_img_to_base64,
+    }
+    if profiler is not None:
+        for name, func in filters.items():
+            filters[name] = profiler.timed("filter", name, func)
+        for name, func in functions.items():
+            functions[name] = profiler.timed("function", name, func)
+    env.filters.update(filters)
+    env.globals.update(functions)
+    return env
 
 
 class Report(object):
@@ -29,6 +414,10 @@ class Report(object):
         footer_rcaption: Optional[str] = None,
         pdfkit_opts: Optional[Dict[str, Any]] = None,
         timestamp: Optional[dt] = None,
+        cache_dir: Optional[str] = None,
+        profiler: Optional[Profiler] = None,
+        env: Optional[Environment] = None,
+        pdf_backend: str = "pdfkit",
     ) -> None:
         sdm = summaryd["metadata"]
         self.summary = summaryd
@@ -38,6 +427,7 @@ class Report(object):
         self.contents_tpl_fname = contents_tpl_fname
         self.css_fname = css_fname
         self.toc_fname = toc_fname
+        self.pdf_backend = pdf_backend
         self.imgs_dir = str(Path(imgs_dir).resolve())
 
         self.timestamp = timestamp or dt.now()
@@ -71,114 +461,18 @@ class Report(object):
             pdfkit_opts["footer-right"] = footer_rcaption.format(**hf_ctx)
         self.pdfkit_opts = pdfkit_opts
 
-        def show_int(value: Any) -> str:
-            if value is None or value == "":
-                return "?"
-            return "{:,d}".format(int(value))
-
-        def show_pct(value1: Any, value2: Any) -> str:
-            if value2 == 0:
-                return "undefined"
-            elif any(v is None or v == "" for v in (value1, value2)):
-                return "?"
-            return "{:,.2f}%".format(value1 * 100.0 / value2)
-
-        def show_float(value: Any, spec: str = ".3g") -> str:
-            if value is None or value == "":
-                return "?"
-            fmt = "{:," + spec + "}"
-            return fmt.format(float(value))
-
-        def as_pct(value: Any) -> str:
-            if value is None or value == "":
-                return "?"
-            return "{:,.2f}%".format(float(value) * 100.0)
-
-        def num_tids(idm: Any) -> int:
-            return sum([len(v["transcript_ids"]) for v in idm])
-
-        def gene_rows(gene: Any) -> int:
-            """Determine how many rows a gene should span
-
-            The number of rows for a gene is determined by two factors:
-            1. The number of variants for that gene
-            2. How many transcripts of interest overlap that variant
-            """
-            rows = 0
-            for variant in gene:
-                rows += len(variant["transcript_consequences"])
-            return rows
-
-        def database_url(identifier: str) -> str:
-            """Turn a database identifier into the apropriate url
-
-            If not known, return the identifier itself
-            """
-            if identifier.startswith("rs"):
-                return f"https://www.ncbi.nlm.nih.gov/snp/{identifier}"
-            elif identifier.startswith("COSV"):
-                return f"https://cancer.sanger.ac.uk/cosmic/search?q={identifier}"
-            else:
-                return identifier
-
-        def make_href(identifier: str) -> str:
-            """Create a link for identifier"""
-            url = database_url(identifier)
-            # Don't know how to make an url
-            if url == identifier:
-                return identifier
-            else:
-                return f"<a href={url}>{identifier}</a>"
-
-        def database_identifiers(item: Any) -> List[str]:
-            """Extract the id's from colocated variants"""
-            ids = list()
-            for known_var in item.get("colocated_variants", list()):
-                ids.append(make_href(known_var["id"]))
-            return ids
-
-        def ref_AD(item: Any) -> int:
-            """Extract the reference depth from the vardict FORMAT AD field"""
-            ad = item["FORMAT"]["AD"]
-            return int(ad.split(",")[0])
-
-        def alt_AD(item: Any) -> List[int]:
-            """Extract the alt depth(s) from the vardcit FORMAT AD field"""
-            ad = item["FORMAT"]["AD"]
-            ref, *alt = ad.split(",")
-            return [int(x) for x in alt]
-
-        def convert_img_to_base64(img_path: str) -> str:
-            if not Path(img_path).exists():
-                raise ValueError(f"Unable to find file {img_path}")
-            with open(img_path, "rb") as f:
-                data = f.read()
-            mime = {
-                ".png": "image/png",
-                ".jpg": "image/jpeg",
-                ".jpeg": "image/jpeg",
-            }.get(os.path.splitext(img_path)[1].lower(), "application/octet-stream")
-            return f"data:{mime};base64,{base64.b64encode(data).decode()}"
-
-        env = Environment(loader=FileSystemLoader(tpl_dir))
-        env.filters["show_int"] = show_int
-        env.filters["show_pct"] = show_pct
-        env.filters["show_float"] = show_float
-        env.filters["as_pct"] = as_pct
-        env.filters["num_tids"] = num_tids
-        env.globals["gene_rows"] = gene_rows
-        env.globals["database_identifiers"] = database_identifiers
-        env.globals["ref_AD"] = ref_AD
-        env.globals["alt_AD"] = alt_AD
-        env.globals["convert_img_to_base64"] = convert_img_to_base64
+        if env is None:
+            env = create_environment(tpl_dir, cache_dir, profiler)
         self.env = env
+        # The number of bytes the embedded images add to the report
+        self.embedded_bytes = 0
+        # The time spent per stage of writing the report
+        self.timings: Dict[str, float] = dict()
         self.cover_tpl = env.get_template(cover_tpl_fname)
         self.contents_tpl = env.get_template(contents_tpl_fname)
 
-    def write(self, html: str, pdf: str) -> None:
-        """Writes the report to the given path."""
-        toc = {"xsl-style-sheet": self.toc_fname}
-        tmp_prefix = str(Path.cwd()) + "/"
+    def render(self) -> Tuple[str, str]:
+        """Render the cover and the contents of the report"""
         cover_ctx = {
             "sample_name": self.sample_name,
             "pipeline_version": self.pipeline_version,
@@ -190,53 +484,221 @@ class Report(object):
         contents_ctx["css_fname"] = self.css_fname
         contents_ctx["imgs_dir"] = self.imgs_dir
 
+        start = time.perf_counter()
+        ASSETS.new_document(self.imgs_dir)
+        cov_txt = self.cover_tpl.render(**cover_ctx)
+        con_txt = self.contents_tpl.render(**contents_ctx)
+        self.embedded_bytes = ASSETS.embedded_bytes()
+        self.timings["render"] = time.perf_counter() - start
+        return cov_txt, con_txt
+
+    def write(self, html: str, pdf: str) -> None:
+        """Writes the report to the given path.
+
+        The report is rendered once for both outputs. The PDF is converted
+        from the rendered text, not from the written HTML file, since that
+        file contains the cover, which wkhtmltopdf needs as a separate
+        document.
+        """
+        cov_txt, con_txt = self.render()
+        if html:
+            write_html(html, cov_txt, con_txt)
+        if pdf:
+            timings = write_pdf(
+                pdf, cov_txt, con_txt, backend=self.pdf_backend, **self.pdf_settings()
+            )
+            self.timings.update(timings)
+
+    def pdf_settings(self) -> Dict[str, Any]:
+        """The settings to convert the report to PDF"""
+        return {
+            "options": self.pdfkit_opts,
+            "css": self.css_fname,
+            "toc": {"xsl-style-sheet": self.toc_fname},
+        }
+
+
+def write_html(html: str, cov_txt: str, con_txt: str) -> None:
+    with open(html, "wt") as fout:
+        fout.write(cov_txt)
+        fout.write(con_txt)
+
+
+class PDFBackend(object):
+    """Convert a report to PDF with wkhtmltopdf, using pdfkit"""
+
+    name = "pdfkit"
+
+    def write(
+        self,
+        pdf: str,
+        cov_txt: str,
+        con_txt: str,
+        options: Dict[str, Any],
+        css: str,
+        toc: Dict[str, Any],
+    ) -> Dict[str, float]:
+        """Write the cover and contents of a report to pdf
+
+        Returns the time spent per stage
+        """
+        import pdfkit
+
+        start = time.perf_counter()
+        tmp_prefix = str(Path.cwd()) + "/"
         with NTF(prefix=tmp_prefix, suffix=".html") as cov_fh:
-            cov_txt = self.cover_tpl.render(**cover_ctx)
             cov_fh.write(cov_txt.encode("utf-8"))
             cov_fh.seek(0)
 
-            con_txt = self.contents_tpl.render(**contents_ctx)
-
-            if html:
-                with open(html, "wt") as fout:
-                    fout.write(cov_txt)
-                    fout.write(con_txt)
-            if pdf:
-                import pdfkit
-
-                pdfkit.from_string(
-                    con_txt,
-                    pdf,
-                    options=self.pdfkit_opts,
-                    css=self.css_fname,
-                    toc=toc,
-                    cover=cov_fh.name,
-                    cover_first=True,
-                )
+            pdfkit.from_string(
+                con_txt,
+                pdf,
+                options=options,
+                css=css,
+                toc=toc,
+                cover=cov_fh.name,
+                cover_first=True,
+            )
+        # wkhtmltopdf lays out and writes the PDF in a single step
+        return {"layout": time.perf_counter() - start}
 
 
-def main(
-    input_summary_path: str,
+class WeasyPrintBackend(PDFBackend):
+    """Convert a report to PDF with WeasyPrint, in the current process
+
+    WeasyPrint is only loaded once per process, so converting multiple reports
+    does not start a new program for every report. The table of contents of
+    wkhtmltopdf is not supported, the PDF bookmarks can be used instead. The
+    header and footer captions are converted to CSS page margin boxes.
+    """
+
+    name = "weasyprint"
+
+    def __init__(self) -> None:
+        import weasyprint
+        from weasyprint.text.fonts import FontConfiguration
+
+        self.weasyprint = weasyprint
+        # The fonts are shared between the reports
+        self.font_config = FontConfiguration()
+
+    def write(
+        self,
+        pdf: str,
+        cov_txt: str,
+        con_txt: str,
+        options: Dict[str, Any],
+        css: str,
+        toc: Dict[str, Any],
+    ) -> Dict[str, float]:
+        weasyprint = self.weasyprint
+        font_config = self.font_config
+        base_url = str(Path.cwd())
+
+        start = time.perf_counter()
+        stylesheet = weasyprint.CSS(filename=css, font_config=font_config)
+        # The cover page has no header and footer
+        cover_page = weasyprint.CSS(string=page_css(options, margin_boxes=False))
+        page = weasyprint.CSS(string=page_css(options))
+        cover = weasyprint.HTML(string=cov_txt, base_url=base_url).render(
+            font_config=font_config, stylesheets=[stylesheet, cover_page]
+        )
+        contents = weasyprint.HTML(string=con_txt, base_url=base_url).render(
+            font_config=font_config, stylesheets=[stylesheet, page]
+        )
+        document = cover.copy(cover.pages + contents.pages)
+        layout = time.perf_counter() - start
+
+        start = time.perf_counter()
+        document.write_pdf(pdf)
+        return {"layout": layout, "write": time.perf_counter() - start}
+
+
+PDF_BACKENDS: Dict[str, Type[PDFBackend]] = {
+    "pdfkit": PDFBackend,
+    "weasyprint": WeasyPrintBackend,
+}
+
+# The wkhtmltopdf header and footer options, and the matching margin boxes
+MARGIN_BOXES = {
+    "header-left": "top-left",
+    "header-center": "top-center",
+    "header-right": "top-right",
+    "footer-left": "bottom-left",
+    "footer-center": "bottom-center",
+    "footer-right": "bottom-right",
+}
+
+
+def page_css(options: Dict[str, Any], margin_boxes: bool = True) -> str:
+    """Convert the wkhtmltopdf page options to a CSS page rule"""
+    margins = " ".join(
+        f"{options.get(f'margin-{side}', 0)}mm"
+        for side in ("top", "right", "bottom", "left")
+    )
+    rules = [f"size: {options.get('page-size', 'A4')};", f"margin: {margins};"]
+    if margin_boxes:
+        for option, box in MARGIN_BOXES.items():
+            if option in options:
+                content = css_content(options[option])
+                rules.append(f"@{box} {{ content: {content}; }}")
+    return f"@page {{ {' '.join(rules)} }}"
+
+
+def css_content(caption: str) -> str:
+    """Convert a wkhtmltopdf caption to the value of a CSS content property"""
+    counters = {"[page]": "counter(page)", "[toPage]": "counter(pages)"}
+    parts = list()
+    for part in re.split(r"(\[page\]|\[toPage\])", caption):
+        if part in counters:
+            parts.append(counters[part])
+        elif part:
+            escaped = part.replace("\\", "\\\\").replace('"', '\\"')
+            parts.append(f'"{escaped}"')
+    return " ".join(parts) or '""'
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend(name: str) -> PDFBackend:
+    """Return the PDF backend called name, which is shared in a process"""
+    return PDF_BACKENDS[name]()
+
+
+def write_pdf(
+    pdf: str,
+    cov_txt: str,
+    con_txt: str,
+    options: Dict[str, Any],
+    css: str,
+    toc: Dict[str, Any],
+    backend: str = "pdfkit",
+) -> Dict[str, float]:
+    """Convert the cover and contents of a report to PDF
+
+    Returns the time spent per stage
+    """
+    return get_backend(backend).write(pdf, cov_txt, con_txt, options, css, toc)
+
+
+def create_report(
+    sd: Dict[str, Any],
     css_path: str,
     templates_dir: str,
     imgs_dir: str,
     toc_path: str,
-    html: str,
-    pdf: str,
-) -> None:
-    """Script for generating PDF report of a sample analyzed with the Hamlet
-    pipeline."""
-    with open(input_summary_path) as src:
-        sd = json.load(src)
-
+    cache_dir: Optional[str] = None,
+    profiler: Optional[Profiler] = None,
+    env: Optional[Environment] = None,
+    pdf_backend: str = "pdfkit",
+) -> Report:
+    """Create the report for a summary, with the default captions"""
     sdm = sd["metadata"]
     sample_name = sdm["sample_name"]
-    pipeline_version = sdm["pipeline_version"]
     header_caption = f"Hamlet Report - Sample {sample_name!r}"
     footer_lcaption = "Generated on {timestamp:%A, %d %B %Y at %H:%M}"
     footer_rcaption = "[page]/[toPage]"
 
-    report = Report(
+    return Report(
         sd,
         tpl_dir=templates_dir,
         imgs_dir=imgs_dir,
@@ -245,29 +707,367 @@ def main(
         header_caption=header_caption,
         footer_lcaption=footer_lcaption,
         footer_rcaption=footer_rcaption,
+        cache_dir=cache_dir,
+        profiler=profiler,
+        env=env,
+        pdf_backend=pdf_backend,
+    )
+
+
+def main(
+    input_summary_path: str,
+    css_path: str,
+    templates_dir: str,
+    imgs_dir: str,
+    toc_path: str,
+    html: str,
+    pdf: str,
+    cache_dir: Optional[str] = None,
+    profile: bool = False,
+    image_dpi: Optional[int] = None,
+    pdf_backend: str = "pdfkit",
+) -> None:
+    """Script for generating PDF report of a sample analyzed with the Hamlet
+    pipeline."""
+    ASSETS.dpi = image_dpi
+    profiler = Profiler() if profile else None
+    with open(input_summary_path) as src:
+        sd = json.load(src)
+
+    report = create_report(
+        sd,
+        css_path,
+        templates_dir,
+        imgs_dir,
+        toc_path,
+        cache_dir,
+        profiler,
+        pdf_backend=pdf_backend,
     )
     report.write(html, pdf)
+    print_embedded(report)
+    print_timings(report.sample_name, report.timings)
+
+    if profiler is not None:
+        for stage, seconds in report.timings.items():
+            profiler.add("stage", stage, seconds)
+        profiler.report()
+
+
+def print_embedded(report: Report) -> None:
+    print(
+        f"The embedded images add {report.embedded_bytes:,} bytes to the report "
+        f"of {report.sample_name}",
+        file=sys.stderr,
+    )
+
+
+def print_timings(sample_name: str, timings: Dict[str, float]) -> None:
+    stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in timings.items())
+    print(f"Time spent on the report of {sample_name}: {stages}", file=sys.stderr)
+
+
+# The Jinja environment of a (worker) process, which is shared by all reports
+# that are rendered in that process
+_environment: Optional[Environment] = None
+
+
+def init_environment(
+    templates_dir: str,
+    cache_dir: Optional[str] = None,
+    profiler: Optional[Profiler] = None,
+    image_dpi: Optional[int] = None,
+) -> None:
+    global _environment
+    _environment = create_environment(templates_dir, cache_dir, profiler)
+    ASSETS.dpi = image_dpi
+
+
+def output_path(template: str, sample_name: str) -> str:
+    """Fill in the sample name in an output path, and create its folder"""
+    path = template.replace("{sample}", sample_name)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return path
+
+
+@dataclass
+class PDFJob:
+    """A rendered report, which is converted to PDF"""
+
+    sample_name: str
+    pdf: str
+    cov_txt: str
+    con_txt: str
+    settings: Dict[str, Any]
+    backend: str
+    timings: Dict[str, float]
+
+
+def convert_pdf(job: PDFJob) -> Dict[str, float]:
+    return write_pdf(
+        job.pdf, job.cov_txt, job.con_txt, backend=job.backend, **job.settings
+    )
+
+
+def render_summary(
+    input_summary_path: str,
+    css_path: str,
+    templates_dir: str,
+    imgs_dir: str,
+    toc_path: str,
+    html: Optional[str],
+    pdf: Optional[str],
+    pdf_backend: str = "pdfkit",
+) -> Optional[PDFJob]:
+    """Render the report for a summary, and write the HTML output
+
+    Returns the job to convert the report to PDF, if PDF output is requested
+    """
+    with open(input_summary_path) as src:
+        sd = json.load(src)
+
+    report = create_report(
+        sd,
+        css_path,
+        templates_dir,
+        imgs_dir,
+        toc_path,
+        env=_environment,
+        pdf_backend=pdf_backend,
+    )
+    cov_txt, con_txt = report.render()
+    print_embedded(report)
+    if html:
+        write_html(output_path(html, report.sample_name), cov_txt, con_txt)
+    if not pdf:
+        print_timings(report.sample_name, report.timings)
+        return None
+    return PDFJob(
+        report.sample_name,
+        output_path(pdf, report.sample_name),
+        cov_txt,
+        con_txt,
+        report.pdf_settings(),
+        pdf_backend,
+        report.timings,
+    )
+
+
+def batch(
+    input_summary_paths: Sequence[str],
+    css_path: str,
+    templates_dir: str,
+    imgs_dir: str,
+    toc_path: str,
+    html: Optional[str],
+    pdf: Optional[str],
+    cache_dir: Optional[str] = None,
+    workers: int = 1,
+    pdf_workers: int = 1,
+    profile: bool = False,
+    image_dpi: Optional[int] = None,
+    pdf_backend: str = "pdfkit",
+) -> None:
+    """Generate the reports for multiple summaries
+
+    The reports are rendered in parallel by the specified number of worker
+    processes, which each use a single Jinja environment for all reports.
+    While the reports are rendered, at most pdf_workers reports are converted
+    to PDF at the same time. For WeasyPrint, this happens in pdf_workers
+    processes which are used for the whole batch. At most twice as many
+    rendered reports wait for their conversion.
+
+    The output paths should contain '{sample}', which is replaced by the
+    sample name of each summary.
+    """
+    profiler = Profiler() if profile else None
+    render = functools.partial(
+        render_summary,
+        css_path=css_path,
+        templates_dir=templates_dir,
+        imgs_dir=imgs_dir,
+        toc_path=toc_path,
+        html=html,
+        pdf=pdf,
+        pdf_backend=pdf_backend,
+    )
+    with contextlib.ExitStack() as stack:
+        start: Callable[[str], Callable[[], Optional[PDFJob]]]
+        if workers > 1:
+            pool = stack.enter_context(
+                multiprocessing.Pool(
+                    workers,
+                    init_environment,
+                    (templates_dir, cache_dir, None, image_dpi),
+                )
+            )
+
+            def start(path: str) -> Callable[[], Optional[PDFJob]]:
+                return pool.apply_async(render, (path,)).get
+
+        else:
+            init_environment(templates_dir, cache_dir, profiler, image_dpi)
+
+            def start(path: str) -> Callable[[], Optional[PDFJob]]:
+                return functools.partial(render, path)
+
+        # wkhtmltopdf runs in its own process, WeasyPrint runs in Python
+        pdf_pool: Executor
+        if pdf_backend == "weasyprint":
+            pdf_pool = ProcessPoolExecutor(pdf_workers)
+        else:
+            pdf_pool = ThreadPoolExecutor(pdf_workers)
+        stack.enter_context(pdf_pool)
+
+        # Only a few reports are rendered ahead of the PDF conversion, so the
+        # rendered reports of a large batch are not all kept in memory. The
+        # PDF jobs only hold on to the rendered report until it is converted.
+        paths = iter(input_summary_paths)
+        renders = deque(start(path) for path in itertools.islice(paths, workers))
+        conversions: Deque[Tuple[str, Dict[str, float], Future[Dict[str, float]]]]
+        conversions = deque()
+
+        def finish() -> None:
+            sample_name, timings, future = conversions.popleft()
+            timings = dict(timings, **future.result())
+            print_timings(sample_name, timings)
+            if profiler is not None:
+                for stage, seconds in timings.items():
+                    profiler.add("stage", stage, seconds)
+
+        while renders:
+            job = renders.popleft()()
+            path = next(paths, None)
+            if path is not None:
+                renders.append(start(path))
+            if job is not None:
+                future = pdf_pool.submit(convert_pdf, job)
+                conversions.append((job.sample_name, job.timings, future))
+                del job
+            if len(conversions) >= 2 * pdf_workers:
+                finish()
+        while conversions:
+            finish()
+
+    if profiler is not None:
+        profiler.report()
+
+
+def read_manifest(manifest: str) -> List[str]:
+    """Read the summary paths from a manifest, one path per line"""
+    with open(manifest) as fin:
+        lines = (line.strip() for line in fin)
+        return [line for line in lines if line and not line.startswith("#")]
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("input_summary_path")
+    parser.add_argument("input_summary_path", nargs="*")
+    parser.add_argument(
+        "--manifest", help="File with the paths to more summaries, one per line"
+    )
     parser.add_argument("--css-path", default="report/assets/style.css")
     parser.add_argument("--templates-dir", default="report/templates")
     parser.add_argument("--imgs-dir", default="report/assets/img")
     parser.add_argument("--toc-path", default="report/assets/toc.xsl")
     parser.add_argument("--html-output", dest="html")
     parser.add_argument("--pdf-output", dest="pdf")
+    parser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir(),
+        help="Folder to cache the compiled templates (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache_dir",
+        action="store_const",
+        const=None,
+        help="Do not cache the compiled templates",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time spent per template and per filter to stderr",
+    )
+    parser.add_argument(
+        "--image-dpi",
+        type=int,
+        help="Downscale PNG images which are larger than a figure in the report "
+        "at this resolution (requires Pillow)",
+    )
+    parser.add_argument(
+        "--pdf-backend",
+        choices=list(PDF_BACKENDS),
+        default="pdfkit",
+        help="Program to convert the report to PDF (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to render the reports for multiple summaries",
+    )
+    parser.add_argument(
+        "--pdf-workers",
+        type=int,
+        default=1,
+        help="Number of PDF files to generate at the same time for multiple "
+        "summaries",
+    )
 
     args = parser.parse_args()
 
-    main(
-        args.input_summary_path,
-        args.css_path,
-        args.templates_dir,
-        args.imgs_dir,
-        args.toc_path,
-        args.html,
-        args.pdf,
-    )
+    summaries = list(args.input_summary_path)
+    if args.manifest:
+        summaries += read_manifest(args.manifest)
+    if not summaries:
+        parser.error("Please specify at least one summary")
+
+    if args.pdf_backend == "weasyprint" and not find_spec("weasyprint"):
+        parser.error("Please install WeasyPrint to use --pdf-backend weasyprint")
+
+    if args.image_dpi is not None and not HAS_PIL:
+        parser.error("Please install Pillow to use --image-dpi")
+
+    # Smaller images would be shown smaller than the figure size
+    if args.image_dpi is not None and args.image_dpi < 96:
+        parser.error("--image-dpi should be at least 96")
+
+    if len(summaries) > 1:
+        for output in (args.html, args.pdf):
+            if output and "{sample}" not in output:
+                msg = "Output paths should contain '{sample}' for multiple summaries"
+                parser.error(msg)
+        if args.profile and args.workers > 1:
+            parser.error("--profile is only supported with a single worker")
+
+        batch(
+            summaries,
+            args.css_path,
+            args.templates_dir,
+            args.imgs_dir,
+            args.toc_path,
+            args.html,
+            args.pdf,
+            args.cache_dir,
+            args.workers,
+            args.pdf_workers,
+            args.profile,
+            args.image_dpi,
+            args.pdf_backend,
+        )
+    else:
+        main(
+            summaries[0],
+            args.css_path,
+            args.templates_dir,
+            args.imgs_dir,
+            args.toc_path,
+            args.html,
+            args.pdf,
+            args.cache_dir,
+            args.profile,
+            args.image_dpi,
+            args.pdf_backend,
+        )
@@ -0,0 +1,260 @@
+import base64
+import importlib.util
+import io
+import os
+import pathlib
+import random
+import shutil
+import sys
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "generate_report", "scripts/generate_report.py"
+)
+assert spec is not None and spec.loader is not None
+generate_report = importlib.util.module_from_spec(spec)
+sys.modules["generate_report"] = generate_report
+spec.loader.exec_module(generate_report)
+
+LOGO = "report/assets/img/lumc-logo.jpg"
+PLOT = "report/assets/img/Myeloblast_logo.png"
+
+
+@pytest.fixture
+def images(tmp_path: pathlib.Path) -> dict[str, str]:
+    """A shared logo, and a plot for a single sample"""
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    sample = tmp_path / "sample"
+    sample.mkdir()
+    shutil.copy(LOGO, shared / "logo.jpg")
+    shutil.copy(PLOT, sample / "plot.png")
+    return {
+        "shared": str(shared),
+        "logo": str(shared / "logo.jpg"),
+        "plot": str(sample / "plot.png"),
+    }
+
+
+def test_asset_store_read_once(
+    images: dict[str, str], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    GIVEN an AssetStore
+    WHEN the same image is embedded multiple times
+    THEN it should only be read again after it has been modified
+    """
+    reads = list()
+    read_bytes = pathlib.Path.read_bytes
+
+    def counting_read_bytes(path: pathlib.Path) -> bytes:
+        reads.append(str(path))
+        return read_bytes(path)
+
+    monkeypatch.setattr(pathlib.Path, "read_bytes", counting_read_bytes)
+    store = generate_report.AssetStore()
+    uri = store.data_uri(images["logo"])
+    assert store.data_uri(images["logo"]) == uri
+    assert reads == [images["logo"]]
+
+    os.utime(images["logo"], ns=(0, 0))
+    assert store.data_uri(images["logo"]) == uri
+    assert len(reads) == 2
+    # The content did not change, so it is not encoded again
+    assert len(store.uris) == 1
+
+
+def test_asset_store_data_uri(images: dict[str, str]) -> None:
+    store = generate_report.AssetStore()
+    uri = store.data_uri(images["plot"])
+    prefix = "data:image/png;base64,"
+    assert uri.startswith(prefix)
+    decoded = base64.b64decode(uri[len(prefix) :])
+    assert decoded == pathlib.Path(images["plot"]).read_bytes()
+
+    with pytest.raises(ValueError, match="Unable to find file"):
+        store.data_uri(images["plot"] + ".missing")
+
+
+def test_asset_store_identical_content(
+    images: dict[str, str], tmp_path: pathlib.Path
+) -> None:
+    """Identical images from different paths should share one encoding"""
+    copy = tmp_path / "copy.jpg"
+    shutil.copy(images["logo"], copy)
+    store = generate_report.AssetStore()
+    assert store.data_uri(images["logo"]) == store.data_uri(str(copy))
+    assert len(store.digests) == 2
+    assert len(store.uris) == 1
+
+
+def test_asset_store_new_document(images: dict[str, str]) -> None:
+    """
+    GIVEN an AssetStore with a shared logo and a plot for a single sample
+    WHEN a new document is started
+    THEN only the shared logo should be kept
+    """
+    store = generate_report.AssetStore()
+    logo = store.data_uri(images["logo"])
+    store.data_uri(images["plot"])
+    assert len(store.uris) == 2
+
+    store.new_document(images["shared"])
+    assert [key[0] for key in store.digests] == [
+        str(pathlib.Path(images["logo"]).resolve())
+    ]
+    assert list(store.uris.values()) == [logo]
+
+    # Without a shared folder, nothing is kept
+    store.new_document()
+    assert not store.digests
+    assert not store.uris
+
+
+def test_asset_store_embedded_bytes(images: dict[str, str]) -> None:
+    store = generate_report.AssetStore()
+    logo = store.data_uri(images["logo"])
+    store.data_uri(images["logo"])
+    plot = store.data_uri(images["plot"])
+    assert store.embedded_bytes() == 2 * len(logo) + len(plot)
+
+    store.new_document(images["shared"])
+    assert store.embedded_bytes() == 0
+    store.data_uri(images["logo"])
+    assert store.embedded_bytes() == len(logo)
+
+
+def test_is_in_folder() -> None:
+    folder = pathlib.Path("/data/img")
+    assert generate_report.is_in_folder(folder, folder)
+    assert generate_report.is_in_folder(folder / "sub" / "logo.png", folder)
+    assert not generate_report.is_in_folder(pathlib.Path("/data/img2/x"), folder)
+    assert not generate_report.is_in_folder(pathlib.Path("/data"), folder)
+
+
+def test_default_cache_dir(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("HAMLET_CACHE", "/cache")
+    assert generate_report.default_cache_dir() == os.path.join("/cache", "jinja")
+
+    # Never write to the home folder of the user by default
+    monkeypatch.delenv("HAMLET_CACHE")
+    expected = os.path.join(".cache", "hamlet", "jinja")
+    assert generate_report.default_cache_dir() == expected
+
+
+def png(width: int, height: int) -> bytes:
+    """A PNG image with random pixels, which compresses badly"""
+    from PIL import Image
+
+    rng = random.Random(42)
+    pixels = bytes(rng.randrange(256) for _ in range(width * height * 3))
+    output = io.BytesIO()
+    Image.frombytes("RGB", (width, height), pixels).save(output, format="PNG")
+    return output.getvalue()
+
+
+@pytest.mark.skipif(not generate_report.HAS_PIL, reason="Pillow is not installed")
+def test_downscale_png() -> None:
+    from PIL import Image
+
+    data = png(400, 200)
+    smaller = generate_report.downscale_png(data, (100, 100))
+    assert len(smaller) < len(data)
+    with Image.open(io.BytesIO(smaller)) as img:
+        # The aspect ratio is kept
+        assert img.size == (100, 50)
+
+
+@pytest.mark.skipif(not generate_report.HAS_PIL, reason="Pillow is not installed")
+def test_downscale_png_small() -> None:
+    """Images which already fit are not changed"""
+    data = png(50, 50)
+    assert generate_report.downscale_png(data, (100, 100)) is data
+
+
+@pytest.mark.skipif(not generate_report.HAS_PIL, reason="Pillow is not installed")
+def test_asset_store_dpi(tmp_path: pathlib.Path) -> None:
+    """With a dpi, large PNG images are downscaled to the figure size"""
+    from PIL import Image
+
+    plot = tmp_path / "plot.png"
+    plot.write_bytes(png(1000, 1000))
+    uri = generate_report.AssetStore(dpi=96).data_uri(str(plot))
+    data = base64.b64decode(uri.split(",", 1)[1])
+    with Image.open(io.BytesIO(data)) as img:
+        assert img.size == (640, 640)
+
+
+OPTIONS = {
+    "page-size": "A4",
+    "margin-top": "20",
+    "margin-right": "16",
+    "margin-bottom": "20",
+    "margin-left": "16",
+    "header-center": "HAMLET report",
+    "footer-right": "Page [page] of [toPage]",
+}
+
+
+def test_page_css() -> None:
+    css = generate_report.page_css(OPTIONS)
+    assert css.startswith("@page { size: A4; margin: 20mm 16mm 20mm 16mm;")
+    assert '@top-center { content: "HAMLET report"; }' in css
+    assert (
+        '@bottom-right { content: "Page " counter(page) " of " counter(pages); }' in css
+    )
+
+
+def test_page_css_defaults() -> None:
+    assert (
+        generate_report.page_css({}) == "@page { size: A4; margin: 0mm 0mm 0mm 0mm; }"
+    )
+    css = generate_report.page_css({"page-size": "Letter", "margin-left": "5"})
+    assert "size: Letter; margin: 0mm 0mm 0mm 5mm;" in css
+
+
+def test_page_css_cover() -> None:
+    """The cover page has no header and footer"""
+    css = generate_report.page_css(OPTIONS, margin_boxes=False)
+    assert css == "@page { size: A4; margin: 20mm 16mm 20mm 16mm; }"
+
+
+@pytest.mark.parametrize(
+    "caption, content",
+    [
+        ("", '""'),
+        ("HAMLET", '"HAMLET"'),
+        ("[page]", "counter(page)"),
+        ("[page]/[toPage]", 'counter(page) "/" counter(pages)'),
+        ('Sample "S1"', '"Sample \\"S1\\""'),
+        ("back\\slash", '"back\\\\slash"'),
+    ],
+)
+def test_css_content(caption: str, content: str) -> None:
+    assert generate_report.css_content(caption) == content
+
+
+@pytest.mark.skipif(
+    importlib.util.find_spec("weasyprint") is None,
+    reason="WeasyPrint is not installed",
+)
+def test_weasyprint_report(tmp_path: pathlib.Path) -> None:
+    """
+    GIVEN the summary of the chrM test sample
+    WHEN we create the PDF report with WeasyPrint
+    THEN the PDF should be written
+    """
+    pdf = tmp_path / "report.pdf"
+    generate_report.main(
+        "test/data/output/v2/SRR8615409.vardict.summary.json",
+        "report/assets/style.css",
+        "report/templates",
+        "report/assets/img",
+        "report/assets/toc.xsl",
+        "",
+        str(pdf),
+        cache_dir=str(tmp_path / "cache"),
+        pdf_backend="weasyprint",
+    )
+    assert pdf.read_bytes().startswith(b"%PDF")
@@ -0,0 +1,379 @@
+import copy
+import importlib.util
+import json
+import pathlib
+import sys
+from typing import Any
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "hamlet_table", "utilities/hamlet_table.py"
+)
+assert spec is not None and spec.loader is not None
+hamlet_table = importlib.util.module_from_spec(spec)
+# Register the module, so the functions can be pickled for the worker processes
+sys.modules["hamlet_table"] = hamlet_table
+spec.loader.exec_module(hamlet_table)
+
+SUMMARY = "test/data/output/v2/SRR8615409.vardict.summary.json"
+EXPRESSION = "test/data/output/v2/SRR8615409.with_expression.summary.json"
+
+
+@pytest.fixture
+def cohort(tmp_path: pathlib.Path) -> list[str]:
+    """Summary files for a cohort of samples, with all modules"""
+    with open(SUMMARY) as fin:
+        data = json.load(fin)
+    with open(EXPRESSION) as fin:
+        data["modules"]["expression"] = json.load(fin)["modules"]["expression"]
+
+    json_files = list()
+    for i in range(4):
+        sample = copy.deepcopy(data)
+        sample["metadata"]["sample_name"] = f"sample{i}"
+        fname = tmp_path / f"sample{i}.summary.json"
+        fname.write_text(json.dumps(sample))
+        json_files.append(str(fname))
+    return json_files
+
+
+def print_table(table: str, json_files: list[str], fname: pathlib.Path) -> None:
+    with open(fname, "wt") as fout:
+
+        def write(*args: Any, **kwargs: Any) -> None:
+            print(*args, **kwargs, file=fout)
+
+        if table.endswith("_itd"):
+            hamlet_table.print_itd_table(json_files, table.split("_")[0], write)
+        else:
+            getattr(hamlet_table, f"print_{table}_table")(json_files, write)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_write_all_tables(
+    cohort: list[str], tmp_path: pathlib.Path, workers: int
+) -> None:
+    """
+    GIVEN a cohort of summary files
+    WHEN we write all tables at once
+    THEN every table should be identical to writing the tables one by one
+    """
+    output = tmp_path / "all"
+    output.mkdir()
+    hamlet_table.write_all_tables(cohort, str(output), workers)
+
+    for table in hamlet_table.ALL_TABLES:
+        expected = tmp_path / f"{table}.tsv"
+        print_table(table, cohort, expected)
+        assert (output / f"{table}.tsv").read_text() == expected.read_text()
+
+    variants = (output / "variant.tsv").read_text().splitlines()
+    assert variants[0].startswith("sample\tgene_name\thgvsc")
+    assert [line.split("\t")[0] for line in variants[1:]] == sorted(
+        line.split("\t")[0] for line in variants[1:]
+    )
+
+
+@pytest.mark.skipif(not hamlet_table.HAS_PYARROW, reason="pyarrow is not installed")
+def test_write_all_tables_parquet(cohort: list[str], tmp_path: pathlib.Path) -> None:
+    """
+    GIVEN a cohort of summary files
+    WHEN we write all tables in Parquet format
+    THEN the tables should contain the same rows as the TSV tables, with typed
+    columns
+    """
+    tsv = tmp_path / "tsv"
+    tsv.mkdir()
+    hamlet_table.write_all_tables(cohort, str(tsv))
+    parquet = tmp_path / "parquet"
+    parquet.mkdir()
+    hamlet_table.write_all_tables(cohort, str(parquet), format="parquet")
+
+    for table in hamlet_table.ALL_TABLES:
+        lines = (tsv / f"{table}.tsv").read_text().splitlines()
+        columns = hamlet_table.read_parquet_table(str(parquet / f"{table}.parquet"))
+        assert columns.column_names == lines[0].split("\t")
+        assert columns.num_rows == len(lines) - 1
+
+    variants = hamlet_table.read_parquet_table(str(parquet / "variant.parquet"))
+    assert str(variants.schema.field("vaf").type) == "double"
+    assert str(variants.schema.field("total_depth").type) == "int64"
+    # Empty placeholders in string columns are stored as null
+    assert str(variants.schema.field("hgvsg").type) == "string"
+    assert None in variants.column("hgvsg").to_pylist()
+    assert "" not in variants.column("hgvsg").to_pylist()
+    fusions = hamlet_table.read_parquet_table(str(parquet / "fusion.parquet"))
+    # Missing values are stored as null, not as the string 'None'
+    assert None in fusions.column("filters").to_pylist()
+    assert "None" not in fusions.column("filters").to_pylist()
+
+
+@pytest.mark.skipif(not hamlet_table.HAS_PYARROW, reason="pyarrow is not installed")
+def test_append_parquet(cohort: list[str], tmp_path: pathlib.Path) -> None:
+    """
+    GIVEN a Parquet table for part of a cohort
+    WHEN we append the remaining samples
+    THEN the table should contain all samples, and the first part should not
+    be rewritten
+    """
+    path = tmp_path / "variant.parquet"
+    hamlet_table.write_parquet_table(cohort[:2], "variant", str(path), append=True)
+    first = path / "part-00000.parquet"
+    before = first.stat().st_mtime_ns
+    hamlet_table.write_parquet_table(cohort[2:], "variant", str(path), append=True)
+
+    assert sorted(p.name for p in path.iterdir()) == [
+        "part-00000.parquet",
+        "part-00001.parquet",
+    ]
+    assert first.stat().st_mtime_ns == before
+
+    expected = tmp_path / "expected.parquet"
+    hamlet_table.write_parquet_table(cohort, "variant", str(expected))
+    appended = hamlet_table.read_parquet_table(str(path))
+    assert appended.equals(hamlet_table.read_parquet_table(str(expected)))
+
+
+@pytest.mark.skipif(not hamlet_table.HAS_PYARROW, reason="pyarrow is not installed")
+def test_parquet_mixed_modes(cohort: list[str], tmp_path: pathlib.Path) -> None:
+    """
+    GIVEN a Parquet table written without append
+    WHEN we append samples, and then write the table again without append
+    THEN the table should be a folder of parts, with the expected samples
+    """
+    path = tmp_path / "variant.parquet"
+    hamlet_table.write_parquet_table(cohort[:2], "variant", str(path))
+    assert path.is_dir()
+    hamlet_table.write_parquet_table(cohort[2:], "variant", str(path), append=True)
+    assert sorted(p.name for p in path.iterdir()) == [
+        "part-00000.parquet",
+        "part-00001.parquet",
+    ]
+    samples = hamlet_table.read_parquet_table(str(path)).column("sample")
+    assert sorted(set(samples.to_pylist())) == [f"sample{i}" for i in range(4)]
+
+    # Without append, the existing parts are replaced
+    hamlet_table.write_parquet_table(cohort[3:], "variant", str(path))
+    assert [p.name for p in path.iterdir()] == ["part-00000.parquet"]
+    samples = hamlet_table.read_parquet_table(str(path)).column("sample")
+    assert set(samples.to_pylist()) == {"sample3"}
+
+
+@pytest.mark.skipif(not hamlet_table.HAS_PYARROW, reason="pyarrow is not installed")
+def test_append_parquet_file(cohort: list[str], tmp_path: pathlib.Path) -> None:
+    """
+    GIVEN a single Parquet file
+    WHEN we append samples to it
+    THEN the file should become the first part of the table
+    """
+    path = tmp_path / "variant.parquet"
+    hamlet_table.write_parquet_table(cohort[:2], "variant", str(tmp_path / "first"))
+    (tmp_path / "first" / "part-00000.parquet").rename(path)
+    hamlet_table.write_parquet_table(cohort[2:], "variant", str(path), append=True)
+
+    expected = tmp_path / "expected.parquet"
+    hamlet_table.write_parquet_table(cohort, "variant", str(expected))
+    appended = hamlet_table.read_parquet_table(str(path))
+    assert appended.equals(hamlet_table.read_parquet_table(str(expected)))
+
+
+def test_write_all_tables_manifest(
+    cohort: list[str], tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    GIVEN a cohort of summary files which were tabulated before
+    WHEN we write all tables again after changing and adding a summary file
+    THEN only the changed and new files should be parsed
+    AND the tables should be identical to writing them from scratch
+    """
+    output = tmp_path / "all"
+    output.mkdir()
+    path = str(output / hamlet_table.MANIFEST)
+    manifest = hamlet_table.Manifest(path)
+    hamlet_table.write_all_tables(cohort[:3], str(output), manifest=manifest)
+    manifest.save(cohort[:3])
+
+    # Change the content of the second sample
+    data = json.loads(pathlib.Path(cohort[1]).read_text())
+    data["metadata"]["sample_name"] = "changed"
+    pathlib.Path(cohort[1]).write_text(json.dumps(data))
+
+    parsed = list()
+
+    def extract_all(fname: str) -> Any:
+        parsed.append(fname)
+        return extract(fname)
+
+    extract = hamlet_table.extract_all
+    monkeypatch.setattr(hamlet_table, "extract_all", extract_all)
+    manifest = hamlet_table.Manifest(path)
+    hamlet_table.write_all_tables(cohort, str(output), manifest=manifest)
+    manifest.save(cohort)
+    assert parsed == [cohort[1], cohort[3]]
+
+    expected = tmp_path / "expected"
+    expected.mkdir()
+    hamlet_table.write_all_tables(cohort, str(expected))
+    for table in hamlet_table.ALL_TABLES:
+        fname = f"{table}.tsv"
+        assert (output / fname).read_text() == (expected / fname).read_text()
+
+    # With rebuild, every file is parsed again
+    parsed.clear()
+    manifest = hamlet_table.Manifest(path, rebuild=True)
+    hamlet_table.write_all_tables(cohort, str(output), manifest=manifest)
+    assert parsed == cohort
+
+
+def write_all_tables_manifest(
+    json_files: list[str], output: pathlib.Path, **kwargs: Any
+) -> None:
+    """Write all tables using the manifest in output, like 'all' mode does"""
+    output.mkdir(exist_ok=True)
+    manifest = hamlet_table.Manifest(str(output / hamlet_table.MANIFEST))
+    hamlet_table.write_all_tables(json_files, str(output), manifest=manifest, **kwargs)
+    manifest.save(json_files)
+
+
+def sorted_rows(path: pathlib.Path) -> list[dict[str, Any]]:
+    rows = hamlet_table.read_parquet_table(str(path)).to_pylist()
+    return sorted(rows, key=json.dumps)
+
+
+@pytest.mark.skipif(not hamlet_table.HAS_PYARROW, reason="pyarrow is not installed")
+def test_append_parquet_after_tsv(cohort: list[str], tmp_path: pathlib.Path) -> None:
+    """
+    GIVEN all tables written as TSV, with a manifest
+    WHEN we append the same summary files in Parquet format to the same folder
+    THEN the Parquet tables should contain all samples
+    """
+    output = tmp_path / "all"
+    write_all_tables_manifest(cohort, output)
+    write_all_tables_manifest(cohort, output, format="parquet", append=True)
+
+    expected = tmp_path / "expected"
+    expected.mkdir()
+    hamlet_table.write_all_tables(cohort, str(expected), format="parquet")
+    for table in hamlet_table.ALL_TABLES:
+        fname = f"{table}.parquet"
+        assert sorted_rows(output / fname) == sorted_rows(expected / fname)
+
+
+@pytest.mark.skipif(not hamlet_table.HAS_PYARROW, reason="pyarrow is not installed")
+def test_append_parquet_changed(cohort: list[str], tmp_path: pathlib.Path) -> None:
+    """
+    GIVEN Parquet tables for part of a cohort, with a manifest
+    WHEN we append the cohort after changing one of the summary files
+    THEN the old rows of the changed summary file should be removed
+    AND every summary file should be in the tables only once
+    """
+    output = tmp_path / "all"
+    write_all_tables_manifest(cohort[:3], output, format="parquet", append=True)
+
+    data = json.loads(pathlib.Path(cohort[1]).read_text())
+    data["metadata"]["sample_name"] = "changed"
+    pathlib.Path(cohort[1]).write_text(json.dumps(data))
+    write_all_tables_manifest(cohort, output, format="parquet", append=True)
+    # Appending again does not change the tables
+    write_all_tables_manifest(cohort, output, format="parquet", append=True)
+
+    expected = tmp_path / "expected"
+    expected.mkdir()
+    hamlet_table.write_all_tables(cohort, str(expected), format="parquet")
+    for table in hamlet_table.ALL_TABLES:
+        fname = f"{table}.parquet"
+        assert sorted_rows(output / fname) == sorted_rows(expected / fname)
+
+    samples = hamlet_table.read_parquet_table(str(output / "variant.parquet"))
+    assert "sample1" not in samples.column("sample").to_pylist()
+
+
+def test_manifest_invalidated(
+    cohort: list[str], tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    GIVEN a manifest
+    WHEN the manifest version or the extractors change
+    THEN the manifest should not be used
+    """
+    output = tmp_path / "all"
+    write_all_tables_manifest(cohort, output)
+    path = str(output / hamlet_table.MANIFEST)
+    assert hamlet_table.Manifest(path).entries
+
+    monkeypatch.setattr(hamlet_table, "code_hash", lambda: "changed")
+    manifest = hamlet_table.Manifest(path)
+    assert not manifest.entries
+    assert not manifest.outputs
+    monkeypatch.undo()
+
+    monkeypatch.setattr(hamlet_table, "MANIFEST_VERSION", 0)
+    assert not hamlet_table.Manifest(path).entries
+
+
+@pytest.mark.skipif(not hamlet_table.HAS_PYARROW, reason="pyarrow is not installed")
+@pytest.mark.parametrize("invalidate", ["code_hash", "rebuild", "deleted"])
+def test_append_manifest_invalidated(
+    cohort: list[str],
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    invalidate: str,
+) -> None:
+    """
+    GIVEN Parquet tables for part of a cohort, with a manifest
+    WHEN the manifest is invalidated, and we append the remaining samples
+    THEN an error should be raised, and the existing tables should be kept
+    """
+    output = tmp_path / "all"
+    write_all_tables_manifest(cohort[:2], output, format="parquet", append=True)
+    variants = output / "variant.parquet"
+    before = sorted_rows(variants)
+    path = output / hamlet_table.MANIFEST
+    if invalidate == "code_hash":
+        monkeypatch.setattr(hamlet_table, "code_hash", lambda: "changed")
+    elif invalidate == "deleted":
+        path.unlink()
+    manifest = hamlet_table.Manifest(str(path), rebuild=invalidate == "rebuild")
+
+    with pytest.raises(RuntimeError, match="without --append"):
+        hamlet_table.write_all_tables(
+            cohort, str(output), format="parquet", append=True, manifest=manifest
+        )
+    assert sorted_rows(variants) == before
+
+    # Without --append, the tables are written from scratch
+    write_all_tables_manifest(cohort, output, format="parquet")
+    expected = tmp_path / "expected"
+    write_all_tables_manifest(cohort, expected, format="parquet")
+    assert sorted_rows(variants) == sorted_rows(expected / "variant.parquet")
+
+
+@pytest.mark.skipif(not hamlet_table.HAS_IJSON, reason="ijson is not installed")
+@pytest.mark.parametrize("table", hamlet_table.ALL_TABLES)
+def test_load_json_subtrees(cohort: list[str], table: str) -> None:
+    """
+    GIVEN a summary file
+    WHEN we only load the subtrees that are used for a table
+    THEN the rows for the table should be the same as for the full summary
+    """
+    paths = hamlet_table.SUBTREES[table]
+    full = hamlet_table.load_json(cohort[0])
+    partial = hamlet_table.load_json(cohort[0], paths)
+
+    extract = hamlet_table.EXTRACTORS[table]
+    assert extract(partial) == extract(full)
+
+
+@pytest.mark.skipif(not hamlet_table.HAS_IJSON, reason="ijson is not installed")
+def test_load_json_subtrees_pruned() -> None:
+    """
+    GIVEN a summary file
+    WHEN we load the subtree for the fusion events
+    THEN the other modules should not be loaded
+    """
+    data = hamlet_table.load_json(SUMMARY, ["modules.fusion.events"])
+    assert list(data) == ["modules"]
+    assert list(data["modules"]) == ["fusion"]
+    assert list(data["modules"]["fusion"]) == ["events"]
+    assert data["modules"]["fusion"]["events"][0]["gene1"] == "BCR"
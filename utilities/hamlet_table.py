@@ -2,231 +2,810 @@
 
 import argparse
 from collections.abc import Sequence
+import contextlib
+import hashlib
 import json
+import multiprocessing
 import os
 import functools
-from typing import Any, Dict, cast
+import re
+import tempfile
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, cast
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+try:
+    import ijson
+
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
 
 
 def main(args: argparse.Namespace) -> None:
-    functions: Dict[str, Any] = {
-        "variant": print_variant_table,
-        "fusion": print_fusion_table,
-        "itd": print_itd_table,
-        "expression": print_expression_table,
-        "celltype": print_celltype_table,
-        "aml_subtype": print_aml_subtype_table,
-    }
-    if args.table == "itd":
-        functions[args.table](args.json_files, args.itd_gene)
-    elif args.table in functions:
-        functions[args.table](args.json_files)
-    elif args.table == "all":
+    if args.table == "all":
         os.makedirs(args.output, exist_ok=True)
+        manifest = Manifest(os.path.join(args.output, MANIFEST), args.rebuild)
+        write_all_tables(
+            args.json_files,
+            args.output,
+            args.workers,
+            args.format,
+            args.append,
+            manifest,
+            args.streaming,
+        )
+        manifest.save(args.json_files)
+        return
+
+    table = f"{args.itd_gene}_itd" if args.table == "itd" else args.table
+    if table not in EXTRACTORS:
+        raise NotImplementedError(args.table)
+    paths = SUBTREES[table] if args.streaming else None
+    if args.format == "parquet":
+        write_parquet_table(args.json_files, table, args.output, args.append, paths)
+    else:
+        strict = table.endswith("_itd")
+        write_table(
+            args.json_files, EXTRACTORS[table], print, HEADERS.get(table), strict, paths
+        )
+
+
+# Extract the rows for a table from a summary JSON
+EXTRACTORS: Dict[str, Callable[[Dict[str, Any]], List[Dict[str, Any]]]] = {}
+# The parts of a summary JSON that are used for a table, for every supported
+# version of the summary
+SUBTREES: Dict[str, List[str]] = {
+    "variant": [
+        "metadata",
+        "modules.snv_indels.genes",
+        "snv_indels.genes",
+        "snv_indels.metadata",
+    ],
+    "fusion": [
+        "metadata",
+        "modules.fusion.events",
+        "results.fusion.tables.intersection.top20",
+        "fusion.events",
+        "fusion.metadata",
+    ],
+    "expression": [
+        "metadata",
+        "modules.expression.gene-expression",
+        "expression.gene-expression",
+        "expression.metadata",
+    ],
+    "celltype": [
+        "metadata",
+        "modules.expression.cell-types",
+        "expression.cell-types",
+        "expression.metadata",
+    ],
+    "aml_subtype": ["modules.expression.subtype", "expression.subtype"],
+    "flt3_itd": ["metadata", "modules.itd.flt3.table", "results.itd.flt3.table"],
+    "kmt2a_itd": ["metadata", "modules.itd.kmt2a.table", "results.itd.kmt2a.table"],
+}
+# Tables with a fixed header, which is written even if there are no rows
+HEADERS: Dict[str, List[str]] = {}
+# The tables written in 'all' mode, in order
+ALL_TABLES = [
+    "variant",
+    "fusion",
+    "expression",
+    "celltype",
+    "aml_subtype",
+    "flt3_itd",
+    "kmt2a_itd",
+]
+# Columns which are stored as strings in the summary, but have a numeric type
+COLUMN_TYPES: Dict[str, Dict[str, type]] = {
+    "variant": {
+        "vaf": float,
+        "ref_depth": int,
+        "alt_depth": int,
+        "total_depth": int,
+    },
+    "fusion": {
+        "split_reads1": int,
+        "split_reads2": int,
+        "discordant_mates": int,
+        "coverage1": int,
+        "coverage2": int,
+    },
+}
+
+
+# Name of the manifest in the output folder of 'all' mode
+MANIFEST = "hamlet_table.manifest.json"
+MANIFEST_VERSION = 2
+
+
+def load_json(fname: str, paths: Optional[Sequence[str]] = None) -> Any:
+    """Load a JSON file
+
+    If paths are specified and ijson is installed, only the subtrees at the
+    (dotted) paths are read into memory, together with the objects that
+    contain them. Otherwise, the whole file is loaded.
+    """
+    if paths is None or not HAS_IJSON:
+        with open(fname) as fin:
+            return json.load(fin)
+
+    with open(fname, "rb") as fin:
+        return load_subtrees(fin, paths)
+
+
+def load_subtrees(fin: Any, paths: Sequence[str]) -> Dict[str, Any]:
+    """Build a JSON object with only the subtrees at paths from fin"""
+    wanted = set(paths)
+    ancestors: Set[str] = set()
+    for path in paths:
+        keys = path.split(".")
+        ancestors.update(".".join(keys[:i]) for i in range(1, len(keys)))
+
+    relevant = wanted | ancestors
+
+    data: Dict[str, Any] = dict()
+    builder = None
+    depth = 0
+    for prefix, event, value in ijson.parse(fin, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+            if depth == 0:
+                set_path(data, target, builder.value)
+                builder = None
+        elif prefix not in relevant:
+            # Skip the other parts of the document as quickly as possible
+            continue
+        elif prefix in wanted and event in ("start_map", "start_array"):
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            depth = 1
+            target = prefix
+        elif prefix in wanted and event != "map_key":
+            set_path(data, prefix, value)
+        elif prefix in ancestors and event == "start_map":
+            set_path(data, prefix, dict())
+    return data
+
+
+def set_path(data: Dict[str, Any], path: str, value: Any) -> None:
+    *parents, key = path.split(".")
+    for parent in parents:
+        data = data[parent]
+    data[key] = value
+
+
+def extract_all(
+    fname: str, paths: Optional[Sequence[str]] = None
+) -> Dict[str, List[Dict[str, Any]]]:
+    """Extract the rows for every table from a single summary JSON"""
+    data = load_json(fname, paths)
+    return {table: EXTRACTORS[table](data) for table in ALL_TABLES}
+
+
+def file_hash(fname: str) -> str:
+    digest = hashlib.sha256()
+    with open(fname, "rb") as fin:
+        while chunk := fin.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(
+    fname: str, previous: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Return the size, modification time and content hash of a file
+
+    The hash is only calculated if the size or modification time differ from
+    the previous fingerprint.
+    """
+    stat = os.stat(fname)
+    fp: Dict[str, Any] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if previous is not None and all(previous.get(k) == v for k, v in fp.items()):
+        fp["sha256"] = previous["sha256"]
+    else:
+        fp["sha256"] = file_hash(fname)
+    return fp
+
+
+@functools.lru_cache(maxsize=None)
+def code_hash() -> str:
+    """Return the hash of this script, which contains the extractors"""
+    return file_hash(__file__)
+
+
+class Manifest:
+    """Fingerprints and extracted rows of the summary files in a cohort
+
+    Summary files which have the same content as in the manifest do not have
+    to be parsed again. The manifest also keeps track of the summary files in
+    every table file, so the rows of a summary file are only appended once.
+    The manifest is discarded when the version or the extractors change.
+    """
+
+    def __init__(self, path: str, rebuild: bool = False) -> None:
+        self.path = path
+        # Entries per absolute path, with the fingerprint and rows per table
+        self.entries: Dict[str, Dict[str, Any]] = dict()
+        # Fingerprints of summary files which are not (yet) in the manifest
+        self.pending: Dict[str, Dict[str, Any]] = dict()
+        # The summary files in every table file, per absolute path, with the
+        # content hash and, for Parquet tables, the part and range of the rows
+        self.outputs: Dict[str, Dict[str, Dict[str, Any]]] = dict()
+        if not rebuild and os.path.exists(path):
+            data = load_json(path)
+            if (data.get("version"), data.get("code")) == (
+                MANIFEST_VERSION,
+                code_hash(),
+            ):
+                self.entries = data["files"]
+                self.outputs = data["outputs"]
+
+    def cached_rows(self, fname: str) -> Optional[Dict[str, List[Dict[str, Any]]]]:
+        """Return the rows for fname, or None if it is new or has changed"""
+        key = os.path.abspath(fname)
+        entry = self.entries.get(key)
+        fp = fingerprint(fname, entry)
+        if entry is not None and entry["sha256"] == fp["sha256"]:
+            entry.update(fp)
+            return cast(Dict[str, List[Dict[str, Any]]], entry["rows"])
+        self.pending[key] = fp
+        return None
+
+    def sha256(self, fname: str) -> str:
+        """Return the content hash of fname, after cached_rows has been called"""
+        key = os.path.abspath(fname)
+        return cast(str, (self.pending.get(key) or self.entries[key])["sha256"])
+
+    def changed(self, fname: str, output: str) -> bool:
+        """Determine if fname has changed since its rows were written to output"""
+        entry = self.outputs.get(output, dict()).get(os.path.abspath(fname))
+        return entry is not None and entry["sha256"] != self.sha256(fname)
+
+    def add(self, fname: str, rows: Dict[str, List[Dict[str, Any]]]) -> None:
+        key = os.path.abspath(fname)
+        # The same file can be specified more than once
+        fp = self.pending.pop(key, None) or fingerprint(fname)
+        self.entries[key] = dict(fp, rows=rows)
+
+    def save(self, json_files: Sequence[str]) -> None:
+        """Write the manifest, with only the entries for json_files"""
+        keys = {os.path.abspath(fname) for fname in json_files}
+        files = {k: v for k, v in self.entries.items() if k in keys}
+        folder = os.path.dirname(self.path) or "."
+        fd, tmp = tempfile.mkstemp(dir=folder)
+        with os.fdopen(fd, "wt") as fout:
+            data = {
+                "version": MANIFEST_VERSION,
+                "code": code_hash(),
+                "files": files,
+                "outputs": self.outputs,
+            }
+            json.dump(data, fout)
+        os.replace(tmp, self.path)
+
+
+def write_all_tables(
+    json_files: Sequence[str],
+    output: str,
+    workers: int = 1,
+    format: str = "tsv",
+    append: bool = False,
+    manifest: Optional[Manifest] = None,
+    streaming: bool = False,
+) -> None:
+    """Write all tables, loading every summary JSON only once
+
+    The summary files are processed in parallel by the specified number of
+    workers, the rows are written in the order of the json files.
+
+    If a manifest is specified, only the summary files which are new or have
+    changed are parsed, the rows for the other files are taken from the
+    manifest. In append mode, only the rows of summary files which are not in
+    a Parquet table yet are added to it. The rows of summary files which have
+    changed are removed from the table first. Existing Parquet tables which are
+    not in the manifest cannot be appended to, since it is unknown which
+    summary files they contain.
+
+    With streaming, only the parts of the summary files that are used for the
+    tables are loaded.
+    """
+    extract: Callable[[str], Dict[str, List[Dict[str, Any]]]] = extract_all
+    if streaming:
+        paths = [path for table in ALL_TABLES for path in SUBTREES[table]]
+        extract = functools.partial(extract_all, paths=paths)
+
+    if manifest is None:
+        cached: List[Optional[Dict[str, List[Dict[str, Any]]]]] = [None] * len(
+            json_files
+        )
+    else:
+        cached = [manifest.cached_rows(fname) for fname in json_files]
+    stale = [fname for fname, rows in zip(json_files, cached) if rows is None]
+
+    if format == "parquet" and append and manifest is not None:
+        for table in ALL_TABLES:
+            path = f"{output}/{table}.{format}"
+            if os.path.isdir(path) and f"{table}.{format}" not in manifest.outputs:
+                raise RuntimeError(
+                    f"{path} is not in the manifest, for example after --rebuild "
+                    "or an update of hamlet_table.py. Run again without --append "
+                    "on the full cohort to write the table from scratch"
+                )
 
-        modules = "variant fusion expression celltype aml_subtype".split()
-        for m in modules:
-            fname = f"{args.output}/{m}.tsv"
-            with open(fname, "wt") as fout:
-                write = functools.partial(print, file=fout)
-                functions[m](args.json_files, write)
+    writers: Dict[str, TableWriter] = dict()
+    # The summary files in every table, see Manifest.outputs
+    contents: Dict[str, Dict[str, Dict[str, Any]]] = dict()
+    with contextlib.ExitStack() as stack:
+        for table in ALL_TABLES:
+            strict = table.endswith("_itd")
+            path = f"{output}/{table}.{format}"
+            contents[table] = dict()
+            if format == "parquet":
+                previous = None
+                if manifest is not None and os.path.isdir(path):
+                    previous = manifest.outputs.get(f"{table}.{format}")
+                if append and previous is not None:
+                    assert manifest is not None
+                    changed = {
+                        os.path.abspath(js)
+                        for js in json_files
+                        if manifest.changed(js, f"{table}.{format}")
+                    }
+                    remove_parquet_rows(path, previous, changed)
+                    contents[table] = previous
+                writer: TableWriter = ParquetWriter(
+                    path,
+                    COLUMN_TYPES.get(table),
+                    HEADERS.get(table),
+                    strict,
+                    append,
+                )
+            else:
+                fout = stack.enter_context(open(path, "wt"))
+                writer = TableWriter(
+                    functools.partial(print, file=fout), HEADERS.get(table), strict
+                )
+            writers[table] = stack.enter_context(writer)
 
-        for gene in ["flt3", "kmt2a"]:
-            fname = f"{args.output}/{gene}_itd.tsv"
-            with open(fname, "wt") as fout:
-                write = functools.partial(print, file=fout)
-                functions["itd"](args.json_files, gene, write)
+        if workers > 1 and stale:
+            pool = stack.enter_context(multiprocessing.Pool(workers))
+            results: Iterable[Dict[str, List[Dict[str, Any]]]] = pool.imap(
+                extract, stale
+            )
+        else:
+            results = map(extract, stale)
+
+        # The row ranges in the new Parquet parts, the part is only known once
+        # the writer is closed
+        new_ranges: Dict[str, List[List[Any]]] = {table: [] for table in ALL_TABLES}
+        fresh = iter(results)
+        for js, sample_rows in zip(json_files, cached):
+            if sample_rows is None:
+                sample_rows = next(fresh)
+                if manifest is not None:
+                    manifest.add(js, sample_rows)
+            key = os.path.abspath(js)
+            for table, rows in sample_rows.items():
+                writer = writers[table]
+                parquet = writer if isinstance(writer, ParquetWriter) else None
+                # The rows of this summary file are already in the table
+                if parquet is not None and parquet.append and key in contents[table]:
+                    continue
+                offset = 0 if parquet is None else len(parquet.rows)
+                writer.write_rows(rows)
+                if manifest is None:
+                    continue
+                entry = contents[table].setdefault(key, {"sha256": manifest.sha256(js)})
+                if parquet is not None:
+                    entry.setdefault("rows", list())
+                    if rows:
+                        entry["rows"].append([None, offset, len(rows)])
+                        new_ranges[table].append(entry["rows"][-1])
+
+    if manifest is None:
+        return
+    for table in ALL_TABLES:
+        for rows_range in new_ranges[table]:
+            rows_range[0] = cast(ParquetWriter, writers[table]).part
+        manifest.outputs[f"{table}.{format}"] = contents[table]
+
+
+def remove_parquet_rows(
+    path: str, content: Dict[str, Dict[str, Any]], keys: Set[str]
+) -> None:
+    """Remove the rows of the summary files in keys from a Parquet table
+
+    content contains the parts and rows of every summary file in the table,
+    see Manifest.outputs. Parts which contain rows of the removed summary files
+    are replaced by a new part without those rows, and content is updated.
+    """
+    removed = [content.pop(key) for key in keys if key in content]
+    parts = {part for entry in removed for part, _, _ in entry["rows"]}
+    for part in sorted(parts):
+        # The rows of the remaining summary files in this part, in order
+        remaining = sorted(
+            (
+                rows_range
+                for entry in content.values()
+                for rows_range in entry["rows"]
+                if rows_range[0] == part
+            ),
+            key=lambda rows_range: cast(int, rows_range[1]),
+        )
+        fname = os.path.join(path, part)
+        if remaining:
+            old = pyarrow.parquet.read_table(fname)
+            new = pyarrow.concat_tables(
+                [old.slice(offset, count) for _, offset, count in remaining]
+            )
+            new_part = write_parquet_part(path, new)
+            offset = 0
+            for rows_range in remaining:
+                rows_range[0], rows_range[1] = new_part, offset
+                offset += rows_range[2]
+        os.remove(fname)
+
+
+class TableWriter:
+    """Write rows to a table, with a header based on the first row"""
+
+    def __init__(
+        self, write: Any, header: Optional[List[str]] = None, strict: bool = False
+    ) -> None:
+        self.write = write
+        self.header = header
+        # Raise an error if the fields of a row differ from the header
+        self.strict = strict
+        if header is not None:
+            self.write_header(header)
+
+    def __enter__(self) -> "TableWriter":
+        return self
+
+    def __exit__(self, exc_type: Any, *args: Any) -> None:
+        # Do not write an incomplete table
+        if exc_type is None:
+            self.close()
+
+    def write_header(self, header: List[str]) -> None:
+        self.write(*header, sep="\t")
+
+    def write_row(self, row: Dict[str, Any]) -> None:
+        assert self.header is not None
+        self.write(*(row[field] for field in self.header), sep="\t")
+
+    def write_rows(self, rows: Iterable[Dict[str, Any]]) -> None:
+        for row in rows:
+            if self.header is None:
+                self.header = list(row.keys())
+                self.write_header(self.header)
+            elif self.strict and list(row.keys()) != self.header:
+                raise RuntimeError()
+            self.write_row(row)
+
+    def close(self) -> None:
+        pass
+
+
+class ParquetWriter(TableWriter):
+    """Write rows to a Parquet table, with typed columns
+
+    A Parquet table is a folder of Parquet files (parts). The rows are
+    collected in memory, and written as a new part when the writer is closed.
+    Without append, the existing parts are removed first. In append mode, the
+    rows are added as a new part, without rewriting the rows that are already
+    there.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        types: Optional[Dict[str, type]] = None,
+        header: Optional[List[str]] = None,
+        strict: bool = False,
+        append: bool = False,
+    ) -> None:
+        if not HAS_PYARROW:
+            raise RuntimeError("pyarrow is required to write Parquet files")
+        self.path = path
+        self.types = types or dict()
+        self.append = append
+        self.rows: List[Dict[str, Any]] = list()
+        # The name of the part that was written when the writer was closed
+        self.part: Optional[str] = None
+        super().__init__(None, header, strict)
+
+    def write_header(self, header: List[str]) -> None:
+        pass
+
+    def write_row(self, row: Dict[str, Any]) -> None:
+        self.rows.append(row)
+
+    def close(self) -> None:
+        if not self.append:
+            remove_parquet_table(self.path)
+        # Tables without a fixed header are not written if there are no rows
+        if self.header is None:
+            return
+        # There is nothing to append
+        if self.append and not self.rows:
+            return
+        table = arrow_table(self.rows, self.header, self.types)
+        parquet_folder(self.path)
+        self.part = write_parquet_part(self.path, table)
+
+
+def parquet_folder(path: str) -> None:
+    """Make sure path is a folder of Parquet parts
+
+    A single Parquet file at path, for example written by another tool, is
+    moved into the folder as the first part.
+    """
+    if os.path.isfile(path):
+        tmp = f"{path}.tmp"
+        os.replace(path, tmp)
+        os.makedirs(path)
+        os.replace(tmp, os.path.join(path, "part-00000.parquet"))
+    os.makedirs(path, exist_ok=True)
+
+
+def remove_parquet_table(path: str) -> None:
+    """Remove a Parquet table, either a single file or a folder of parts"""
+    if os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        for part in parquet_parts(path):
+            os.remove(os.path.join(path, part))
+        # Leave folders which contain other files
+        with contextlib.suppress(OSError):
+            os.rmdir(path)
+
+
+def parquet_parts(path: str) -> List[str]:
+    """Return the file names of the parts of a Parquet table, in order"""
+    return sorted(f for f in os.listdir(path) if f.endswith(".parquet"))
+
+
+def write_parquet_part(path: str, table: Any) -> str:
+    """Write table as the next part in the Parquet folder, return its name"""
+    numbers = [
+        int(match.group(1))
+        for part in parquet_parts(path)
+        if (match := re.fullmatch(r"part-(\d+)\.parquet", part))
+    ]
+    part = f"part-{max(numbers, default=-1) + 1:05d}.parquet"
+    # Fail instead of overwriting a part written at the same time
+    with open(os.path.join(path, part), "xb") as fout:
+        pyarrow.parquet.write_table(table, fout)
+    return part
+
+
+def arrow_table(
+    rows: List[Dict[str, Any]], header: List[str], types: Dict[str, type]
+) -> Any:
+    """Convert the rows to an Arrow table
+
+    Columns in types are converted to the specified type. Missing values,
+    including the empty strings the tables use as placeholder, are stored as
+    null, and nested values as a JSON string.
+    """
+    arrow_types = {int: pyarrow.int64(), float: pyarrow.float64()}
+    columns = list()
+    for field in header:
+        if field in types:
+            convert = types[field]
+            values = [
+                None if row[field] in (None, "", ".") else convert(row[field])
+                for row in rows
+            ]
+            columns.append(pyarrow.array(values, type=arrow_types[convert]))
+            continue
+
+        values = [
+            (
+                json.dumps(row[field])
+                if isinstance(row[field], (dict, list))
+                else None if row[field] == "" else row[field]
+            )
+            for row in rows
+        ]
+        try:
+            column = pyarrow.array(values)
+            # Columns without any values are stored as strings, so the parts
+            # of a table have the same schema
+            if column.type == pyarrow.null():
+                column = column.cast(pyarrow.string())
+            columns.append(column)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            # Columns with mixed types are stored as strings
+            strings = [None if value is None else str(value) for value in values]
+            columns.append(pyarrow.array(strings, type=pyarrow.string()))
+    return pyarrow.table(columns, names=header)
+
+
+def read_parquet_table(path: str) -> Any:
+    """Read a table written by ParquetWriter, including all appended parts"""
+    if not os.path.isdir(path):
+        return pyarrow.parquet.read_table(path)
+    tables = [
+        pyarrow.parquet.read_table(os.path.join(path, part))
+        for part in parquet_parts(path)
+    ]
+    return pyarrow.concat_tables(tables, promote_options="permissive")
 
-    else:
-        raise NotImplementedError(args.table)
+
+def write_parquet_table(
+    json_files: Sequence[str],
+    table: str,
+    path: str,
+    append: bool = False,
+    paths: Optional[Sequence[str]] = None,
+) -> None:
+    writer = ParquetWriter(
+        path,
+        COLUMN_TYPES.get(table),
+        HEADERS.get(table),
+        table.endswith("_itd"),
+        append,
+    )
+    with writer:
+        for js in json_files:
+            writer.write_rows(EXTRACTORS[table](load_json(js, paths)))
+
+
+def write_table(
+    json_files: Sequence[str],
+    extract: Callable[[Dict[str, Any]], List[Dict[str, Any]]],
+    write: Any = print,
+    header: Optional[List[str]] = None,
+    strict: bool = False,
+    paths: Optional[Sequence[str]] = None,
+) -> None:
+    writer = TableWriter(write, header, strict)
+    for js in json_files:
+        writer.write_rows(extract(load_json(js, paths)))
 
 
 def print_aml_subtype_table(json_files: Sequence[str], write: Any = print) -> None:
-    header = None
-    for js in json_files:
-        with open(js) as fin:
-            data = json.load(fin)
-            try:
-                subtype = data["modules"]["expression"]["subtype"]
-                subtype["sample"] = subtype.pop("sample_id")
-            except KeyError:
-                subtype = data["expression"]["subtype"]
-                subtype["sample"] = subtype.pop("sample_id")
+    write_table(json_files, aml_subtype_rows, write)
+
+
+def aml_subtype_rows(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    try:
+        subtype = data["modules"]["expression"]["subtype"]
+        sample = subtype["sample_id"]
+    except KeyError:
+        subtype = data["expression"]["subtype"]
+        sample = subtype["sample_id"]
+
+    # Put the sample, prediction and cutoff first
+    row = {
+        "sample": sample,
+        "prediction": subtype["prediction"],
+        "pass_cutoff": subtype["pass_cutoff"],
+    }
+    row.update((k, v) for k, v in subtype.items() if k not in row and k != "sample_id")
+    return [row]
 
-            if header is None:
-                header = ["sample", "prediction", "pass_cutoff"]
-                clusters = [field for field in subtype if field not in header]
 
-                header += clusters
-                write(*header, sep="\t")
+def print_celltype_table(json_files: Sequence[str], write: Any = print) -> None:
+    write_table(json_files, celltype_rows, write)
 
-            write(*(subtype[field] for field in header), sep="\t")
 
+def celltype_rows(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    try:
+        celltypes = data["modules"]["expression"]["cell-types"]
+        sample = sample_name(data)
+    except KeyError:
+        celltypes = data["expression"]["cell-types"]
+        sample = sample_name(data["expression"])
 
-def print_celltype_table(json_files: Sequence[str], write: Any = print) -> None:
-    header = None
-    for js in json_files:
-        with open(js) as fin:
-            data = json.load(fin)
-            try:
-                celltypes = data["modules"]["expression"]["cell-types"]
-                sample = sample_name(data)
-            except KeyError:
-                celltypes = data["expression"]["cell-types"]
-                sample = sample_name(data["expression"])
-
-            if header is None:
-                header = list(celltypes["data"].keys())
-                write("sample", *header, sep="\t")
-
-            write(
-                sample, *(celltypes["data"][celltype] for celltype in header), sep="\t"
-            )
+    row = {"sample": sample}
+    row.update(celltypes["data"])
+    return [row]
 
 
 def print_expression_table(json_files: Sequence[str], write: Any = print) -> None:
     """Print gene expression table"""
-    genes = None
-    for js in json_files:
-        with open(js) as fin:
-            data = json.load(fin)
-            if "modules" in data:
-                expression = data["modules"]["expression"]["gene-expression"]
-                sample = sample_name(data)
-            elif "expression" in data:
-                expression = data["expression"]["gene-expression"]
-                sample = sample_name(data["expression"])
-            else:
-                raise RuntimeError("Unknown json format")
+    write_table(json_files, expression_rows, write)
 
-            if genes is None:
-                genes = list(expression.keys())
 
-                # Print the header
-                header = ["sample"]
-                #  First add all normalized columns
-                for gene in genes:
-                    header.append(f"{gene}-normalized")
-                # Then add all raw columncs
-                for gene in genes:
-                    header.append(f"{gene}-raw")
-
-                write(*header, sep="\t")
-
-            # Print the data
-            row = [sample]
-            # First we append the normalized data in order
-            for gene in genes:
-                row.append(expression[gene]["normalized"])
-            for gene in genes:
-                row.append(expression[gene]["raw"])
+def expression_rows(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    if "modules" in data:
+        expression = data["modules"]["expression"]["gene-expression"]
+        sample = sample_name(data)
+    elif "expression" in data:
+        expression = data["expression"]["gene-expression"]
+        sample = sample_name(data["expression"])
+    else:
+        raise RuntimeError("Unknown json format")
 
-            write(*row, sep="\t")
+    row = {"sample": sample}
+    #  First add all normalized columns
+    for gene in expression:
+        row[f"{gene}-normalized"] = expression[gene]["normalized"]
+    # Then add all raw columns
+    for gene in expression:
+        row[f"{gene}-raw"] = expression[gene]["raw"]
+    return [row]
 
 
 def print_variant_table(json_files: Sequence[str], write: Any = print) -> None:
     """Print variant table"""
+    write_table(json_files, variant_rows, write, HEADERS["variant"])
 
-    # Print the header
-    header = "sample gene_name hgvsc hgvsp hgvsg database vaf exon annotation ref_depth alt_depth total_depth".split()
-    write(*header, sep="\t")
 
-    for fname in json_files:
-        with open(fname) as fin:
-            js = json.load(fin)
-
-        if "modules" in js:
-            genes = js["modules"]["snv_indels"]["genes"]
-            name = sample_name(js)
-        elif "snv_indels" in js:
-            genes = js["snv_indels"]["genes"]
-            name = sample_name(js["snv_indels"])
-        else:
-            raise RuntimeError("Unknown json format")
+def variant_rows(js: Dict[str, Any]) -> List[Dict[str, Any]]:
+    if "modules" in js:
+        genes = js["modules"]["snv_indels"]["genes"]
+        name = sample_name(js)
+    elif "snv_indels" in js:
+        genes = js["snv_indels"]["genes"]
+        name = sample_name(js["snv_indels"])
+    else:
+        raise RuntimeError("Unknown json format")
 
-        for gene, variants in genes.items():
-            for variant in variants:
-                # Dict to store all the column values we will print
-                ref, alt = variant["FORMAT"]["AD"].split(",")
+    rows = list()
+    for gene, variants in genes.items():
+        for variant in variants:
+            # Dict to store all the column values we will print
+            ref, alt = variant["FORMAT"]["AD"].split(",")
 
-                db_ids = ",".join(
-                    (var["id"] for var in variant.get("colocated_variants", []))
-                )
-                to_print = {
-                    "sample": name,
-                    "gene_name": gene,
-                    "total_depth": variant["FORMAT"]["DP"],
-                    "vaf": variant["FORMAT"]["AF"],
-                    "ref_depth": ref,
-                    "alt_depth": alt,
-                    "database": db_ids,
-                }
-
-                for transcript in variant["transcript_consequences"]:
-                    to_print["hgvsc"] = transcript.get("hgvsc", "")
-                    to_print["hgvsp"] = transcript.get("hgvsp", "")
-                    to_print["hgvsg"] = transcript.get("hgvsg", "")
-
-                    to_print["exon"] = transcript.get("exon", "")
-                    to_print["annotation"] = transcript.get("annotation", "")
-                write(*(to_print[field] for field in header), sep="\t")
+            db_ids = ",".join(
+                (var["id"] for var in variant.get("colocated_variants", []))
+            )
+            to_print = {
+                "sample": name,
+                "gene_name": gene,
+                "total_depth": variant["FORMAT"]["DP"],
+                "vaf": variant["FORMAT"]["AF"],
+                "ref_depth": ref,
+                "alt_depth": alt,
+                "database": db_ids,
+            }
+
+            for transcript in variant["transcript_consequences"]:
+                to_print["hgvsc"] = transcript.get("hgvsc", "")
+                to_print["hgvsp"] = transcript.get("hgvsp", "")
+                to_print["hgvsg"] = transcript.get("hgvsg", "")
+
+                to_print["exon"] = transcript.get("exon", "")
+                to_print["annotation"] = transcript.get("annotation", "")
+            rows.append(to_print)
+    return rows
 
 
 def print_fusion_table(json_files: Sequence[str], write: Any = print) -> None:
     """Print fusion table"""
-    header = [
-        "sample",
-        "gene1",
-        "gene2",
-        "strand1(gene/fusion)",
-        "strand2(gene/fusion)",
-        "breakpoint1",
-        "breakpoint2",
-        "site1",
-        "site2",
-        "type",
-        "split_reads1",
-        "split_reads2",
-        "discordant_mates",
-        "coverage1",
-        "coverage2",
-        "confidence",
-        "reading_frame",
-        "tags",
-        "retained_protein_domains",
-        "closest_genomic_breakpoint1",
-        "closest_genomic_breakpoint2",
-        "gene_id1",
-        "gene_id2",
-        "transcript_id1",
-        "transcript_id2",
-        "direction1",
-        "direction2",
-        "filters",
-        "fusion_transcript",
-        "peptide_sequence",
-    ]
-
-    write(*header, sep="\t")
-    for js in json_files:
-        with open(js) as fin:
-            data = json.load(fin)
-
-        if "modules" in data:  # HAMLET 2.0
-            fusions = data["modules"]["fusion"]["events"]
-            sample = sample_name(data)
-        elif "results" in data:  # HAMLET 1.0
-            fusions = data["results"]["fusion"]["tables"]["intersection"]["top20"]
-            sample = sample_name(data)
-        elif "fusion" in data:  # Output of the fusion module
-            fusions = data["fusion"]["events"]
-            sample = sample_name(data["fusion"])
-        else:
-            raise ValueError
+    write_table(json_files, fusion_rows, write, HEADERS["fusion"])
+
+
+def fusion_rows(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    if "modules" in data:  # HAMLET 2.0
+        fusions = data["modules"]["fusion"]["events"]
+        sample = sample_name(data)
+    elif "results" in data:  # HAMLET 1.0
+        fusions = data["results"]["fusion"]["tables"]["intersection"]["top20"]
+        sample = sample_name(data)
+    elif "fusion" in data:  # Output of the fusion module
+        fusions = data["fusion"]["events"]
+        sample = sample_name(data["fusion"])
+    else:
+        raise ValueError
 
-        for fusion in fusions:
-            fusion["sample"] = sample
-            write(*(fusion[key] for key in header), sep="\t")
+    return [dict(fusion, sample=sample) for fusion in fusions]
 
 
 def sample_name(data: Dict[str, Any]) -> str:
@@ -236,6 +815,11 @@ def sample_name(data: Dict[str, Any]) -> str:
 def print_itd_table(
     json_files: Sequence[str], itd_gene: str, write: Any = print
 ) -> None:
+    extract = functools.partial(itd_rows, itd_gene=itd_gene)
+    write_table(json_files, extract, write, strict=True)
+
+
+def itd_rows(data: Dict[str, Any], itd_gene: str) -> List[Dict[str, Any]]:
     def join_list(positions: Sequence[Any]) -> Any:
         """Join a list of positions
 
@@ -246,35 +830,69 @@ def print_itd_table(
         else:
             return positions
 
-    # Did we print the header already
-    header = None
-
-    for js in json_files:
-        with open(js) as fin:
-            data = json.load(fin)
-
-        if "modules" in data:  # HAMLET 2.0
-            itd_table = data["modules"]["itd"][itd_gene]["table"]
-        elif "results" in data:  # HAMLET 1.0
-            itd_table = data["results"]["itd"][itd_gene]["table"]
-
-        for event in itd_table:
-            event["td_ends"] = join_list(event["td_ends"])
-            event["td_starts"] = join_list(event["td_starts"])
-
-            # Sneakily put the sample name first
-            new_event = {"sample": sample_name(data)}
-            new_event.update(event)
-            event = new_event
-
-            if header is None:
-                header = list(event.keys())
-                write(*header, sep="\t")
-            else:
-                new_header = list(event.keys())
-                if new_header != header:
-                    raise RuntimeError()
-            write(*(event[field] for field in header), sep="\t")
+    if "modules" in data:  # HAMLET 2.0
+        itd_table = data["modules"]["itd"][itd_gene]["table"]
+    elif "results" in data:  # HAMLET 1.0
+        itd_table = data["results"]["itd"][itd_gene]["table"]
+
+    rows = list()
+    for event in itd_table:
+        # Sneakily put the sample name first
+        new_event = {"sample": sample_name(data)}
+        new_event.update(event)
+        new_event["td_ends"] = join_list(event["td_ends"])
+        new_event["td_starts"] = join_list(event["td_starts"])
+        rows.append(new_event)
+    return rows
+
+
+HEADERS["variant"] = (
+    "sample gene_name hgvsc hgvsp hgvsg database vaf exon annotation ref_depth alt_depth total_depth".split()
+)
+HEADERS["fusion"] = [
+    "sample",
+    "gene1",
+    "gene2",
+    "strand1(gene/fusion)",
+    "strand2(gene/fusion)",
+    "breakpoint1",
+    "breakpoint2",
+    "site1",
+    "site2",
+    "type",
+    "split_reads1",
+    "split_reads2",
+    "discordant_mates",
+    "coverage1",
+    "coverage2",
+    "confidence",
+    "reading_frame",
+    "tags",
+    "retained_protein_domains",
+    "closest_genomic_breakpoint1",
+    "closest_genomic_breakpoint2",
+    "gene_id1",
+    "gene_id2",
+    "transcript_id1",
+    "transcript_id2",
+    "direction1",
+    "direction2",
+    "filters",
+    "fusion_transcript",
+    "peptide_sequence",
+]
+
+EXTRACTORS.update(
+    {
+        "variant": variant_rows,
+        "fusion": fusion_rows,
+        "expression": expression_rows,
+        "celltype": celltype_rows,
+        "aml_subtype": aml_subtype_rows,
+        "flt3_itd": functools.partial(itd_rows, itd_gene="flt3"),
+        "kmt2a_itd": functools.partial(itd_rows, itd_gene="kmt2a"),
+    }
+)
 
 
 if __name__ == "__main__":
@@ -295,7 +913,40 @@ if __name__ == "__main__":
     )
     parser.add_argument("json_files", nargs="+")
     parser.add_argument("--itd-gene", required=False, choices=["flt3", "kmt2a"])
-    parser.add_argument("--output", help="Output folder when using 'all'")
+    parser.add_argument(
+        "--output",
+        help="Output folder when using 'all', or output folder for a single "
+        "table in Parquet format",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of summary files to process in parallel when using 'all'",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["tsv", "parquet"],
+        default="tsv",
+        help="Output format of the tables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Add the samples to existing Parquet tables, without rewriting them",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Only load the parts of the summary files that are used for the "
+        "tables (requires ijson)",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Parse all summary files when using 'all', instead of re-using the "
+        "rows for unchanged files from the manifest in the output folder",
+    )
 
     args = parser.parse_args()
 
@@ -305,4 +956,16 @@ if __name__ == "__main__":
     if args.table == "all" and not args.output:
         raise parser.error("Please specify an --output folder")
 
+    if args.format == "parquet" and not args.output:
+        raise parser.error("Please specify an --output folder")
+
+    if args.format == "parquet" and not HAS_PYARROW:
+        raise parser.error("Please install pyarrow to write Parquet files")
+
+    if args.streaming and not HAS_IJSON:
+        raise parser.error("Please install ijson to use --streaming")
+
+    if args.append and args.format != "parquet":
+        raise parser.error("--append is only supported for the Parquet format")
+
     main(args)